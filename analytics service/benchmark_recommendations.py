@@ -0,0 +1,59 @@
+# Benchmark of the co-view recommendation model on a synthetic watch history
+# Usage: python benchmark_recommendations.py [plays] [users] [videos]
+# No database is needed, the model is built directly from generated rows.
+
+from recommender import CoViewModel
+from time import perf_counter
+import numpy as np
+import sys
+
+def generate_history(plays, users, videos, seed=42):
+    rng = np.random.default_rng(seed)
+    # Popularity of the videos follows a Zipf-like distribution (a few videos get most of the plays)
+    popularity = 1.0 / np.arange(1, videos + 1) ** 0.8
+    popularity /= popularity.sum()
+    user_column = rng.integers(0, users, size=plays)
+    video_column = rng.choice(videos, size=plays, p=popularity)
+    categories = ["Film", "Sport", "Music", "News", "Education"]
+    return [
+        (f"user{user}", video + 1, categories[video % len(categories)])
+        for user, video in zip(user_column.tolist(), video_column.tolist())
+    ]
+
+def percentile(values, p):
+    return float(np.percentile(np.array(values) * 1000, p))
+
+def main():
+    plays = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    videos = int(sys.argv[3]) if len(sys.argv) > 3 else 5_000
+
+    print(f"Generating {plays} plays ({users} users, {videos} videos)...")
+    rows = generate_history(plays, users, videos)
+
+    model = CoViewModel()
+    start = perf_counter()
+    model.build(rows)
+    print(f"Build: {perf_counter() - start:.2f} s, {model.coview.nnz} non-zero co-view pairs")
+
+    # Incremental updates: 10 000 new plays
+    new_plays = [
+        {"username": username, "video_id": video_id, "category": category}
+        for username, video_id, category in generate_history(10_000, users, videos, seed=7)
+    ]
+    start = perf_counter()
+    model.record_plays(new_plays)
+    print(f"Record 10000 plays: {(perf_counter() - start) * 1000:.1f} ms")
+
+    # Recommendation latency for random users
+    rng = np.random.default_rng(1)
+    weights = {"Film": 5, "Sport": 2}
+    latencies = []
+    for user in rng.integers(0, users, size=1000).tolist():
+        start = perf_counter()
+        model.recommend(f"user{user}", weights, limit=3)
+        latencies.append(perf_counter() - start)
+    print(f"Recommend: p50 {percentile(latencies, 50):.2f} ms, p99 {percentile(latencies, 99):.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from time import monotonic, perf_counter
+import threading
+import os
+
+# Settings of the recommendation cache (can be set via environment variables)
+CACHE_MAX_SIZE = int(os.getenv("RECOMMENDATION_CACHE_MAX_SIZE", "10000"))    # Number of users kept in the cache
+CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "300"))              # Lifetime of an entry (in seconds)
+
+# Per-user cache of recommendation results with TTL and LRU eviction
+#
+# Every entry remembers the videos the user had watched when it was computed, so a play of user Y
+# invalidates Y and every cached user who watched one of Y's videos (Y's co-viewers).
+class RecommendationCache:
+    def __init__(self, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # username -> (expires_at, value, watched videos)
+        self._users_by_video = {}       # video -> usernames of the cached entries that depend on it
+        self._generation = 0            # Increased on every invalidation, results computed before it are not stored
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.recompute_count = 0
+        self.recompute_total_time = 0.0
+        self.recompute_max_time = 0.0
+
+    # Removes an entry and its reverse index (the lock must be held)
+    def _remove(self, username):
+        entry = self._entries.pop(username, None)
+        if entry is None:
+            return False
+        for video in entry[2]:
+            users = self._users_by_video.get(video)
+            if users is not None:
+                users.discard(username)
+                if not users:
+                    del self._users_by_video[video]
+        return True
+
+    # Returns the cached value or None if it is missing or expired
+    def get(self, username):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[0] < monotonic():
+                if entry is not None:
+                    self._remove(username)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)  # Mark as recently used
+            self.hits += 1
+            return entry[1]
+
+    # Stores a value computed at the given generation (skipped if an invalidation happened meanwhile)
+    def put(self, username, value, videos, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(username)
+            videos = frozenset(videos)
+            self._entries[username] = (monotonic() + self.ttl, value, videos)
+            for video in videos:
+                self._users_by_video.setdefault(video, set()).add(username)
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Returns the cached value or computes, measures and stores it
+    # compute() must return (value, watched videos of the user)
+    def get_or_compute(self, username, compute):
+        value = self.get(username)
+        if value is not None:
+            return value
+        generation = self._generation
+        start = perf_counter()
+        value, videos = compute()
+        elapsed = perf_counter() - start
+        with self._lock:
+            self.recompute_count += 1
+            self.recompute_total_time += elapsed
+            self.recompute_max_time = max(self.recompute_max_time, elapsed)
+        self.put(username, value, videos, generation)
+        return value
+
+    # Invalidates the users affected by a play: the player and everyone who watched one of the given videos
+    def invalidate(self, username, videos):
+        with self._lock:
+            self._generation += 1
+            affected = {username}
+            for video in videos:
+                affected.update(self._users_by_video.get(video, ()))
+            for affected_user in affected:
+                if self._remove(affected_user):
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "recompute_count": self.recompute_count,
+                "recompute_avg_ms": self.recompute_total_time / self.recompute_count * 1000 if self.recompute_count else 0.0,
+                "recompute_max_ms": self.recompute_max_time * 1000,
+            }
+
+# Shared cache used by the recommendation endpoint
+recommendation_cache = RecommendationCache()
@@ -0,0 +1,272 @@
+from sqlalchemy import MetaData, Table, Column, Integer, String, inspect, select, text
+from models import VideoViewCount, UserRecentVideos
+from database import upsert_insert
+from sqlalchemy.orm import Session
+from collections import Counter
+from time import monotonic
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the video catalog (can be set via environment variables)
+CATALOG_MAX_AGE = float(os.getenv("VIDEO_CATALOG_MAX_AGE", "300"))             # Seconds after which the catalog is reloaded
+CATALOG_MISS_INTERVAL = float(os.getenv("VIDEO_CATALOG_MISS_INTERVAL", "5"))   # Minimum seconds between reloads caused by unknown videos
+
+# Number of legacy rows converted at once by the migration
+MIGRATION_CHUNK_SIZE = 1000
+
+# The videos table of the vod management service (same database, only read here)
+# It has its own metadata, so create_all never creates or changes it
+videos = Table(
+    "videos", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("title", String),
+    Column("category", String),
+)
+
+# Converts a video id sent by a client to an int (None if it is missing or invalid)
+def parse_video_id(value):
+    try:
+        return int(value) if value is not None and value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+# In-memory copy of the video ids, titles and categories of the vod management service
+# Analytics is keyed on the video ids, the titles are only used at the edges (event input and responses)
+class VideoCatalog:
+    def __init__(self, max_age=CATALOG_MAX_AGE, miss_interval=CATALOG_MISS_INTERVAL):
+        self.max_age = max_age
+        self.miss_interval = miss_interval
+        self._lock = threading.Lock()
+        self._ids = {}       # video title -> video id (the lowest id if a title is used more than once)
+        self._videos = {}    # video id -> (title, category)
+        self._loaded_at = None
+
+    # Reloads the catalog from the videos table
+    def refresh(self, db: Session):
+        ids, videos_by_id = {}, {}
+        if inspect(db.get_bind()).has_table("videos"):
+            for row in db.execute(select(videos.c.id, videos.c.title, videos.c.category).order_by(videos.c.id)):
+                videos_by_id[row.id] = (row.title, row.category)
+                ids.setdefault(row.title, row.id)
+        else:
+            logger.warning("The videos table does not exist, video titles can't be resolved")
+        with self._lock:
+            self._ids, self._videos = ids, videos_by_id
+            self._loaded_at = monotonic()
+
+    # Applies a video.published or video.updated event of the vod management service (see events.py)
+    # The catalog stays current between the reloads: new videos resolve at once and renamed videos show the new title
+    def apply_event(self, event):
+        payload = event.payload
+        video_id, title = payload["video_id"], payload["title"]
+        with self._lock:
+            if self._loaded_at is None:
+                return # Not loaded yet, the first use loads the current state
+            ids, videos_by_id = dict(self._ids), dict(self._videos)
+            previous = videos_by_id.get(video_id)
+            videos_by_id[video_id] = (title, payload.get("category"))
+            if previous is not None and previous[0] != title and ids.get(previous[0]) == video_id:
+                # The old title now belongs to the lowest remaining id that has it (if any)
+                del ids[previous[0]]
+                others = [other_id for other_id, video in videos_by_id.items() if video[0] == previous[0]]
+                if others:
+                    ids[previous[0]] = min(others)
+            if title not in ids or ids[title] > video_id:
+                ids[title] = video_id
+            self._ids, self._videos = ids, videos_by_id
+
+    # Reloads the catalog if it is too old, or if something was not found and the last reload is not too recent
+    def _ensure_fresh(self, db: Session, missing=False):
+        age = None if self._loaded_at is None else monotonic() - self._loaded_at
+        if age is None or age > self.max_age or (missing and age > self.miss_interval):
+            self.refresh(db)
+
+    # Returns the ids of the given titles (titles that are not videos are left out)
+    def resolve_titles(self, db: Session, titles):
+        titles = set(titles)
+        self._ensure_fresh(db)
+        if any(title not in self._ids for title in titles):
+            self._ensure_fresh(db, missing=True)
+        ids = self._ids
+        return {title: ids[title] for title in titles if title in ids}
+
+    # Returns the titles of the given video ids (ids of deleted videos are left out)
+    def titles(self, db: Session, video_ids):
+        video_ids = set(video_ids)
+        self._ensure_fresh(db)
+        if any(video_id not in self._videos for video_id in video_ids):
+            self._ensure_fresh(db, missing=True)
+        videos_by_id = self._videos
+        return {video_id: videos_by_id[video_id][0] for video_id in video_ids if video_id in videos_by_id}
+
+    # Returns the category of a video known by the catalog (None if unknown)
+    def category(self, video_id):
+        video = self._videos.get(video_id)
+        return video[1] if video else None
+
+    # Returns the id of one video given by id or title (None if it is not a known video)
+    def resolve(self, db: Session, video_id=None, title=None):
+        video_id = parse_video_id(video_id)
+        if video_id is not None and self.titles(db, [video_id]):
+            return video_id
+        return self.resolve_titles(db, [title]).get(title) if title else None
+
+    # Sets "video_id" on every event that refers to a video (None if the video can't be resolved)
+    # A valid video id sent by the client wins over the title, the catalog is reloaded at most once per call
+    def resolve_events(self, db: Session, events):
+        references = []
+        for event in events:
+            metadata = event.get("activity_metadata") or {}
+            if metadata.get("video") or metadata.get("video_id") is not None:
+                references.append((event, parse_video_id(metadata.get("video_id")), metadata.get("video")))
+        if not references:
+            return
+
+        self._ensure_fresh(db)
+        if any(video_id not in self._videos and title not in self._ids for _, video_id, title in references):
+            self._ensure_fresh(db, missing=True)
+        ids, videos_by_id = self._ids, self._videos
+        for event, video_id, title in references:
+            event["video_id"] = video_id if video_id in videos_by_id else ids.get(title)
+
+# Shared catalog used by the API endpoints and the ingestion pipeline
+video_catalog = VideoCatalog()
+
+# Migration of the tables that were keyed on video titles
+#
+# video_view_count and user_recent_videos of the first release used the titles, every later analytics table
+# is keyed on video ids from the start. The title-keyed table is renamed to <name>_legacy and the new one is
+# created, so the service can start at once. The legacy rows are merged into the new table (two titles of the
+# same video add up) as soon as the videos table of the vod management service exists, on a later start if it
+# is not there yet. Rows of titles that are not (or no longer) videos can't be keyed and are dropped.
+
+# Returns the title -> id map used by the migration
+def load_title_ids(connection):
+    ids = {}
+    for row in connection.execute(select(videos.c.id, videos.c.title).order_by(videos.c.id)):
+        ids.setdefault(row.title, row.id)
+    return ids
+
+# The rows of a chunk are summed first, one upsert can't update the same record twice
+def merge_view_counts(db: Session, rows):
+    view_counts = Counter()
+    for row in rows:
+        view_counts[row["video_id"]] += row["view_count"]
+    stmt = upsert_insert(db, VideoViewCount).values([
+        {"video_id": video_id, "view_count": count} for video_id, count in sorted(view_counts.items())
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["video_id"],
+        set_={"view_count": VideoViewCount.view_count + stmt.excluded.view_count},
+    ))
+
+# Renames a table to <name>_legacy and frees its index and constraint names for the new table
+def rename_to_legacy(connection, table_name):
+    legacy = f"{table_name}_legacy"
+    connection.execute(text(f"ALTER TABLE {table_name} RENAME TO {legacy}"))
+    inspector = inspect(connection)
+    for index in inspector.get_indexes(legacy):
+        if not index.get("duplicates_constraint"):
+            connection.execute(text(f"DROP INDEX IF EXISTS {index['name']}"))
+    if connection.dialect.name == "postgresql":
+        for constraint in inspector.get_unique_constraints(legacy):
+            connection.execute(text(f"ALTER TABLE {legacy} DROP CONSTRAINT IF EXISTS {constraint['name']}"))
+    return legacy
+
+# Merges the legacy view counts into the new table (the plays counted since the rename are kept)
+def convert_view_counts(connection, title_ids):
+    legacy = f"{VideoViewCount.__tablename__}_legacy"
+    db = Session(bind=connection)
+    converted = dropped = 0
+    legacy_table = Table(legacy, MetaData(), autoload_with=connection)
+    rows = connection.execute(
+        select(legacy_table).order_by(legacy_table.c.id).execution_options(yield_per=MIGRATION_CHUNK_SIZE)
+    ).mappings()
+    for chunk in rows.partitions():
+        resolved = []
+        for row in chunk:
+            video_id = row.get("video_id") or title_ids.get(row["video_title"])
+            if video_id is None:
+                dropped += 1
+                continue
+            resolved.append({**row, "video_id": video_id})
+        if resolved:
+            merge_view_counts(db, resolved)
+            converted += len(resolved)
+    db.flush()
+    connection.execute(text(f"DROP TABLE {legacy}"))
+    logger.info("Converted %s to video id keys", VideoViewCount.__tablename__, extra={"rows_converted": converted, "rows_dropped": dropped})
+
+# Converts the recently watched title lists to video id lists (one row per user)
+# Users who played something since the rename already have a newer list, theirs is kept
+def convert_recent_videos(connection, title_ids):
+    table = UserRecentVideos.__table__
+    legacy = f"{table.name}_legacy"
+    legacy_table = Table(legacy, MetaData(), autoload_with=connection)
+    current = set(connection.execute(select(table.c.username)).scalars())
+    rows = connection.execute(
+        select(legacy_table.c.username, legacy_table.c.video_titles).order_by(legacy_table.c.id)
+    ).mappings().all()
+    records = []
+    for row in rows:
+        if row["username"] in current:
+            continue
+        video_ids = []
+        for title in row["video_titles"] or []:
+            video_id = title_ids.get(title)
+            if video_id is not None and video_id not in video_ids:
+                video_ids.append(video_id)
+        records.append({"username": row["username"], "video_ids": video_ids})
+    if records:
+        connection.execute(table.insert(), records)
+    connection.execute(text(f"DROP TABLE {legacy}"))
+    logger.info("Converted %s to video id keys", table.name, extra={"users_converted": len(records)})
+
+# Fills the missing video ids of the watch history from the titles (one set-based update)
+def backfill_history_video_ids(connection):
+    updated = connection.execute(text(
+        "UPDATE user_video_history SET video_id = resolved.video_id "
+        "FROM (SELECT title, min(id) AS video_id FROM videos GROUP BY title) AS resolved "
+        "WHERE user_video_history.video_id IS NULL AND user_video_history.video_title = resolved.title"
+    )).rowcount
+    if updated:
+        logger.info("Filled in the video ids of user_video_history", extra={"rows_updated": updated})
+
+# Tables of the first release that were keyed on video titles: (model, title column, function converting the legacy rows)
+LEGACY_TABLES = (
+    (VideoViewCount, "video_title", convert_view_counts),
+    (UserRecentVideos, "video_titles", convert_recent_videos),
+)
+
+# Migrates the title-keyed tables (runs before create_all, every step is skipped once done)
+def migrate_video_keys(engine):
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for model, title_column, _ in LEGACY_TABLES:
+            table_name = model.__tablename__
+            if inspector.has_table(table_name) and title_column in {column["name"] for column in inspector.get_columns(table_name)}:
+                logger.info("Converting %s to video id keys", table_name)
+                rename_to_legacy(connection, table_name)
+                model.__table__.create(connection)
+
+    inspector = inspect(engine)
+    pending = [(model, convert) for model, _, convert in LEGACY_TABLES if inspector.has_table(f"{model.__tablename__}_legacy")]
+    has_videos = inspector.has_table("videos")
+    has_history = inspector.has_table("user_video_history")
+    if pending and not has_videos:
+        logger.warning(
+            "The videos table does not exist yet, the legacy rows are converted on a later start",
+            extra={"tables": [f"{model.__tablename__}_legacy" for model, _ in pending]},
+        )
+        return
+
+    with engine.begin() as connection:
+        if pending:
+            title_ids = load_title_ids(connection)
+            for _, convert in pending:
+                convert(connection, title_ids)
+        if has_videos and has_history:
+            backfill_history_video_ids(connection)
@@ -0,0 +1,127 @@
+# Concurrency check of the play aggregates: many writers add plays at the same time, the counters must be exact
+# Usage: python check_play_counts.py [threads] [batches per thread] [database URL]
+# Every thread writes its batches with its own session, like the writers of several replicas do. A batch that
+# fails with a transient error (e.g. "database is locked" on SQLite) is written again, as the ingestion buffer does.
+# Without a URL a new SQLite file is used. On PostgreSQL use a test database: the videos of the check are added to
+# its videos table and the counters are compared to their values before the run.
+
+from datetime import datetime
+from collections import Counter
+import tempfile
+import threading
+import sys
+import os
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+BATCHES = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+if len(sys.argv) > 3:
+    os.environ["DATABASE_URL"] = sys.argv[3]
+else:
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp(prefix='play-counts-')}/analytics.db?timeout=30"
+
+from database import SessionLocal, engine, init_db
+from models import VideoViewCount, UserCategoryPreference
+from ingestion import process_batch, is_transient_error
+from catalog import videos
+
+VIDEOS = 5
+USERS = 8
+CATEGORIES = ["Film", "Sport"]
+PLAYS_PER_BATCH = 20
+
+# Adds the videos of the check (the videos table is created if the vod management service did not do it yet)
+def create_videos(run_id):
+    videos.metadata.create_all(bind=engine)
+    titles = [f"Play count check {run_id} video {number}" for number in range(VIDEOS)]
+    with engine.begin() as connection:
+        connection.execute(videos.insert(), [
+            {"title": title, "category": CATEGORIES[number % len(CATEGORIES)]} for number, title in enumerate(titles)
+        ])
+    return titles
+
+def read_counters():
+    db = SessionLocal()
+    try:
+        view_counts = {row.video_id: row.view_count for row in db.query(VideoViewCount)}
+        preferences = {(row.username, row.category): row.view_count for row in db.query(UserCategoryPreference)}
+        return view_counts, preferences
+    finally:
+        db.close()
+
+def main():
+    init_db()
+    run_id = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    titles = create_videos(run_id)
+    users = [f"play-count-check-{run_id}-{number}" for number in range(USERS)]
+    view_counts_before, _ = read_counters()
+
+    # Plays sent by thread t, batch b: the expected counters follow from the same formula
+    def batch_events(thread, batch):
+        return [
+            {
+                "username": users[(thread + play) % USERS],
+                "event_type": "play-video",
+                "activity_metadata": {"video": titles[(batch + play) % VIDEOS]},
+                "timestamp": datetime.utcnow(),
+            }
+            for play in range(PLAYS_PER_BATCH)
+        ]
+
+    retries = Counter()
+    errors = []
+
+    def writer(thread):
+        for batch in range(BATCHES):
+            while True:
+                events = batch_events(thread, batch)
+                db = SessionLocal()
+                try:
+                    process_batch(db, events)
+                    break
+                except Exception as e:
+                    db.rollback()
+                    if not is_transient_error(e):
+                        errors.append(e)
+                        return
+                    retries[thread] += 1
+                finally:
+                    db.close()
+
+    threads = [threading.Thread(target=writer, args=(thread,)) for thread in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    # Expected plays per video and per (user, category)
+    expected_videos, expected_preferences = Counter(), Counter()
+    for thread in range(THREADS):
+        for batch in range(BATCHES):
+            for event in batch_events(thread, batch):
+                number = titles.index(event["activity_metadata"]["video"])
+                expected_videos[number] += 1
+                expected_preferences[(event["username"], CATEGORIES[number % len(CATEGORIES)])] += 1
+
+    with engine.connect() as connection:
+        ids = {row.title: row.id for row in connection.execute(videos.select().where(videos.c.title.in_(titles)))}
+    view_counts, preferences = read_counters()
+    failures = []
+    for number, title in enumerate(titles):
+        counted = view_counts.get(ids[title], 0) - view_counts_before.get(ids[title], 0)
+        if counted != expected_videos[number]:
+            failures.append(f"{title}: {counted} views, expected {expected_videos[number]}")
+    for key, expected in expected_preferences.items():
+        if preferences.get(key, 0) != expected:
+            failures.append(f"{key}: {preferences.get(key, 0)} category views, expected {expected}")
+
+    total = THREADS * BATCHES * PLAYS_PER_BATCH
+    print(f"{THREADS} threads wrote {total} plays ({sum(retries.values())} batches retried after transient errors)")
+    if failures:
+        print("Counters are wrong:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print(f"View counts and category preferences are exact ({sum(expected_videos.values())} views)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+from sqlalchemy import MetaData, Table, Column, BigInteger, Integer, String, DateTime, JSON, select, delete, or_, func, event
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from collections import namedtuple
+from database import engine
+from time import monotonic
+import threading
+import logging
+import select as io_select
+import os
+
+logger = logging.getLogger(__name__)
+
+# The same module is used by the vod management and analytics services (copied into both directories)
+
+# Settings of the event bus (can be set via environment variables)
+EVENT_BUS_BACKEND = os.getenv("EVENT_BUS_BACKEND", "outbox")                  # "outbox" (shared database) or "memory" (in-process, for tests)
+EVENT_CHANNEL = os.getenv("EVENT_CHANNEL", "vod_events")                      # PostgreSQL NOTIFY channel
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "5"))            # Seconds between outbox reads when no notification arrives
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "500"))                  # Events read from the outbox at once
+EVENT_GAP_TIMEOUT = float(os.getenv("EVENT_GAP_TIMEOUT", "30"))               # Seconds a missing id is waited for (its transaction may commit late)
+EVENT_RETENTION_HOURS = float(os.getenv("EVENT_RETENTION_HOURS", "24"))       # Age after which delivered events are deleted from the outbox
+
+# Larger jumps of the id sequence are not tracked as missing ids (e.g. after a sequence restart)
+MAX_TRACKED_GAP = 10000
+
+# Topics published by the services
+VIDEO_PUBLISHED = "video.published"     # A new video was added to the catalog
+VIDEO_UPDATED = "video.updated"         # The metadata (title, category, ...) of a video changed
+COMMENT_CREATED = "comment.created"     # A comment was written
+
+# The outbox table: every event is inserted in the transaction of the change it describes
+# It has its own metadata, so the services create it next to their own tables (see create_event_tables)
+outbox = Table(
+    "event_outbox", MetaData(),
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("topic", String(100), nullable=False),
+    Column("payload", JSON, nullable=False),
+    Column("created_at", DateTime, nullable=False, index=True),
+)
+
+# One delivered event
+Event = namedtuple("Event", ["id", "topic", "payload", "created_at"])
+
+# Creates the outbox table if it does not exist
+def create_event_tables(bind):
+    outbox.metadata.create_all(bind=bind)
+
+# Handlers of the subscribers, called on the thread that delivers the events
+class EventBus:
+    def __init__(self):
+        self._handlers = []     # (topic, handler), a topic ending with "*" is a prefix (e.g. "video.*")
+
+    # Registers a handler for a topic ("video.updated") or a group of topics ("video.*")
+    def subscribe(self, topic, handler):
+        self._handlers.append((topic, handler))
+
+    def _dispatch(self, event):
+        for topic, handler in self._handlers:
+            if topic == event.topic or (topic.endswith("*") and event.topic.startswith(topic[:-1])):
+                try:
+                    handler(event)
+                except Exception:
+                    logger.exception("Event handler failed", extra={"topic": event.topic, "event_id": event.id})
+
+# In-process backend for tests: the events are delivered right after the transaction commits
+class InMemoryEventBus(EventBus):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self.delivered = []     # Every delivered event, in order
+
+    # Queues the event on the session, it is delivered if the transaction commits
+    def publish(self, db: Session, topic, payload):
+        # Begin the transaction like the INSERT of the outbox would, so a rollback drops the event
+        if not db.in_transaction():
+            db.begin()
+        db.info.setdefault("pending_events", []).append((self, topic, payload))
+
+    def _deliver(self, topic, payload):
+        with self._lock:
+            self._last_id += 1
+            event = Event(self._last_id, topic, payload, datetime.utcnow())
+            self.delivered.append(event)
+        self._dispatch(event)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def status(self):
+        return {"backend": "memory", "delivered": len(self.delivered)}
+
+@event.listens_for(Session, "after_commit")
+def _deliver_committed_events(session):
+    for bus, topic, payload in session.info.pop("pending_events", []):
+        bus._deliver(topic, payload)
+
+# Fires on every rollback, also when the transaction had not sent anything to the database yet
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_rolled_back_events(session, previous_transaction):
+    session.info.pop("pending_events", None)
+
+# Durable backend: the events are written to the outbox table of the shared database
+#
+# A subscriber reads the outbox after the last id it delivered, so no event is lost while it is busy or
+# disconnected. On PostgreSQL the publishing transaction also sends a NOTIFY, which wakes the subscribers
+# as soon as it commits; without notifications (SQLite, or while the listening connection is down) the
+# outbox is read every EVENT_POLL_INTERVAL seconds.
+#
+# Ids are assigned when a row is inserted, not when it commits, so a transaction that commits late can
+# make a lower id visible after a higher one was delivered. Skipped ids are therefore read again for
+# EVENT_GAP_TIMEOUT seconds (ids of rolled back transactions never appear). Such late events are
+# delivered out of order, the handlers must apply the state in the payload instead of counting events.
+#
+# A subscriber starts at the end of the outbox: it loads the current state itself (e.g. the catalog)
+# and keeps it up to date with the events. Delivered events are deleted after EVENT_RETENTION_HOURS.
+class OutboxEventBus(EventBus):
+    def __init__(self, engine, poll_interval=EVENT_POLL_INTERVAL, batch_size=EVENT_BATCH_SIZE,
+                 gap_timeout=EVENT_GAP_TIMEOUT, retention_hours=EVENT_RETENTION_HOURS):
+        super().__init__()
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.gap_timeout = gap_timeout
+        self.retention = timedelta(hours=retention_hours)
+        self._position = None   # Highest delivered id
+        self._gaps = {}         # Skipped id -> time it was first missed
+        self._delivered = 0
+        self._listening = False
+        self._last_cleanup = None
+        self._stop = threading.Event()
+        self._wake_read, self._wake_write = None, None
+        self._thread = None
+
+    # Writes the event in the transaction of the session (sent when the caller commits)
+    def publish(self, db: Session, topic, payload):
+        db.execute(outbox.insert().values(topic=topic, payload=payload, created_at=datetime.utcnow()))
+        if db.get_bind().dialect.name == "postgresql":
+            # PostgreSQL sends the notification when (and only if) the transaction commits
+            db.execute(select(func.pg_notify(EVENT_CHANNEL, topic)))
+
+    # Reads the events after the position (and the missing ids) and delivers them, returns their number
+    def poll(self):
+        condition = outbox.c.id > self._position
+        if self._gaps:
+            condition = or_(condition, outbox.c.id.in_(list(self._gaps)))
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(outbox).where(condition).order_by(outbox.c.id).limit(self.batch_size)).all()
+
+        now = monotonic()
+        for row in rows:
+            if self._gaps.pop(row.id, None) is None:
+                # Ids between the position and this one may belong to transactions that are still running
+                if row.id - self._position <= MAX_TRACKED_GAP:
+                    self._gaps.update((missing, now) for missing in range(self._position + 1, row.id))
+                self._position = row.id
+            self._delivered += 1
+            self._dispatch(Event(row.id, row.topic, row.payload, row.created_at))
+        for missing, missed_at in list(self._gaps.items()):
+            if now - missed_at > self.gap_timeout:
+                del self._gaps[missing]
+        return len(rows)
+
+    # Deletes the events older than the retention period (at most once an hour)
+    def cleanup(self):
+        if self._last_cleanup is not None and monotonic() - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = monotonic()
+        with self.engine.begin() as connection:
+            deleted = connection.execute(delete(outbox).where(outbox.c.created_at < datetime.utcnow() - self.retention)).rowcount
+        if deleted:
+            logger.info("Deleted old events from the outbox", extra={"events": deleted})
+
+    # Opens a separate connection (outside the pool) that listens to the notifications
+    def _listen(self):
+        cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+        connection = self.engine.dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {EVENT_CHANNEL}")
+        return connection
+
+    # Waits for a notification, the poll interval or stop()
+    def _wait(self, listener):
+        sources = [self._wake_read] + ([listener] if listener is not None else [])
+        ready, _, _ = io_select.select(sources, [], [], self.poll_interval)
+        if listener is not None and listener in ready:
+            listener.poll()
+            listener.notifies.clear()
+
+    def _run(self):
+        listener = None
+        while not self._stop.is_set():
+            try:
+                if listener is None and self.engine.dialect.name == "postgresql":
+                    listener = self._listen()
+                    self._listening = True
+                # Read until the outbox is drained (a full batch means more may be waiting)
+                while self.poll() >= self.batch_size and not self._stop.is_set():
+                    pass
+                self.cleanup()
+            except Exception as e:
+                logger.warning("Event bus error, retrying: %s", e)
+                if listener is not None:
+                    try:
+                        listener.close()
+                    except Exception:
+                        pass
+                    listener, self._listening = None, False
+            if not self._stop.is_set():
+                self._wait(listener)
+        if listener is not None:
+            listener.close()
+            self._listening = False
+
+    # Starts delivering the events published from now on
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        create_event_tables(self.engine)
+        with self.engine.connect() as connection:
+            self._position = connection.execute(select(func.coalesce(func.max(outbox.c.id), 0))).scalar()
+        self._stop.clear()
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="event-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            os.write(self._wake_write, b"x")
+            self._thread.join(timeout=5)
+            self._thread = None
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
+    def status(self):
+        return {
+            "backend": "outbox",
+            "listening": self._listening,
+            "position": self._position,
+            "pending_gaps": len(self._gaps),
+            "delivered": self._delivered,
+        }
+
+def create_event_bus(backend=EVENT_BUS_BACKEND):
+    if backend == "memory":
+        return InMemoryEventBus()
+    if backend == "outbox":
+        return OutboxEventBus(engine)
+    raise ValueError(f"Unknown event bus backend: {backend}")
+
+# Shared event bus of the service
+event_bus = create_event_bus()
@@ -0,0 +1,113 @@
+from fastapi.responses import StreamingResponse
+from fastapi import HTTPException
+from sqlalchemy import select, tuple_
+from database import SessionLocal
+from datetime import datetime
+import json
+import csv
+import io
+
+# Number of rows fetched from the server-side cursor at once in export mode
+STREAM_CHUNK_SIZE = 1000
+
+# Media types of the supported export formats
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Cursor format: "<timestamp ISO format>,<id>" of the last returned row ("null,<id>" for rows without a timestamp)
+def encode_cursor(row):
+    timestamp = row["timestamp"].isoformat() if row["timestamp"] is not None else "null"
+    return f"{timestamp},{row['id']}"
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, row_id = cursor.rsplit(",", 1)
+        return (None if timestamp == "null" else datetime.fromisoformat(timestamp)), int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# Builds the selects of the rows after the keyset cursor, filtered by time range and column values
+# The rows are read in two phases: first the rows with a timestamp, ordered by (timestamp, id) and bounded by the
+# cursor on the (timestamp, id) index, then the rows without a timestamp (written before it had a default),
+# ordered by id. A time range filter leaves the rows without a timestamp out.
+def build_queries(model, start=None, end=None, cursor=None, **filters):
+    conditions = []
+    if start is not None:
+        conditions.append(model.timestamp >= start)
+    if end is not None:
+        conditions.append(model.timestamp < end)
+    for column, value in filters.items():
+        if value is not None:
+            conditions.append(getattr(model, column) == value)
+    timestamp, row_id = decode_cursor(cursor) if cursor else (None, None)
+    columns = model.__table__.columns
+
+    queries = []
+    # A "null,<id>" cursor is already past the rows with a timestamp
+    if row_id is None or timestamp is not None:
+        dated = [model.timestamp.is_not(None)]
+        if timestamp is not None:
+            dated.append(tuple_(model.timestamp, model.id) > tuple_(timestamp, row_id))
+        queries.append(select(*columns).where(*conditions, *dated).order_by(model.timestamp, model.id))
+    if start is None and end is None:
+        undated = [model.timestamp.is_(None)]
+        if row_id is not None and timestamp is None:
+            undated.append(model.id > row_id)
+        # Ordered by id (the timestamp is null), listing the timestamp too lets the (timestamp, id) index serve the order
+        queries.append(select(*columns).where(*conditions, *undated).order_by(model.timestamp, model.id))
+    return queries
+
+# Returns one page of rows and the cursor of the next page (None on the last page)
+# The next phase is only read if the page is not full yet
+def fetch_page(db, queries, limit):
+    rows = []
+    for query in queries:
+        rows += [dict(row) for row in db.execute(query.limit(limit + 1 - len(rows))).mappings()]
+        if len(rows) > limit:
+            break
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+# Reads the rows of every phase with a server-side cursor, a chunk at a time, so memory use stays constant
+def iter_rows(queries):
+    db = SessionLocal() # The request session is closed before the response body is streamed
+    try:
+        for query in queries:
+            result = db.execute(query, execution_options={"yield_per": STREAM_CHUNK_SIZE}).mappings()
+            for row in result:
+                yield row
+    finally:
+        db.close()
+
+def serialize_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+# Streams the rows as NDJSON (one JSON object per line) or CSV
+def stream_export(queries, columns, export_format, filename):
+    def generate_ndjson():
+        for row in iter_rows(queries):
+            yield json.dumps({column: serialize_value(row[column]) for column in columns}, default=str) + "\n"
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in iter_rows(queries):
+            writer.writerow([
+                json.dumps(row[column]) if isinstance(row[column], (dict, list)) else serialize_value(row[column])
+                for column in columns
+            ])
+            # Send the written lines and reuse the buffer
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        yield buffer.getvalue()
+
+    generator = generate_ndjson() if export_format == "ndjson" else generate_csv()
+    return StreamingResponse(
+        generator,
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'},
+    )
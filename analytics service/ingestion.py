@@ -0,0 +1,316 @@
+from models import UserActivity, UserRecentVideos, UserVideoHistory, VideoViewCount, UserCategoryPreference, IngestionDeadLetter
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm import Session
+from database import SessionLocal, upsert_insert
+from recommender import coview_model
+from cache import recommendation_cache
+from rollups import apply_rollups
+from trending import trending_engine
+from sketches import apply_viewer_sketches
+from qoe import apply_playback_events, AGGREGATE_ONLY_EVENT_TYPES
+from catalog import video_catalog
+from collections import Counter, deque
+from datetime import datetime, timezone
+from sqlalchemy.exc import OperationalError, InterfaceError, DisconnectionError, TimeoutError as PoolTimeoutError
+from sqlalchemy import insert
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the ingestion pipeline (can be set via environment variables)
+BUFFER_MAX_SIZE = int(os.getenv("INGEST_BUFFER_MAX_SIZE", "10000"))      # Events kept in memory before rejecting new ones
+BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))                  # Events written to the database in one transaction
+FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))        # Maximum time (in seconds) an event waits in the buffer
+MAX_BATCH_RETRIES = int(os.getenv("INGEST_MAX_BATCH_RETRIES", "5"))      # Failed writes of a batch before it is written event by event
+
+# Number of recently watched videos kept per user
+RECENT_VIDEOS_LIMIT = 3
+
+# Raised when the buffer cannot take more events (the caller should retry later)
+class BufferFullError(Exception):
+    pass
+
+# Errors of the database connection or of concurrent transactions (deadlock, lock timeout): the events are fine,
+# the write is repeated later. Every other error (constraint violation, bad value, ...) is caused by the events.
+def is_transient_error(error):
+    return isinstance(error, (OperationalError, InterfaceError, DisconnectionError, PoolTimeoutError))
+
+# Returns the time of an event as naive UTC
+# Events without a timestamp (or with one in the future) get the time they were received
+def event_timestamp(timestamp, received_at):
+    if timestamp is None:
+        return received_at
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return min(timestamp, received_at)
+
+# In-memory event buffer with a background thread that writes the events in batches
+class EventBuffer:
+    def __init__(self, max_size=BUFFER_MAX_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._events = deque()
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock() # Only one batch is written at a time
+        self._thread = None
+        self._running = False
+        self._failed_writes = 0     # Consecutive failed writes of the batch at the front of the buffer
+        self.dead_lettered = 0      # Events given up since the start
+
+    def __len__(self):
+        return len(self._events)
+
+    # Adds events to the buffer, all or nothing
+    # Raises BufferFullError if they don't fit (backpressure towards the clients)
+    def put(self, events):
+        with self._condition:
+            if len(self._events) + len(events) > self.max_size:
+                raise BufferFullError(f"Ingestion buffer is full ({self.max_size} events)")
+            received_at = datetime.utcnow()
+            for event in events:
+                self._events.append({**event, "timestamp": event_timestamp(event.get("timestamp"), received_at), "received_at": received_at})
+            # Wake up the writer thread early if a full batch is waiting
+            if len(self._events) >= self.batch_size:
+                self._condition.notify()
+
+    # Seconds the oldest buffered event has been waiting to be written (0 if the buffer is empty)
+    def lag_seconds(self):
+        with self._condition:
+            if not self._events:
+                return 0.0
+            received_at = self._events[0]["received_at"]
+        return max(0.0, (datetime.utcnow() - received_at).total_seconds())
+
+    # Writes the buffered events to the database, one batch at a time, returns the number of written events
+    #
+    # A batch that fails with a transient error (see is_transient_error) goes back to the front of the buffer
+    # and is retried on the next flush; while the database is down the buffer fills up and /track answers 503.
+    # A batch that fails with any other error, or MAX_BATCH_RETRIES times in a row, is written event by event,
+    # so a single bad event does not block the others: it is moved to the dead-letter table instead.
+    def flush(self):
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._condition:
+                    batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+                if not batch:
+                    return written
+                if self._failed_writes < MAX_BATCH_RETRIES:
+                    error = self._write(batch)
+                    if error is None:
+                        written += len(batch)
+                        self._failed_writes = 0
+                        continue
+                    self._failed_writes += 1
+                    if is_transient_error(error):
+                        logger.warning("Failed to write event batch, retrying: %s", error, extra={"events": len(batch), "failed_writes": self._failed_writes})
+                        self._requeue(batch)
+                        return written
+                    logger.warning("Failed to write event batch, writing the events one by one: %s", error, extra={"events": len(batch)})
+
+                # Isolate the failing events
+                for position, event in enumerate(batch):
+                    error = self._write([event])
+                    if error is None:
+                        written += 1
+                    elif is_transient_error(error):
+                        # The database is unavailable, keep the rest for the next flush
+                        logger.warning("Failed to write event, retrying: %s", error, extra={"events": len(batch) - position})
+                        self._requeue(batch[position:])
+                        return written
+                    else:
+                        self._dead_letter(event, error)
+                self._failed_writes = 0
+
+    # Writes the events in one transaction, returns the error if it failed
+    # The in-memory state is updated after the commit, outside the error path: the batch is stored by then,
+    # so their errors must not make flush write it again
+    def _write(self, events):
+        db = SessionLocal()
+        try:
+            keyed_plays = process_batch(db, events)
+        except Exception as e:
+            db.rollback()
+            return e
+        finally:
+            db.close()
+        apply_in_memory_updates(keyed_plays)
+        return None
+
+    # Puts events back to the front of the buffer (even above max_size, they were accepted already)
+    def _requeue(self, events):
+        with self._condition:
+            self._events.extendleft(reversed(events))
+
+    # Stores an event that can't be written in the dead-letter table (or in the log if that fails too)
+    def _dead_letter(self, event, error):
+        self.dead_lettered += 1
+        stored = {key: value.isoformat() if isinstance(value, datetime) else value for key, value in event.items()}
+        logger.error("Event could not be written, moved to the dead-letter table: %s", error, extra={"event_type": event.get("event_type"), "username": event.get("username")})
+        db = SessionLocal()
+        try:
+            db.add(IngestionDeadLetter(event=stored, error=str(error)[:2000], failed_at=datetime.utcnow()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Failed to store the dead letter, the event is dropped", extra={"event": repr(stored)})
+        finally:
+            db.close()
+
+    # Background loop: flush on every interval or as soon as a full batch is buffered
+    def _run(self):
+        while self._running:
+            with self._condition:
+                if len(self._events) < self.batch_size:
+                    self._condition.wait(timeout=self.flush_interval)
+            self.flush()
+
+    # Starts the background writer thread
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="event-ingestion", daemon=True)
+        self._thread.start()
+
+    # Stops the background writer thread and writes everything that is still buffered
+    def stop(self):
+        self._running = False
+        with self._condition:
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+
+# Writes one batch of events in a single transaction
+# Returns the plays with a resolved video id, for the in-memory updates (apply_in_memory_updates)
+def process_batch(db: Session, events):
+    # Resolve the videos of the events to their ids (analytics is keyed on video ids, not titles)
+    video_catalog.resolve_events(db, events)
+
+    # 1. Save every event to UserActivity with one bulk insert (player heartbeats are only aggregated)
+    activities = [
+        {
+            "username": event["username"],
+            "event_type": event["event_type"],
+            "activity_metadata": event.get("activity_metadata") or {},
+            "timestamp": event["timestamp"],
+        }
+        for event in events
+        if event["event_type"] not in AGGREGATE_ONLY_EVENT_TYPES
+    ]
+    if activities:
+        db.execute(insert(UserActivity), activities)
+
+    # Only "play-video" events with a video title update the other tables
+    plays = []
+    for event in events:
+        metadata = event.get("activity_metadata") or {}
+        if event["event_type"] == "play-video" and metadata.get("video"):
+            plays.append({
+                "username": event["username"],
+                "video_title": metadata["video"],
+                "video_id": event.get("video_id"),
+                "category": metadata.get("category") or video_catalog.category(event.get("video_id")),
+                "timestamp": event["timestamp"],
+            })
+
+    # Plays of titles that are not videos are only kept in the history
+    keyed_plays = [play for play in plays if play["video_id"] is not None]
+
+    if plays:
+        # 2. Save to UserVideoHistory (all watched videos) with one bulk insert
+        db.execute(insert(UserVideoHistory), plays)
+
+    if keyed_plays:
+        # 3. Update the aggregates once per batch
+        apply_play_aggregates(db, keyed_plays)
+        apply_viewer_sketches(db, keyed_plays)
+
+    # 4. Update the time-bucket rollups of the dashboards
+    apply_rollups(db, events)
+
+    # 5. Update the playback quality aggregates
+    apply_playback_events(db, events)
+
+    # Commit all changes
+    db.commit()
+    return keyed_plays
+
+# Updates the in-memory co-view model, trending scores and recommendation cache with stored plays
+# Every step is independent, a failing one is logged (the plays are already in the database)
+def apply_in_memory_updates(keyed_plays):
+    if not keyed_plays:
+        return
+    try:
+        coview_model.record_plays(keyed_plays)
+    except Exception:
+        logger.exception("Failed to update the co-view model", extra={"plays": len(keyed_plays)})
+    try:
+        trending_engine.record_plays(keyed_plays)
+    except Exception:
+        logger.exception("Failed to update the trending scores", extra={"plays": len(keyed_plays)})
+    try:
+        # Drop the cached recommendations of the players and their co-viewers
+        for username in {play["username"] for play in keyed_plays}:
+            recommendation_cache.invalidate(username, coview_model.watched_videos(username))
+    except Exception:
+        logger.exception("Failed to invalidate the cached recommendations", extra={"plays": len(keyed_plays)})
+
+# Updates view counts, category preferences and recent videos for a batch of plays (with resolved video ids)
+def apply_play_aggregates(db: Session, plays):
+    # Count the plays per video and per (user, category) in memory first
+    video_plays = Counter(play["video_id"] for play in plays)
+    category_plays = Counter((play["username"], play["category"]) for play in plays if play["category"])
+
+    # Increment VideoViewCount with one atomic upsert for all videos in the batch
+    # (rows are sorted so concurrent writers lock them in the same order)
+    stmt = upsert_insert(db, VideoViewCount)
+    stmt = stmt.values([
+        {"video_id": video_id, "view_count": count}
+        for video_id, count in sorted(video_plays.items())
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["video_id"],
+        set_={"view_count": VideoViewCount.view_count + stmt.excluded.view_count},
+    ))
+
+    # Increment UserCategoryPreference with one atomic upsert (conflicts on uq_user_category)
+    if category_plays:
+        stmt = upsert_insert(db, UserCategoryPreference)
+        stmt = stmt.values([
+            {"username": username, "category": category, "view_count": count}
+            for (username, category), count in sorted(category_plays.items())
+        ])
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["username", "category"],
+            set_={"view_count": UserCategoryPreference.view_count + stmt.excluded.view_count},
+        ))
+
+    # Update UserRecentVideos (keep the last 3 videos, plays are applied in arrival order)
+    usernames = list({play["username"] for play in plays})
+    recent_by_user = {
+        row.username: row
+        for row in db.query(UserRecentVideos).filter(UserRecentVideos.username.in_(usernames)).all()
+    }
+    for play in plays:
+        user_recent = recent_by_user.get(play["username"])
+        if not user_recent:
+            # If the user hasnt got any record create a record with the username
+            user_recent = UserRecentVideos(username=play["username"], video_ids=[play["video_id"]])
+            db.add(user_recent)
+            recent_by_user[play["username"]] = user_recent
+            continue
+
+        video_ids = list(user_recent.video_ids or [])
+        if play["video_id"] not in video_ids:
+            video_ids.insert(0, play["video_id"])  # Add new video to the beginning
+            user_recent.video_ids = video_ids[:RECENT_VIDEOS_LIMIT]
+            flag_modified(user_recent, "video_ids")
+
+# Shared buffer used by the API endpoints
+event_buffer = EventBuffer()
@@ -0,0 +1,92 @@
+from sqlalchemy.orm import Session
+from models import SystemMetric
+from database import SessionLocal
+from timing import bucket_key
+from datetime import datetime
+from sqlalchemy import insert
+
+# Percentiles returned by the latency endpoint
+PERCENTILES = (50, 95, 99)
+
+# Stores a batch of latency histograms (one SystemMetric record per window, endpoint and status code)
+def store_metric_batch(db: Session, records):
+    if not records:
+        return
+    db.execute(insert(SystemMetric), [
+        {
+            "service": record["service"],
+            "endpoint": record["endpoint"],
+            "status_code": record["status_code"],
+            "timestamp": record["window_start"],
+            "request_count": record["request_count"],
+            "response_time": record["response_time"],
+            "latency_buckets": record["latency_buckets"],
+        }
+        for record in records
+    ])
+    db.commit()
+
+# Sink of the analytics service's own timing middleware (writes to the database directly)
+def store_own_metrics(records):
+    for record in records:
+        record["window_start"] = datetime.fromisoformat(record["window_start"])
+    db = SessionLocal()
+    try:
+        store_metric_batch(db, records)
+    finally:
+        db.close()
+
+# Returns the latency (ms) below which the given share of the requests fall
+# Linear interpolation inside the bucket, the unbounded last bucket reports its lower bound
+def histogram_percentile(buckets, total, percentile):
+    bounds = sorted(buckets, key=lambda key: float(key))
+    target = total * percentile / 100
+    cumulative = 0
+    lower = 0.0
+    for key in bounds:
+        upper = float(key)
+        count = buckets[key]
+        if cumulative + count >= target:
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (target - cumulative) / count
+        cumulative += count
+        lower = upper
+    return lower
+
+# Merges the histograms of every route in the time window and returns the percentiles per route
+def latency_percentiles(db: Session, start=None, end=None, service=None, endpoint=None):
+    query = db.query(
+        SystemMetric.service, SystemMetric.endpoint, SystemMetric.request_count,
+        SystemMetric.response_time, SystemMetric.latency_buckets,
+    )
+    if start is not None:
+        query = query.filter(SystemMetric.timestamp >= start)
+    if end is not None:
+        query = query.filter(SystemMetric.timestamp < end)
+    if service is not None:
+        query = query.filter(SystemMetric.service == service)
+    if endpoint is not None:
+        query = query.filter(SystemMetric.endpoint == endpoint)
+
+    routes = {}
+    for row in query.yield_per(1000):
+        route = routes.setdefault((row.service, row.endpoint), {"count": 0, "total_ms": 0.0, "buckets": {}})
+        # Older records hold a single request without a histogram
+        count = row.request_count or 1
+        buckets = row.latency_buckets or {bucket_key(row.response_time): 1}
+        route["count"] += count
+        route["total_ms"] += row.response_time * count
+        for key, bucket_count in buckets.items():
+            route["buckets"][key] = route["buckets"].get(key, 0) + bucket_count
+
+    return [
+        {
+            "service": service_name,
+            "endpoint": endpoint_name,
+            "request_count": route["count"],
+            "avg_ms": route["total_ms"] / route["count"],
+            **{f"p{p}_ms": histogram_percentile(route["buckets"], route["count"], p) for p in PERCENTILES},
+        }
+        for (service_name, endpoint_name), route in sorted(routes.items(), key=lambda item: (item[0][0] or "", item[0][1]))
+    ]
@@ -1,19 +1,43 @@
 from models import UserActivity, SystemMetric, UserRecentVideos, UserVideoHistory, VideoViewCount, UserCategoryPreference
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, Depends, Request, HTTPException
-from database import init_db, get_db
+from fastapi import FastAPI, Depends, Request, HTTPException, Query, Response
+from ingestion import event_buffer, BufferFullError, event_timestamp
+from database import init_db, get_db, SessionLocal, engine
+from db_engine import pool_status
+from recommender import coview_model
+from cache import recommendation_cache
+from export import build_queries, fetch_page, stream_export
+from rollups import query_rollups, ACTIVE_USER_GRANULARITIES
+from latency import store_metric_batch, store_own_metrics, latency_percentiles
+from logs import setup_logging
+from timing import setup_timing
+from metrics import setup_metrics, add_gauge
+from partitions import PartitionMaintenance
+from trending import trending_engine, TOP_K
+from sketches import unique_viewers
+from qoe import query_playback_quality, PLAYBACK_EVENT_TYPES
+from catalog import video_catalog
+from progress import progress_tracker
+from parquet_export import parquet_exporter
+from events import event_bus, VIDEO_PUBLISHED, VIDEO_UPDATED
+from graceful import graceful_shutdown
 from sqlalchemy.orm import Session
-from sqlalchemy.orm.attributes import flag_modified
 from sqlalchemy import func
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, List, Literal, Optional
 from time import time
-from collections import defaultdict
+import threading
   
 # Create the FastAPI app instance
 app = FastAPI()
 
+# Structured JSON logging through a background queue, every request gets an id
+setup_logging("analytics-service", app)
+
+# Keeps the monthly partitions of the raw event tables up to date (PostgreSQL only)
+partition_maintenance = PartitionMaintenance(engine)
+
 # Configure CORS (Cross-Origin Resource Sharing)
 app.add_middleware(
     CORSMiddleware,
@@ -28,220 +52,423 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers (e.g., Authorization, Content-Type)
 )
 
+# Measure every request, the histograms of this service are written to the database directly
+recorder = setup_timing(app, "analytics-service", sink=store_own_metrics)
+
+# Expose the request, SQL query and connection pool metrics on /metrics (Prometheus format)
+setup_metrics(app, recorder, engine)
+
+# Ingestion lag: how far the written events are behind the received ones
+add_gauge("analytics_ingestion_lag_seconds", "Age of the oldest event waiting in the ingestion buffer", event_buffer.lag_seconds)
+add_gauge("analytics_ingestion_buffered_events", "Events waiting in the ingestion buffer", lambda: len(event_buffer))
+add_gauge("analytics_ingestion_dead_letters", "Events moved to the dead-letter table since the start", lambda: event_buffer.dead_lettered)
+add_gauge("analytics_progress_pending", "Watch positions waiting to be written", lambda: len(progress_tracker))
+
+# Keep the video catalog up to date with the new and changed videos of the vod management service
+event_bus.subscribe(VIDEO_PUBLISHED, video_catalog.apply_event)
+event_bus.subscribe(VIDEO_UPDATED, video_catalog.apply_event)
+
 # Input model
 class TrackEventRequest(BaseModel):
     username: str
     event_type: str
     activity_metadata: Dict = {}
+    timestamp: Optional[datetime] = None # Time of the event on the client (defaults to the time it is received)
+
+# Playback event sent by the video player (playback-start, playback-heartbeat or playback-end)
+# The counters of heartbeats and end events cover the period since the previous heartbeat
+# They are added to the QoE aggregates, negative values are rejected (422)
+class PlaybackEventRequest(BaseModel):
+    username: str
+    event_type: Literal["playback-start", "playback-heartbeat", "playback-end"]
+    video: str                                                  # Title of the video
+    video_id: Optional[int] = None
+    session_id: Optional[str] = None                            # Identifier of the playback session on the client
+    rendition: Optional[str] = None                             # Current rendition (e.g. "1080p", "720p", "480p", "360p")
+    bitrate_kbps: Optional[float] = Field(None, ge=0)           # Bitrate of the current rendition
+    startup_time_ms: Optional[float] = Field(None, ge=0)        # playback-start: time until the first frame
+    watch_time_ms: float = Field(0, ge=0)                       # Played time in the period
+    stall_count: int = Field(0, ge=0)                           # Number of stalls (rebuffering) in the period
+    stall_duration_ms: float = Field(0, ge=0)                   # Total stall time in the period
+    rendition_switches: int = Field(0, ge=0)                    # Number of quality changes in the period
+    timestamp: Optional[datetime] = None
+
+# Watch-progress heartbeat sent by the video player every few seconds
+class ProgressRequest(BaseModel):
+    username: str
+    video: str                                  # Title of the video
+    video_id: Optional[int] = None
+    position_seconds: float                     # Current playback position
+    duration_seconds: Optional[float] = None    # Length of the video
+    timestamp: Optional[datetime] = None        # Time of the heartbeat on the client
+
+# Latency histogram of one endpoint in one window, sent by the timing middleware of the services
+class SystemMetricBatchItem(BaseModel):
+    service: str
+    endpoint: str
+    status_code: int
+    window_start: datetime
+    request_count: int
+    response_time: float # Average response time in milliseconds
+    latency_buckets: Dict[str, int]
+
+# Resolves the video title of a request to the video id the analytics tables are keyed on
+def resolve_video_id(db: Session, video_title: str):
+    video_id = video_catalog.resolve_titles(db, [video_title]).get(video_title)
+    if video_id is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    return video_id
+
+# Returns the titles and ids of the given videos in the same order (deleted videos are left out)
+def with_titles(db: Session, video_ids):
+    titles = video_catalog.titles(db, video_ids)
+    known = [video_id for video_id in video_ids if video_id in titles]
+    return [titles[video_id] for video_id in known], known
 
 # Initialize database tables at application startup
 @app.on_event("startup")
 def startup():
     init_db() # Creates tables if they don't exist
+    event_bus.start() # Deliver the events published from now on (before the state below is loaded)
+    parquet_exporter.remove_temporary_files() # Unfinished files of an export the previous process could not complete
+
+    # Build the co-view model from the watch history and restore the trending scores before new plays are written
+    db = SessionLocal()
+    try:
+        coview_model.load(db)
+        trending_engine.load(db)
+    finally:
+        db.close()
+
+    event_buffer.start() # Start writing buffered events in the background
+    progress_tracker.start() # Write the coalesced watch positions periodically
+    trending_engine.start() # Save the trending scores periodically
+    partition_maintenance.start() # Create the partitions of the next months and apply the retention
+    parquet_exporter.start() # Export the raw events to Parquet periodically (if PARQUET_EXPORT_INTERVAL is set)
+    graceful_shutdown.install() # SIGTERM: report not-ready first, then stop (see graceful.py)
+
+# Write every buffered event before the application stops
+# A running Parquet export is interrupted first, it is repeated from its watermark after the restart
+@app.on_event("shutdown")
+def shutdown():
+    parquet_exporter.stop()
+    event_buffer.stop()
+    progress_tracker.stop()
+    trending_engine.stop()
+    partition_maintenance.stop()
+    event_bus.stop()
+    engine.dispose() # Close the pooled database connections
 
 # Health check endpoint
 @app.get("/")
 def read_root():
     return {"message": "Analytics Service is up and running!"}
 
-# Endpoint to fetch all user activities
+# Liveness probe: the process is up and able to answer requests
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+# Readiness probe: fails as soon as the pod starts shutting down, so no new events are routed here
+@app.get("/health/ready")
+def readiness(response: Response):
+    ready = not graceful_shutdown.is_draining()
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "buffered_events": len(event_buffer)}
+
+# Connection pool of the service: live checkouts and the time requests wait for a connection
+@app.get("/health/db-pool")
+def db_pool():
+    return pool_status(engine)
+
+# Position of the event bus subscriber in the outbox
+@app.get("/health/event-bus")
+def event_bus_status():
+    return event_bus.status()
+
+# Endpoint to fetch user activities
+# Filters: time range (start <= timestamp < end), event type and username
+# format=json returns one page (use next_cursor to get the next one), ndjson/csv streams every matching row
 @app.get("/analytics/user-activities")
-def get_user_activities(db: Session = Depends(get_db)):
-    # Query all records from the UserActivity table
-    activities = db.query(UserActivity).all()
-    return {"user_activities": activities}
+def get_user_activities(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+    username: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    format: Literal["json", "ndjson", "csv"] = "json",
+    db: Session = Depends(get_db),
+):
+    queries = build_queries(UserActivity, start, end, cursor, event_type=event_type, username=username)
+    if format != "json":
+        columns = [column.name for column in UserActivity.__table__.columns]
+        return stream_export(queries, columns, format, "user_activities")
 
-# Endpoint to fetch all system metrics
+    activities, next_cursor = fetch_page(db, queries, limit)
+    return {"user_activities": activities, "next_cursor": next_cursor}
+
+# Endpoint to fetch system metrics (same paging and export options as user activities)
 @app.get("/analytics/system-metrics")
-def get_system_metrics(db: Session = Depends(get_db)):
-    # Query all records from the SystemMetric table
-    metrics = db.query(SystemMetric).all()
-    return {"system_metrics": metrics}
+def get_system_metrics(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    endpoint: Optional[str] = None,
+    status_code: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    format: Literal["json", "ndjson", "csv"] = "json",
+    db: Session = Depends(get_db),
+):
+    queries = build_queries(SystemMetric, start, end, cursor, endpoint=endpoint, status_code=status_code)
+    if format != "json":
+        columns = [column.name for column in SystemMetric.__table__.columns]
+        return stream_export(queries, columns, format, "system_metrics")
+
+    metrics, next_cursor = fetch_page(db, queries, limit)
+    return {"system_metrics": metrics, "next_cursor": next_cursor}
+
+# Endpoint to start an incremental Parquet export of the raw event tables (runs in the background)
+# The files are written to date partitions under PARQUET_EXPORT_DIR, the next run continues after the watermark
+@app.post("/analytics/export/parquet", status_code=202)
+def start_parquet_export():
+    if parquet_exporter.is_running():
+        raise HTTPException(status_code=409, detail="An export is already running")
+    threading.Thread(target=parquet_exporter.run_once, name="parquet-export-request", daemon=True).start()
+    return {"message": "Parquet export started"}
+
+# Endpoint to fetch the export watermarks and the result of the last run
+@app.get("/analytics/export/parquet")
+def get_parquet_export_status():
+    return parquet_exporter.status()
+
+# Endpoint to store the latency histograms of the services (one request per window instead of one row per request)
+@app.post("/analytics/system-metrics/batch")
+def track_system_metrics(data: List[SystemMetricBatchItem], db: Session = Depends(get_db)):
+    store_metric_batch(db, [item.dict() for item in data])
+    return {"message": "System metrics stored successfully", "count": len(data)}
+
+# Endpoint to fetch p50, p95 and p99 latency per route in a time window
+@app.get("/analytics/latency")
+def get_latency_percentiles(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    service: Optional[str] = None,
+    endpoint: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    return {"routes": latency_percentiles(db, start, end, service, endpoint)}
 
-# Endpoint to fetch all users recently watched videos
+# Endpoint to fetch pre-aggregated dashboard data (e.g. plays per hour, active users per day)
+# The answer comes from the rollup tables, independent of the raw event volume
+@app.get("/analytics/rollups")
+def get_rollups(
+    metric: Literal["events", "plays_by_category", "active_users"],
+    granularity: Literal["minute", "hour", "day"] = "hour",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    dimension: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    if metric == "active_users" and granularity not in ACTIVE_USER_GRANULARITIES:
+        raise HTTPException(status_code=400, detail="Active users are only counted per hour and per day")
+
+    rollups = query_rollups(db, metric, granularity, start, end, dimension)
+    return {
+        "metric": metric,
+        "granularity": granularity,
+        "buckets": [
+            {"bucket_start": rollup.bucket_start, "dimension": rollup.dimension, "count": rollup.count}
+            for rollup in rollups
+        ],
+    }
+
+# Endpoint to fetch all users recently watched videos, with the resume position of each
 @app.get("/recent-videos/{username}")
 def get_recent_videos(username: str, db: Session = Depends(get_db)):
     user_recent = db.query(UserRecentVideos).filter(UserRecentVideos.username == username).first()
     if not user_recent:
-        return {"username": username, "recent_videos": []}
-    return {"username": username, "recent_videos": user_recent.video_titles}
+        return {"username": username, "recent_videos": [], "video_ids": [], "videos": []}
+    titles, video_ids = with_titles(db, user_recent.video_ids)
+    positions = progress_tracker.positions(db, username, video_ids)
+    return {
+        "username": username,
+        "recent_videos": titles,
+        "video_ids": video_ids,
+        "videos": [
+            {
+                "video_id": video_id,
+                "video_title": title,
+                "position_seconds": positions.get(video_id, {}).get("position_seconds", 0),
+                "duration_seconds": positions.get(video_id, {}).get("duration_seconds"),
+            }
+            for video_id, title in zip(video_ids, titles)
+        ],
+    }
+
+# Endpoint to record the playback position of a user (coalesced in memory, written periodically)
+@app.post("/progress")
+def track_progress(data: ProgressRequest, db: Session = Depends(get_db)):
+    if data.position_seconds < 0:
+        raise HTTPException(status_code=400, detail="position_seconds can't be negative")
+    video_id = video_catalog.resolve(db, data.video_id, data.video)
+    if video_id is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    progress_tracker.record(
+        data.username, video_id, data.position_seconds, data.duration_seconds,
+        event_timestamp(data.timestamp, datetime.utcnow()),
+    )
+    return {"message": "Progress tracked successfully"}
+
+# Endpoint to fetch the resume position of a user in a video (0 if the user has not watched it)
+@app.get("/progress/{username}/{video_title}")
+def get_progress(username: str, video_title: str, db: Session = Depends(get_db)):
+    video_id = resolve_video_id(db, video_title)
+    position = progress_tracker.positions(db, username, [video_id]).get(video_id, {})
+    return {
+        "username": username,
+        "video_title": video_title,
+        "video_id": video_id,
+        "position_seconds": position.get("position_seconds", 0),
+        "duration_seconds": position.get("duration_seconds"),
+        "updated_at": position.get("updated_at"),
+    }
+
+# Endpoint to fetch how many progress heartbeats were coalesced
+@app.get("/analytics/progress")
+def get_progress_stats():
+    return progress_tracker.stats()
+
+
+# Playback events only go through /track/playback, where their counters are validated
+def reject_playback_events(events: List[TrackEventRequest]):
+    if any(event.event_type in PLAYBACK_EVENT_TYPES for event in events):
+        raise HTTPException(status_code=422, detail="Playback events are tracked with /track/playback")
 
+# Queues the events in the ingestion buffer, they are written to the database in batches
+def enqueue_events(events: List[Dict]):
+    try:
+        event_buffer.put(events)
+    except BufferFullError as e:
+        # Backpressure: the client should retry after the buffer has been flushed
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
 
 @app.post("/track")
-def track_event(data: TrackEventRequest, db: Session = Depends(get_db)):
-    # Create a new UserActivity record with the provided details
-    activity = UserActivity(
-        username=data.username, # Name of the user who triggered the activity
-        event_type=data.event_type, # Type of activity (e.g., "video_play", "login", etc.)
-        activity_metadata=data.activity_metadata # Optional metadata related to the activity (e.g., video ID or other context)
-    )
-    # Add the new activity record to the database session
-    db.add(activity)
-    # Commit the transaction to save the record in the database
-    db.commit()
-
-    # If the activity type is "play-video", update all relevant tables
-    if data.event_type == "play-video":
-        video_title = data.activity_metadata.get("video", "")
-        video_id = data.activity_metadata.get("video_id")
-        category = data.activity_metadata.get("category")
-        
-        # Only proceed if we have a video title
-        if not video_title:
-            return {"message": "User activity tracked successfully", "warning": "No video title provided"}
-        
-        # 1. Save to UserVideoHistory (all watched videos)
-        history = UserVideoHistory(
-            username=data.username,
-            video_title=video_title,
-            video_id=video_id,
-            category=category
-        )
-        db.add(history)
-        
-        # 2. Update VideoViewCount (increment view count for this video)
-        view_count = db.query(VideoViewCount).filter(VideoViewCount.video_title == video_title).first()
-        if not view_count:
-            view_count = VideoViewCount(
-                video_title=video_title,
-                video_id=video_id,
-                view_count=1
-            )
-            db.add(view_count)
-        else:
-            view_count.view_count += 1
-        
-        # 3. Update UserCategoryPreference (increment category view count for this user)
-        if category:
-            category_pref = db.query(UserCategoryPreference).filter(
-                UserCategoryPreference.username == data.username,
-                UserCategoryPreference.category == category
-            ).first()
-            if not category_pref:
-                category_pref = UserCategoryPreference(
-                    username=data.username,
-                    category=category,
-                    view_count=1
-                )
-                db.add(category_pref)
-            else:
-                category_pref.view_count += 1
-        
-        # 4. Update UserRecentVideos (keep last 3 videos)
-        user_recent = db.query(UserRecentVideos).filter(UserRecentVideos.username == data.username).first()
-        if not user_recent:
-            print("create new record for user")
-            # If the user hasnt got any record create a record with the username
-            user_recent = UserRecentVideos(
-                username=data.username,
-                video_titles=[video_title]
-            )
-            # Add the new activity record to the database session
-            db.add(user_recent)
-        else:
-            print(f"Record already exists for user: {data.username}")
-            print(f"Current video list before update: {user_recent.video_titles}")
-
-            video_titles = user_recent.video_titles or []
-
-            if video_title not in video_titles:
-                print(f"Adding new video: {video_title} to the recently watched list.")
-                video_titles.insert(0, video_title)  # Add new video to the beginning
-                user_recent.video_titles = video_titles[:3]  # Keep only the last 3 videos
-                flag_modified(user_recent, "video_titles")
-            else:
-                print(f"Skipping duplicate video: {video_title}")
-        
-        # Commit all changes
-        db.commit()
-    
+def track_event(data: TrackEventRequest):
+    reject_playback_events([data])
+    # Add the event to the buffer (UserActivity and, for "play-video", all relevant tables are updated by the batch writer)
+    enqueue_events([data.dict()])
+
+    # Only proceed with "play-video" aggregates if we have a video title
+    if data.event_type == "play-video" and not data.activity_metadata.get("video", ""):
+        return {"message": "User activity tracked successfully", "warning": "No video title provided"}
+
     # Return a success message to indicate the event was tracked
     return {"message": "User activity tracked successfully"}
 
+# Endpoint to track playback quality events (one or more heartbeats per request)
+@app.post("/track/playback")
+def track_playback(data: List[PlaybackEventRequest]):
+    enqueue_events([
+        {
+            "username": event.username,
+            "event_type": event.event_type,
+            "activity_metadata": event.dict(exclude={"username", "event_type", "timestamp"}, exclude_none=True),
+            "timestamp": event.timestamp,
+        }
+        for event in data
+    ])
+    return {"message": "Playback events tracked successfully", "count": len(data)}
+
+# Endpoint to track many events with one request
+@app.post("/track/batch")
+def track_events(data: List[TrackEventRequest]):
+    reject_playback_events(data)
+    enqueue_events([event.dict() for event in data])
+    return {"message": "User activities tracked successfully", "count": len(data)}
+
 
 @app.get("/recommendations/{username}")
 def get_recommendations(username: str, db: Session = Depends(get_db)):
     """
     Get video recommendations for a user using co-viewing algorithm with category bias.
     Returns top 3 recommended videos based on what similar users watched.
+    The co-view counts come from the in-memory model, only the category preferences are queried.
     """
-    # 1. Get all videos watched by this user
-    user_history = db.query(UserVideoHistory).filter(
-        UserVideoHistory.username == username
-    ).all()
-    
-    if not user_history:
-        return {"username": username, "recommendations": []}
-    
-    # Get unique video titles watched by this user
-    user_videos = set([h.video_title for h in user_history])
-    
-    # 2. Find similar users (users who watched at least one common video)
-    # Get all users who watched at least one of the user's videos
-    similar_users = db.query(UserVideoHistory.username).filter(
-        UserVideoHistory.video_title.in_(user_videos),
-        UserVideoHistory.username != username
-    ).distinct().all()
-    
-    if not similar_users:
-        return {"username": username, "recommendations": []}
-    
-    similar_usernames = [u[0] for u in similar_users]
-    
-    # 3. Get videos watched by similar users that the current user hasn't watched
-    # Count co-view points for each recommended video
-    video_scores = defaultdict(float)  # video_title -> score
-    
-    for similar_username in similar_usernames:
-        # Get videos watched by this similar user
-        similar_user_history = db.query(UserVideoHistory).filter(
-            UserVideoHistory.username == similar_username
-        ).all()
-        
-        similar_user_videos = set([h.video_title for h in similar_user_history])
-        
-        # Calculate overlap (number of common videos)
-        overlap = len(user_videos.intersection(similar_user_videos))
-        
-        if overlap == 0:
-            continue
-        
-        # For each video that similar user watched but current user didn't
-        for video in similar_user_videos:
-            if video not in user_videos:
-                # Add co-view points based on overlap
-                video_scores[video] += overlap
-    
-    if not video_scores:
-        return {"username": username, "recommendations": []}
-    
-    # 4. Get user's category preferences
+    if not coview_model.has_user(username):
+        return {"username": username, "recommendations": [], "video_ids": []}
+
+    # Answer from the cache if nothing relevant was played since the last computation
+    top_recommendations = recommendation_cache.get_or_compute(
+        username, lambda: compute_recommendations(username, db)
+    )
+
+    # The model works with video ids, the titles are added to the response
+    titles, video_ids = with_titles(db, top_recommendations)
+    return {"username": username, "recommendations": titles, "video_ids": video_ids}
+
+# Computes the recommendations of a user, returns them with the videos they are based on
+def compute_recommendations(username: str, db: Session):
+    # Snapshot of the watched videos before scoring (the cache entry depends on these)
+    watched_videos = coview_model.watched_videos(username)
+
+    # Get user's category preferences
     category_prefs = db.query(UserCategoryPreference).filter(
         UserCategoryPreference.username == username
     ).all()
-    
     category_weights = {pref.category: pref.view_count for pref in category_prefs}
-    
-    # 5. Apply category bias to scores
-    # Get category for each recommended video
-    for video_title in video_scores.keys():
-        # Get category from UserVideoHistory
-        video_history = db.query(UserVideoHistory).filter(
-            UserVideoHistory.video_title == video_title
-        ).first()
-        
-        if video_history and video_history.category:
-            category = video_history.category
-            if category in category_weights:
-                # Add category bias: multiply category weight by a factor
-                category_bias = category_weights[category] * 0.5  # Adjust weight factor as needed
-                video_scores[video_title] += category_bias
-    
-    # 6. Sort by score and get top 3
-    ranked_videos = sorted(video_scores.items(), key=lambda x: x[1], reverse=True)
-    top_recommendations = [video_title for video_title, score in ranked_videos[:3]]
-    
-    return {"username": username, "recommendations": top_recommendations}
+
+    # Score the candidate videos and get top 3
+    return coview_model.recommend(username, category_weights, limit=3), watched_videos
+
+# Endpoint to fetch the hit ratio and recompute latency of the recommendation cache
+@app.get("/analytics/recommendation-cache")
+def get_recommendation_cache_stats():
+    return recommendation_cache.stats()
+
+
+# Endpoint to fetch the currently trending videos (plays weighted by recency), overall or in one category
+# Answered from the in-memory top lists, without touching the database
+@app.get("/trending")
+def get_trending(category: Optional[str] = None, limit: int = Query(10, ge=1, le=TOP_K), db: Session = Depends(get_db)):
+    videos = trending_engine.top(category, limit)
+    titles = video_catalog.titles(db, [video["video_id"] for video in videos])
+    return {
+        "category": category,
+        "videos": [{**video, "video_title": titles[video["video_id"]]} for video in videos if video["video_id"] in titles],
+    }
+
+
+# Endpoint to fetch the approximate number of distinct viewers of a video (per day and in the whole range)
+# Estimated from mergeable HyperLogLog sketches, the response includes the error bounds
+@app.get("/analytics/unique-viewers/{video_title}")
+def get_unique_viewers(
+    video_title: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+):
+    return {"video_title": video_title, **unique_viewers(db, resolve_video_id(db, video_title), start, end)}
+
+
+# Endpoint to fetch playback quality (startup time, rebuffering, bitrate, rendition switches)
+# grouped by rendition, by video, or by both
+@app.get("/analytics/playback-quality")
+def get_playback_quality(
+    group_by: Literal["rendition", "video", "video_rendition"] = "rendition",
+    video_title: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+):
+    video_id = resolve_video_id(db, video_title) if video_title is not None else None
+    results = query_playback_quality(db, group_by, video_id, start, end)
+    if group_by != "rendition":
+        titles = video_catalog.titles(db, [result["video_id"] for result in results])
+        for result in results:
+            result["video_title"] = titles.get(result["video_id"])
+    return {"group_by": group_by, "results": results}
 
 
 @app.get("/video-view-count/{video_title}")
@@ -250,11 +477,12 @@ def get_video_view_count(video_title: str, db: Session = Depends(get_db)):
     Get the view count for a specific video.
     Returns 0 if the video has no views recorded.
     """
+    video_id = video_catalog.resolve_titles(db, [video_title]).get(video_title)
     view_count = db.query(VideoViewCount).filter(
-        VideoViewCount.video_title == video_title
-    ).first()
+        VideoViewCount.video_id == video_id
+    ).first() if video_id is not None else None
     
     if not view_count:
-        return {"video_title": video_title, "view_count": 0}
+        return {"video_title": video_title, "video_id": video_id, "view_count": 0}
     
-    return {"video_title": video_title, "view_count": view_count.view_count}           
\ No newline at end of file
+    return {"video_title": video_title, "video_id": video_id, "view_count": view_count.view_count}           
\ No newline at end of file
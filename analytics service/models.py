@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, JSON, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Float, DateTime, JSON, UniqueConstraint, Index, LargeBinary
 from datetime import datetime
 from database import Base 
 
@@ -21,6 +21,12 @@ class UserActivity(Base):
     # Additional information in JSON format - can be null
     activity_metadata = Column(JSON, nullable=True) 
 
+    # Indexes for time range queries and per-user activity listings (keyset pagination on timestamp, id)
+    __table_args__ = (
+        Index("ix_user_activities_timestamp", "timestamp", "id"),
+        Index("ix_user_activities_username_timestamp", "username", "timestamp"),
+    )
+
 # This class defines the UserRecentVideos table structure in the database
 class UserRecentVideos(Base):
     __tablename__ = "user_recent_videos" # Name of the table in the database
@@ -29,8 +35,8 @@ class UserRecentVideos(Base):
     id = Column(Integer, primary_key=True, index=True)
     # name of the user - must be not null
     username = Column(String, nullable=False)
-    # name of the 3 recently watched videos - must be not null
-    video_titles = Column(JSON, nullable=False)
+    # ids of the 3 recently watched videos (most recent first) - must be not null
+    video_ids = Column(JSON, nullable=False)
 
 # This class defines the SystemMetric table structure in the database
 class SystemMetric(Base):
@@ -42,15 +48,30 @@ class SystemMetric(Base):
     # Name of the backend endpoint - must be not null
     endpoint = Column(String, nullable=False)
     
-    # Response time from the backend endpoint - must be not null
+    # Response time from the backend endpoint (average in milliseconds for aggregated records) - must be not null
     response_time = Column(Float, nullable=False)
     
     # HTTP status code - must be not null
     status_code = Column(Integer, nullable=False)
     
     # Date and time when the endpoint was called - defaults to current UTC time
+    # For aggregated records this is the start of the measurement window
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+    # Name of the service that served the requests - can be null (older records)
+    service = Column(String, nullable=True)
+
+    # Number of requests the record aggregates - can be null (older records: one request)
+    request_count = Column(Integer, nullable=True, default=1)
+
+    # Latency histogram of the window: bucket upper bound in ms ("inf" for the last) -> request count - can be null
+    latency_buckets = Column(JSON, nullable=True)
+
+    # Index for time range queries (keyset pagination on timestamp, id)
+    __table_args__ = (
+        Index("ix_system_metrics_timestamp_id", "timestamp", "id"),
+    )
+
 # This class defines the UserVideoHistory table structure in the database
 class UserVideoHistory(Base):
     __tablename__ = "user_video_history" # Name of the table in the database
@@ -61,11 +82,11 @@ class UserVideoHistory(Base):
     # name of the user - must be not null
     username = Column(String, nullable=False, index=True)
     
-    # title of the video - must be not null
+    # title of the video when it was played - must be not null
     video_title = Column(String, nullable=False)
     
-    # id of the video - can be null if not available
-    video_id = Column(Integer, nullable=True)
+    # id of the video in the vod management service - can be null if the title could not be resolved
+    video_id = Column(Integer, nullable=True, index=True)
     
     # category of the video - can be null
     category = Column(String, nullable=True)
@@ -80,11 +101,8 @@ class VideoViewCount(Base):
     # Unique identifier for each view count record (Primary Key)
     id = Column(Integer, primary_key=True, index=True)
     
-    # title of the video - must be not null, unique
-    video_title = Column(String, nullable=False, unique=True, index=True)
-    
-    # id of the video - can be null if not available
-    video_id = Column(Integer, nullable=True, index=True)
+    # id of the video in the vod management service - must be not null, unique
+    video_id = Column(Integer, nullable=False, unique=True, index=True)
     
     # total number of views for this video - must be not null, defaults to 0
     view_count = Column(Integer, nullable=False, default=0)
@@ -108,4 +126,198 @@ class UserCategoryPreference(Base):
     # Unique constraint on username and category combination
     __table_args__ = (
         UniqueConstraint('username', 'category', name='uq_user_category'),
-    )
\ No newline at end of file
+    )
+
+# This class defines the ActivityRollup table structure in the database
+# Pre-aggregated event counts per time bucket (minute, hour, day), maintained by the ingestion pipeline
+class ActivityRollup(Base):
+    __tablename__ = "activity_rollups" # Name of the table in the database
+
+    # Unique identifier for each rollup record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # Name of the aggregated metric (e.g. "events", "plays_by_category", "active_users") - must be not null
+    metric = Column(String, nullable=False)
+
+    # Size of the time bucket ("minute", "hour" or "day") - must be not null
+    granularity = Column(String, nullable=False)
+
+    # Start of the time bucket - must be not null
+    bucket_start = Column(DateTime, nullable=False)
+
+    # Value the metric is broken down by (event type, category, or "" if none) - must be not null
+    dimension = Column(String, nullable=False, default="")
+
+    # Aggregated count for the bucket - must be not null, defaults to 0
+    count = Column(Integer, nullable=False, default=0)
+
+    # One record per metric, granularity, bucket and dimension (also serves the range queries)
+    __table_args__ = (
+        UniqueConstraint('metric', 'granularity', 'bucket_start', 'dimension', name='uq_activity_rollup'),
+    )
+
+# This class defines the RollupActiveUser table structure in the database
+# Users already counted as active in a time bucket (keeps the active user rollups distinct)
+class RollupActiveUser(Base):
+    __tablename__ = "rollup_active_users" # Name of the table in the database
+
+    # Unique identifier for each record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # Size of the time bucket ("hour" or "day") - must be not null
+    granularity = Column(String, nullable=False)
+
+    # Start of the time bucket - must be not null
+    bucket_start = Column(DateTime, nullable=False)
+
+    # name of the user - must be not null
+    username = Column(String, nullable=False)
+
+    # Unique constraint on the bucket and username combination
+    __table_args__ = (
+        UniqueConstraint('granularity', 'bucket_start', 'username', name='uq_rollup_active_user'),
+    )
+
+# This class defines the TrendingScore table structure in the database
+# Periodic snapshot of the time-decayed trending scores (restored when the service starts)
+class TrendingScore(Base):
+    __tablename__ = "trending_scores" # Name of the table in the database
+
+    # Unique identifier for each score record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # id of the video in the vod management service - must be not null, unique
+    video_id = Column(Integer, nullable=False, unique=True, index=True)
+
+    # category of the video - can be null
+    category = Column(String, nullable=True)
+
+    # Decayed score of the video at updated_at - must be not null
+    score = Column(Float, nullable=False, default=0)
+
+    # Date and time of the snapshot - defaults to current UTC time
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# This class defines the ViewerSketch table structure in the database
+# HyperLogLog sketch of the distinct viewers of a video in one day (approximate unique viewer counts)
+class ViewerSketch(Base):
+    __tablename__ = "viewer_sketches" # Name of the table in the database
+
+    # Unique identifier for each sketch record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # id of the video in the vod management service - must be not null
+    video_id = Column(Integer, nullable=False)
+
+    # Start of the day the sketch belongs to - must be not null
+    bucket_start = Column(DateTime, nullable=False)
+
+    # HyperLogLog registers (one byte per register) - must be not null
+    registers = Column(LargeBinary, nullable=False)
+
+    # One sketch per video and day (also serves the range queries of a video)
+    __table_args__ = (
+        UniqueConstraint('video_id', 'bucket_start', name='uq_viewer_sketch'),
+    )
+
+# This class defines the PlaybackQoeRollup table structure in the database
+# Daily playback quality aggregates per video and rendition, built from the player heartbeats
+class PlaybackQoeRollup(Base):
+    __tablename__ = "playback_qoe_rollups" # Name of the table in the database
+
+    # Unique identifier for each rollup record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # id of the video in the vod management service - must be not null
+    video_id = Column(Integer, nullable=False)
+
+    # Rendition the player was on (e.g. "720p", "" if unknown) - must be not null
+    rendition = Column(String, nullable=False, default="")
+
+    # Start of the day - must be not null
+    bucket_start = Column(DateTime, nullable=False)
+
+    # Number of playback sessions started, and the sum of their startup delays (ms)
+    sessions = Column(Integer, nullable=False, default=0)
+    startup_time_ms = Column(Float, nullable=False, default=0)
+
+    # Number of heartbeats and the total played time they reported (ms)
+    heartbeats = Column(Integer, nullable=False, default=0)
+    watch_time_ms = Column(Float, nullable=False, default=0)
+
+    # Number of stalls (rebuffering events) and their total duration (ms)
+    stall_count = Column(Integer, nullable=False, default=0)
+    stall_duration_ms = Column(Float, nullable=False, default=0)
+
+    # Selected bitrate weighted by the played time (kbps * ms), average bitrate = this / watch_time_ms
+    bitrate_time = Column(Float, nullable=False, default=0)
+
+    # Number of rendition switches (quality changes)
+    rendition_switches = Column(Integer, nullable=False, default=0)
+
+    # One record per video, rendition and day
+    __table_args__ = (
+        UniqueConstraint('video_id', 'rendition', 'bucket_start', name='uq_playback_qoe_rollup'),
+    )
+
+# This class defines the WatchProgress table structure in the database
+# Latest playback position of every user in every video ("continue watching"), written by the progress coalescer
+class WatchProgress(Base):
+    __tablename__ = "watch_progress" # Name of the table in the database
+
+    # Unique identifier for each progress record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # name of the user - must be not null
+    username = Column(String, nullable=False)
+
+    # id of the video in the vod management service - must be not null
+    video_id = Column(Integer, nullable=False)
+
+    # Playback position in seconds - must be not null
+    position_seconds = Column(Float, nullable=False, default=0)
+
+    # Length of the video in seconds as reported by the player - can be null
+    duration_seconds = Column(Float, nullable=True)
+
+    # Date and time of the position (client time of the latest heartbeat) - must be not null
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    # One record per user and video (the unique index also serves the lookups of a user)
+    __table_args__ = (
+        UniqueConstraint('username', 'video_id', name='uq_watch_progress'),
+    )
+
+# This class defines the ExportWatermark table structure in the database
+# Last row of every raw event table that was exported to Parquet (the next export continues after it)
+class ExportWatermark(Base):
+    __tablename__ = "export_watermarks" # Name of the table in the database
+
+    # Unique identifier for each watermark record (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # Name of the exported table - must be not null, unique
+    table_name = Column(String, nullable=False, unique=True)
+
+    # id of the last exported row - must be not null
+    last_id = Column(Integer, nullable=False, default=0)
+
+    # Date and time of the last export - defaults to current UTC time
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# This class defines the IngestionDeadLetter table structure in the database
+# Events the ingestion pipeline could not write (e.g. a value the database rejects), kept for inspection
+class IngestionDeadLetter(Base):
+    __tablename__ = "ingestion_dead_letters" # Name of the table in the database
+
+    # Unique identifier for each dead letter (Primary Key)
+    id = Column(Integer, primary_key=True, index=True)
+
+    # The event as it was buffered (timestamps as ISO strings) - must be not null
+    event = Column(JSON, nullable=False)
+
+    # Error the write of the event failed with - must be not null
+    error = Column(String, nullable=False)
+
+    # Date and time when the event was given up - defaults to current UTC time
+    failed_at = Column(DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,284 @@
+from models import UserActivity, UserVideoHistory, ExportWatermark
+from database import SessionLocal, upsert_insert
+from sqlalchemy import select, func
+from datetime import datetime, date
+from collections import OrderedDict
+import pyarrow.parquet as pq
+import pyarrow as pa
+import threading
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the Parquet export (can be set via environment variables)
+EXPORT_DIR = os.getenv("PARQUET_EXPORT_DIR", "/data/exports")                  # Root directory of the exported files
+EXPORT_INTERVAL = float(os.getenv("PARQUET_EXPORT_INTERVAL", "0"))             # Seconds between export runs (0 = only on request)
+EXPORT_BATCH_SIZE = int(os.getenv("PARQUET_EXPORT_BATCH_SIZE", "50000"))       # Rows read from the cursor and written as one row group
+EXPORT_MAX_OPEN_FILES = int(os.getenv("PARQUET_EXPORT_MAX_OPEN_FILES", "8"))   # Date partitions written at the same time
+
+# Rows without a timestamp are exported to this date (like the default partition of the raw tables)
+UNKNOWN_DATE = date(1970, 1, 1)
+
+# Known activity_metadata keys that get their own typed column
+# Values that can't be converted (and every other key) stay in the metadata_extra JSON column
+METADATA_COLUMNS = {
+    "video": pa.string(),
+    "video_id": pa.int64(),
+    "category": pa.string(),
+    "rendition": pa.string(),
+    "session_id": pa.string(),
+    "bitrate_kbps": pa.float64(),
+    "startup_time_ms": pa.float64(),
+    "watch_time_ms": pa.float64(),
+    "stall_count": pa.int64(),
+    "stall_duration_ms": pa.float64(),
+    "rendition_switches": pa.int64(),
+    "level": pa.int64(),
+    "height": pa.int64(),
+    "bitrate": pa.float64(),
+}
+
+# Python conversion of the typed metadata columns
+CONVERTERS = {pa.string(): str, pa.int64(): int, pa.float64(): float}
+
+ACTIVITY_SCHEMA = pa.schema(
+    [("id", pa.int64()), ("username", pa.string()), ("event_type", pa.string()), ("timestamp", pa.timestamp("us"))]
+    + [(f"metadata_{key}", column_type) for key, column_type in METADATA_COLUMNS.items()]
+    + [("metadata_extra", pa.string())]
+)
+
+HISTORY_SCHEMA = pa.schema([
+    ("id", pa.int64()), ("username", pa.string()), ("video_title", pa.string()), ("video_id", pa.int64()),
+    ("category", pa.string()), ("timestamp", pa.timestamp("us")),
+])
+
+# Converts a metadata value to the type of its column, returns (True, value) on success
+def convert_metadata_value(value, column_type):
+    if value is None:
+        return True, None
+    # bool is an int in Python, but a flag is not a number
+    if isinstance(value, (dict, list, bool)):
+        return False, None
+    try:
+        converted = CONVERTERS[column_type](value)
+    except (TypeError, ValueError):
+        return False, None
+    if column_type == pa.int64() and isinstance(value, float) and not value.is_integer():
+        return False, None
+    return True, converted
+
+# Flattens a user activity row: typed columns for the known metadata keys, JSON for the rest
+def flatten_activity(row):
+    metadata = row.activity_metadata or {}
+    record = {"id": row.id, "username": row.username, "event_type": row.event_type, "timestamp": row.timestamp}
+    extra = {}
+    for key, value in metadata.items():
+        column_type = METADATA_COLUMNS.get(key)
+        converted = convert_metadata_value(value, column_type) if column_type is not None else (False, None)
+        if converted[0]:
+            record[f"metadata_{key}"] = converted[1]
+        else:
+            extra[key] = value
+    record["metadata_extra"] = json.dumps(extra, default=str) if extra else None
+    return record
+
+def history_record(row):
+    return {
+        "id": row.id, "username": row.username, "video_title": row.video_title,
+        "video_id": row.video_id, "category": row.category, "timestamp": row.timestamp,
+    }
+
+# Exported tables: model, Parquet schema and the function that turns a row into a record
+EXPORTED_TABLES = {
+    "user_activities": (UserActivity, ACTIVITY_SCHEMA, flatten_activity),
+    "user_video_history": (UserVideoHistory, HISTORY_SCHEMA, history_record),
+}
+
+# Writes the rows of one export run into date partitions: <root>/<table>/date=YYYY-MM-DD/part-<first id>-<n>.parquet
+# Files are written under a temporary name and renamed when they are complete.
+# The names only depend on where the run started, so a run repeated after a failure replaces its files.
+class PartitionedParquetWriter:
+    def __init__(self, root, table_name, schema, first_id, max_open_files=EXPORT_MAX_OPEN_FILES):
+        self.directory = os.path.join(root, table_name)
+        self.schema = schema
+        self.first_id = first_id
+        self.max_open_files = max_open_files
+        self._writers = OrderedDict()   # date -> (ParquetWriter, temporary path, final path), least recently used first
+        self._file_counts = {}          # date -> number of files started in this run
+        self.files = []
+
+    def _open(self, day):
+        number = self._file_counts.get(day, 0)
+        self._file_counts[day] = number + 1
+        directory = os.path.join(self.directory, f"date={day.isoformat()}")
+        os.makedirs(directory, exist_ok=True)
+        prefix = f"part-{self.first_id:012d}-"
+        if number == 0:
+            # Files left by an earlier attempt of the same run are replaced
+            for name in os.listdir(directory):
+                if name.startswith(prefix):
+                    os.remove(os.path.join(directory, name))
+        path = os.path.join(directory, f"{prefix}{number}.parquet")
+        writer = pq.ParquetWriter(f"{path}.tmp", self.schema, compression="zstd")
+        self._writers[day] = (writer, f"{path}.tmp", path)
+        # Only a few files are open at the same time, the least recently used one is completed
+        if len(self._writers) > self.max_open_files:
+            self._close(next(iter(self._writers)))
+
+    def _close(self, day):
+        writer, temporary_path, path = self._writers.pop(day)
+        writer.close()
+        os.replace(temporary_path, path)
+        self.files.append(path)
+
+    # Writes a batch of records, one row group per date
+    def write(self, records):
+        by_day = {}
+        for record in records:
+            day = record["timestamp"].date() if record["timestamp"] is not None else UNKNOWN_DATE
+            by_day.setdefault(day, []).append(record)
+        for day, day_records in sorted(by_day.items()):
+            if day not in self._writers:
+                self._open(day)
+            self._writers.move_to_end(day)
+            self._writers[day][0].write_table(pa.Table.from_pylist(day_records, schema=self.schema))
+
+    def close(self):
+        for day in list(self._writers):
+            self._close(day)
+
+    # Removes the unfinished files after a failed run
+    def abort(self):
+        for writer, temporary_path, _ in self._writers.values():
+            writer.close()
+            os.remove(temporary_path)
+        self._writers.clear()
+
+# Raised inside a run when the service stops, the run is continued from the watermark by the next one
+class ExportInterrupted(Exception):
+    pass
+
+# Incremental export of the raw event tables to Parquet
+#
+# Every table has a watermark (the last exported id) in export_watermarks. A run exports the rows after
+# the watermark up to the highest id at its start, streaming them from a server-side cursor, and moves
+# the watermark only when every file is complete. A shutdown interrupts the run between two batches:
+# its unfinished files are removed and the watermark stays, so the next run exports the same rows. Ids follow the insert order because a single
+# ingestion writer inserts the events (one analytics replica).
+class ParquetExporter:
+    def __init__(self, root=EXPORT_DIR, batch_size=EXPORT_BATCH_SIZE, interval=EXPORT_INTERVAL):
+        self.root = root
+        self.batch_size = batch_size
+        self.interval = interval
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+
+    def export_table(self, table_name):
+        model, schema, to_record = EXPORTED_TABLES[table_name]
+        db = SessionLocal()
+        try:
+            watermark = db.query(ExportWatermark).filter(ExportWatermark.table_name == table_name).first()
+            last_id = watermark.last_id if watermark is not None else 0
+            upper_id = db.query(func.max(model.id)).scalar() or 0
+            if upper_id <= last_id:
+                return {"table": table_name, "rows": 0, "files": []}
+
+            writer = PartitionedParquetWriter(self.root, table_name, schema, last_id + 1)
+            rows = 0
+            query = select(*model.__table__.columns).where(model.id > last_id, model.id <= upper_id).order_by(model.id)
+            try:
+                # Only one batch of rows is in memory at a time
+                for partition in db.execute(query.execution_options(yield_per=self.batch_size)).partitions():
+                    if self._stop.is_set():
+                        raise ExportInterrupted(f"Export of {table_name} interrupted by the shutdown")
+                    writer.write([to_record(row) for row in partition])
+                    rows += len(partition)
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+
+            stmt = upsert_insert(db, ExportWatermark).values(
+                table_name=table_name, last_id=upper_id, updated_at=datetime.utcnow()
+            )
+            db.execute(stmt.on_conflict_do_update(
+                index_elements=["table_name"],
+                set_={"last_id": stmt.excluded.last_id, "updated_at": stmt.excluded.updated_at},
+            ))
+            db.commit()
+            return {"table": table_name, "rows": rows, "files": writer.files}
+        finally:
+            db.close()
+
+    # Exports every table once, returns None if a run is already in progress
+    def run_once(self):
+        if not self._run_lock.acquire(blocking=False):
+            return None
+        try:
+            started_at = datetime.utcnow()
+            results = []
+            for table_name in EXPORTED_TABLES:
+                try:
+                    results.append(self.export_table(table_name))
+                except ExportInterrupted as e:
+                    logger.info(str(e))
+                    results.append({"table": table_name, "interrupted": True})
+                    break
+                except Exception as e:
+                    logger.exception("Parquet export of %s failed", table_name)
+                    results.append({"table": table_name, "error": str(e)})
+            self.last_run = {"started_at": started_at, "finished_at": datetime.utcnow(), "tables": results}
+            return self.last_run
+        finally:
+            self._run_lock.release()
+
+    def is_running(self):
+        return self._run_lock.locked()
+
+    # Returns the watermarks and the result of the last run
+    def status(self):
+        db = SessionLocal()
+        try:
+            watermarks = {row.table_name: {"last_id": row.last_id, "updated_at": row.updated_at} for row in db.query(ExportWatermark).all()}
+        finally:
+            db.close()
+        return {"running": self.is_running(), "watermarks": watermarks, "last_run": self.last_run}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    # Starts the periodic export (only if an interval is set)
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="parquet-export", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        # Wait for a run started by a request, it stops after its current batch
+        if self._run_lock.acquire(timeout=timeout):
+            self._run_lock.release()
+
+    # Removes the temporary files of runs that were killed before they could clean up
+    def remove_temporary_files(self):
+        removed = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".parquet.tmp"):
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+        if removed:
+            logger.warning("Removed unfinished Parquet files of an interrupted export", extra={"files": removed})
+
+# Shared exporter used by the API endpoints
+parquet_exporter = ParquetExporter()
@@ -0,0 +1,254 @@
+from sqlalchemy import MetaData, Table, Index, inspect, select, text
+from models import ActivityRollup, RollupActiveUser, ExportWatermark
+from qoe import AGGREGATE_ONLY_EVENT_TYPES
+from datetime import datetime
+from database import Base
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the partitioning and retention (can be set via environment variables)
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))                       # Partitions created in advance
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "0"))                                   # Raw months kept (0 = keep everything)
+RETENTION_MODE = os.getenv("RETENTION_MODE", "detach")                                       # "detach" (archive) or "drop"
+RETENTION_REQUIRE_EXPORT = os.getenv("RETENTION_REQUIRE_EXPORT", "true").lower() == "true"   # Only retire months exported to Parquet
+MIGRATE_EXISTING = os.getenv("PARTITION_MIGRATE_EXISTING", "false").lower() == "true"        # Convert existing plain tables
+MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "21600"))           # Seconds between maintenance runs
+
+# Raw event tables partitioned by month on their timestamp column (PostgreSQL only)
+PARTITIONED_TABLES = ("user_activities", "user_video_history")
+
+# Tables whose months are retired by the retention, once the rollups are compacted from them
+# user_video_history is kept: the co-view model of the recommendations is rebuilt from the whole history at startup
+RETIRED_TABLES = ("user_activities",)
+
+# Records which monthly partitions were already compacted into the rollups
+COMPACTIONS_TABLE = "partition_compactions"
+
+# Returns the first day of the month, shifted by the given number of months
+def month_start(day: datetime, shift=0):
+    month_index = day.year * 12 + day.month - 1 + shift
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def partition_name(table_name, start: datetime):
+    return f"{table_name}_p{start:%Y%m}"
+
+# Returns a copy of the model's table that is partitioned by range on timestamp
+# (the partition key has to be part of the primary key)
+def partitioned_definition(table):
+    columns = []
+    for column in table.columns:
+        copy = column._copy()
+        copy.index = None  # Indexes are added below from table.indexes
+        copy.unique = None
+        if copy.name == "id":
+            copy.autoincrement = True
+        if copy.name == "timestamp":
+            copy.primary_key = True
+            copy.nullable = False
+        columns.append(copy)
+    partitioned = Table(table.name, MetaData(), *columns, postgresql_partition_by='RANGE ("timestamp")')
+    for index in table.indexes:
+        Index(index.name, *[partitioned.c[column.name] for column in index.columns])
+    return partitioned
+
+def is_partitioned(connection, table_name):
+    return connection.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name)"), {"name": table_name}
+    ).first() is not None
+
+# Creates the monthly partitions from the given month until PARTITION_MONTHS_AHEAD months after now
+def ensure_partitions(connection, table_name, first_month=None):
+    current = month_start(first_month or datetime.utcnow())
+    last = month_start(datetime.utcnow(), PARTITION_MONTHS_AHEAD)
+    while current <= last:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {partition_name(table_name, current)} PARTITION OF {table_name} '
+            f"FOR VALUES FROM ('{current:%Y-%m-%d}') TO ('{month_start(current, 1):%Y-%m-%d}')"
+        ))
+        current = month_start(current, 1)
+    # Rows outside every monthly partition are kept in the default partition
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT"))
+
+# Converts an existing plain table into a partitioned one and moves its rows (runs in one transaction)
+def migrate_to_partitioned(connection, table):
+    legacy = f"{table.name}_legacy"
+    logger.info("Converting %s to a partitioned table", table.name)
+    connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {legacy}"))
+    # Index names are global, free them for the new table
+    for index in table.indexes:
+        connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    connection.execute(text(f"ALTER TABLE {legacy} DROP CONSTRAINT IF EXISTS {table.name}_pkey"))
+
+    partitioned_definition(table).create(connection)
+    first = connection.execute(text(f'SELECT min("timestamp") FROM {legacy}')).scalar()
+    ensure_partitions(connection, table.name, first)
+
+    # The partition key can't be null: rows without a timestamp go to the default partition as 1970-01-01
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    values = ", ".join(
+        f"COALESCE(\"{column.name}\", TIMESTAMP '1970-01-01')" if column.name == "timestamp" else f'"{column.name}"'
+        for column in table.columns
+    )
+    connection.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {values} FROM {legacy}"))
+    # Continue the ids where the old table stopped
+    connection.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE((SELECT max(id) FROM {table.name}), 0) + 1, false)"
+    ))
+    connection.execute(text(f"DROP TABLE {legacy}"))
+
+# Creates the partitioned tables (before create_all, so it skips them) and the partitions of the next months
+def setup_partitioning(engine):
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {COMPACTIONS_TABLE} ("
+            "table_name VARCHAR NOT NULL, partition_name VARCHAR NOT NULL, month_start TIMESTAMP NOT NULL, "
+            "compacted_at TIMESTAMP NOT NULL, retired_at TIMESTAMP, PRIMARY KEY (table_name, partition_name))"
+        ))
+        for table_name in PARTITIONED_TABLES:
+            table = Base.metadata.tables[table_name]
+            if not inspect(connection).has_table(table_name):
+                partitioned_definition(table).create(connection)
+            elif not is_partitioned(connection, table_name):
+                if not MIGRATE_EXISTING:
+                    logger.warning("%s is not partitioned, set PARTITION_MIGRATE_EXISTING=true to convert it", table_name)
+                    continue
+                migrate_to_partitioned(connection, table)
+            ensure_partitions(connection, table_name)
+
+# Recomputes the rollups of a month from the raw events, so the raw partition can be removed
+# The incremental rollups already hold this data, rebuilding also covers events older than the rollups.
+# Aggregate-only events (player heartbeats) have no raw rows, so what they added is kept: their "events"
+# rows are not rebuilt, and their users still count as active through the distinct user markers.
+def compact_month(connection, start: datetime):
+    end = month_start(start, 1)
+    params = {"start": start, "end": end, "aggregate_only": list(AGGREGATE_ONLY_EVENT_TYPES)}
+    rollups = ActivityRollup.__tablename__
+    markers = RollupActiveUser.__tablename__
+    connection.execute(text(
+        f"DELETE FROM {rollups} WHERE bucket_start >= :start AND bucket_start < :end "
+        "AND NOT (metric = 'events' AND dimension = ANY(:aggregate_only))"
+    ), params)
+    for granularity in ("minute", "hour", "day"):
+        bucket = f"date_trunc('{granularity}', \"timestamp\")"
+        connection.execute(text(
+            f"INSERT INTO {rollups} (metric, granularity, bucket_start, dimension, count) "
+            f"SELECT 'events', '{granularity}', {bucket}, event_type, count(*) FROM user_activities "
+            f'WHERE "timestamp" >= :start AND "timestamp" < :end AND event_type <> ALL(:aggregate_only) '
+            f"GROUP BY {bucket}, event_type"
+        ), params)
+        connection.execute(text(
+            f"INSERT INTO {rollups} (metric, granularity, bucket_start, dimension, count) "
+            f"SELECT 'plays_by_category', '{granularity}', {bucket}, activity_metadata->>'category', count(*) "
+            f"FROM user_activities WHERE \"timestamp\" >= :start AND \"timestamp\" < :end "
+            f"AND event_type = 'play-video' AND COALESCE(activity_metadata->>'category', '') <> '' "
+            f"GROUP BY {bucket}, activity_metadata->>'category'"
+        ), params)
+        if granularity != "minute":
+            # Users of the raw events plus the users the markers registered (also the heartbeat-only ones)
+            connection.execute(text(
+                f"INSERT INTO {rollups} (metric, granularity, bucket_start, dimension, count) "
+                f"SELECT 'active_users', '{granularity}', bucket_start, '', count(DISTINCT username) FROM ("
+                f'SELECT {bucket} AS bucket_start, username FROM user_activities WHERE "timestamp" >= :start AND "timestamp" < :end '
+                f"UNION SELECT bucket_start, username FROM {markers} "
+                f"WHERE granularity = '{granularity}' AND bucket_start >= :start AND bucket_start < :end"
+                ") AS active GROUP BY bucket_start"
+            ), params)
+    # The distinct user markers are only needed while events of the month can still arrive
+    connection.execute(text(
+        f"DELETE FROM {markers} WHERE bucket_start >= :start AND bucket_start < :end"
+    ), params)
+
+# Returns True if the Parquet export is past every row of the partition (the watermark is the last exported id)
+def is_exported(connection, table_name, partition):
+    last_id = connection.execute(
+        select(ExportWatermark.last_id).where(ExportWatermark.table_name == table_name)
+    ).scalar() or 0
+    return connection.execute(text(f"SELECT 1 FROM {partition} WHERE id > :last_id LIMIT 1"), {"last_id": last_id}).first() is None
+
+# Detaches (archives) or drops the raw partitions older than RETENTION_MONTHS, after compacting them
+# With RETENTION_REQUIRE_EXPORT a month is kept until the Parquet export has passed all of its rows
+def apply_retention(engine):
+    if engine.dialect.name != "postgresql" or RETENTION_MONTHS <= 0:
+        return
+    cutoff = month_start(datetime.utcnow(), -RETENTION_MONTHS)
+    with engine.begin() as connection:
+        if not is_partitioned(connection, "user_activities"):
+            return
+        partitions = connection.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass('user_activities')"
+        )).scalars().all()
+
+    for name in sorted(partitions):
+        suffix = name.rsplit("_p", 1)[-1]
+        if not suffix.isdigit() or len(suffix) != 6:
+            continue # Default partition
+        start = datetime(int(suffix[:4]), int(suffix[4:]), 1)
+        if start >= cutoff:
+            continue
+
+        # Every month is handled in its own transaction: compact first, then remove the raw partitions
+        with engine.begin() as connection:
+            retired = {
+                table_name: partition_name(table_name, start) for table_name in RETIRED_TABLES
+                if inspect(connection).has_table(partition_name(table_name, start))
+            }
+            if RETENTION_REQUIRE_EXPORT:
+                unexported = [table_name for table_name, partition in retired.items() if not is_exported(connection, table_name, partition)]
+                if unexported:
+                    logger.warning("Raw partitions of %s are not exported to Parquet yet, they are kept", f"{start:%Y-%m}", extra={"tables": unexported})
+                    continue
+            compact_month(connection, start)
+            for table_name, partition in retired.items():
+                connection.execute(text(f"ALTER TABLE {table_name} DETACH PARTITION {partition}"))
+                if RETENTION_MODE == "drop":
+                    connection.execute(text(f"DROP TABLE {partition}"))
+                connection.execute(text(
+                    f"INSERT INTO {COMPACTIONS_TABLE} (table_name, partition_name, month_start, compacted_at, retired_at) "
+                    "VALUES (:table_name, :partition, :start, :now, :now) "
+                    "ON CONFLICT (table_name, partition_name) DO UPDATE SET compacted_at = :now, retired_at = :now"
+                ), {"table_name": table_name, "partition": partition, "start": start, "now": datetime.utcnow()})
+            logger.info("Retired raw partitions of %s", f"{start:%Y-%m}", extra={"retention_mode": RETENTION_MODE})
+
+# Background thread that keeps creating the partitions of the next months and applies the retention
+class PartitionMaintenance:
+    def __init__(self, engine, interval=MAINTENANCE_INTERVAL):
+        self.engine = engine
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        try:
+            with self.engine.begin() as connection:
+                for table_name in PARTITIONED_TABLES:
+                    if is_partitioned(connection, table_name):
+                        ensure_partitions(connection, table_name)
+            apply_retention(self.engine)
+        except Exception as e:
+            logger.exception("Partition maintenance failed")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        if self.engine.dialect.name != "postgresql" or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="partition-maintenance", daemon=True)
+        self._thread.start()
+        # First run in the background thread as well, so startup is not delayed
+        threading.Thread(target=self.run_once, name="partition-maintenance-first-run", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
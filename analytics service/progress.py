@@ -0,0 +1,171 @@
+from database import SessionLocal, upsert_insert
+from sqlalchemy.orm import Session
+from models import WatchProgress
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the progress tracking (can be set via environment variables)
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "10"))     # Seconds between writes of the coalesced positions
+PROGRESS_MAX_PENDING = int(os.getenv("PROGRESS_MAX_PENDING", "50000"))          # Pending (user, video) pairs that trigger an early write
+
+# Records written with one upsert statement
+UPSERT_CHUNK_SIZE = 1000
+
+# Coalesces the watch-progress heartbeats of the players in memory
+#
+# Only the latest position of every (user, video) pair is kept, and the pairs are written to
+# WatchProgress with one upsert per interval, so a heartbeat every few seconds costs no database write.
+class ProgressTracker:
+    def __init__(self, flush_interval=PROGRESS_FLUSH_INTERVAL, max_pending=PROGRESS_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}              # username -> {video_id: latest position record}
+        self._pending_size = 0
+        self._writing = {}              # Records of the write in progress (still visible to the readers)
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock() # Only one write at a time
+        self._thread = None
+        self._running = False
+
+        # Metrics
+        self.received = 0
+        self.written = 0
+
+    def __len__(self):
+        return self._pending_size
+
+    # Records a position, older heartbeats (by client time) than the pending one are ignored
+    def record(self, username, video_id, position_seconds, duration_seconds, updated_at):
+        with self._condition:
+            self.received += 1
+            user_pending = self._pending.setdefault(username, {})
+            current = user_pending.get(video_id)
+            if current is not None and current["updated_at"] > updated_at:
+                return
+            if current is None:
+                self._pending_size += 1
+            user_pending[video_id] = {
+                "username": username,
+                "video_id": video_id,
+                "position_seconds": position_seconds,
+                "duration_seconds": duration_seconds if duration_seconds is not None else (current or {}).get("duration_seconds"),
+                "updated_at": updated_at,
+            }
+            # Wake up the writer thread early if too many pairs are waiting
+            if self._pending_size >= self.max_pending:
+                self._condition.notify()
+
+    # Writes the pending positions with one upsert, returns the number of written records
+    def flush(self):
+        with self._flush_lock:
+            with self._condition:
+                pending = self._writing = self._pending
+                self._pending, self._pending_size = {}, 0
+            # Rows are sorted so concurrent writers lock them in the same order
+            records = [
+                user_pending[video_id]
+                for username, user_pending in sorted(pending.items())
+                for video_id in sorted(user_pending)
+            ]
+            if not records:
+                return 0
+            db = SessionLocal()
+            try:
+                for start in range(0, len(records), UPSERT_CHUNK_SIZE):
+                    stmt = upsert_insert(db, WatchProgress).values(records[start:start + UPSERT_CHUNK_SIZE])
+                    db.execute(stmt.on_conflict_do_update(
+                        index_elements=["username", "video_id"],
+                        set_={
+                            "position_seconds": stmt.excluded.position_seconds,
+                            "duration_seconds": stmt.excluded.duration_seconds,
+                            "updated_at": stmt.excluded.updated_at,
+                        },
+                        # A stored position newer than the coalesced one is kept
+                        where=WatchProgress.updated_at <= stmt.excluded.updated_at,
+                    ))
+                db.commit()
+                self.written += len(records)
+                return len(records)
+            except Exception as e:
+                # Put the positions back unless a newer heartbeat arrived in the meantime
+                db.rollback()
+                with self._condition:
+                    for record in records:
+                        user_pending = self._pending.setdefault(record["username"], {})
+                        current = user_pending.get(record["video_id"])
+                        if current is None:
+                            self._pending_size += 1
+                        if current is None or current["updated_at"] < record["updated_at"]:
+                            user_pending[record["video_id"]] = record
+                logger.exception("Failed to write watch progress", extra={"records": len(records)})
+                return 0
+            finally:
+                db.close()
+                with self._condition:
+                    self._writing = {}
+
+    # Returns the positions of a user (optionally only for the given videos): stored ones overlaid with the pending ones
+    def positions(self, db: Session, username, video_ids=None):
+        query = db.query(WatchProgress).filter(WatchProgress.username == username)
+        if video_ids is not None:
+            if not video_ids:
+                return {}
+            query = query.filter(WatchProgress.video_id.in_(video_ids))
+        positions = {
+            row.video_id: {
+                "position_seconds": row.position_seconds,
+                "duration_seconds": row.duration_seconds,
+                "updated_at": row.updated_at,
+            }
+            for row in query.all()
+        }
+        with self._condition:
+            unwritten = list(self._writing.get(username, {}).items()) + list(self._pending.get(username, {}).items())
+            for video_id, record in unwritten:
+                if video_ids is not None and video_id not in video_ids:
+                    continue
+                stored = positions.get(video_id)
+                if stored is None or stored["updated_at"] <= record["updated_at"]:
+                    positions[video_id] = {key: record[key] for key in ("position_seconds", "duration_seconds", "updated_at")}
+        return positions
+
+    def stats(self):
+        return {
+            "pending": self._pending_size,
+            "received": self.received,
+            "written": self.written,
+            # Share of the heartbeats that did not need their own database write
+            "coalescing_ratio": 1 - self.written / self.received if self.received else None,
+        }
+
+    # Background loop: write on every interval or as soon as too many pairs are pending
+    def _run(self):
+        while self._running:
+            with self._condition:
+                if self._pending_size < self.max_pending:
+                    self._condition.wait(timeout=self.flush_interval)
+            self.flush()
+
+    # Starts the background writer thread
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="progress-flush", daemon=True)
+        self._thread.start()
+
+    # Stops the background writer thread and writes the pending positions
+    def stop(self):
+        self._running = False
+        with self._condition:
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+
+# Shared tracker used by the API endpoints
+progress_tracker = ProgressTracker()
@@ -0,0 +1,95 @@
+from models import PlaybackQoeRollup
+from database import upsert_insert
+from sqlalchemy.orm import Session
+from rollups import bucket_start
+from sqlalchemy import func
+
+# Playback event types sent by the video player
+# - playback-start: the first frame was shown (startup_time_ms is the delay since the user pressed play)
+# - playback-heartbeat: sent periodically while playing, with the counters since the previous heartbeat
+# - playback-end: the session ended (same counters as a heartbeat, for the last period)
+PLAYBACK_START = "playback-start"
+PLAYBACK_HEARTBEAT = "playback-heartbeat"
+PLAYBACK_END = "playback-end"
+PLAYBACK_EVENT_TYPES = (PLAYBACK_START, PLAYBACK_HEARTBEAT, PLAYBACK_END)
+
+# Heartbeats are only aggregated, the raw rows are not kept in user_activities
+AGGREGATE_ONLY_EVENT_TYPES = (PLAYBACK_HEARTBEAT,)
+
+# Counters summed into the rollup records
+COUNTERS = (
+    "sessions", "startup_time_ms", "heartbeats", "watch_time_ms",
+    "stall_count", "stall_duration_ms", "bitrate_time", "rendition_switches",
+)
+
+# Adds the playback events of a batch (with resolved video ids) to the daily QoE rollups with one upsert
+def apply_playback_events(db: Session, events):
+    totals = {}
+    for event in events:
+        if event["event_type"] not in PLAYBACK_EVENT_TYPES:
+            continue
+        metadata = event.get("activity_metadata") or {}
+        if event.get("video_id") is None:
+            continue # Not a known video
+        key = (event["video_id"], metadata.get("rendition") or "", bucket_start(event["timestamp"], "day"))
+        counters = totals.setdefault(key, dict.fromkeys(COUNTERS, 0))
+
+        if event["event_type"] == PLAYBACK_START:
+            counters["sessions"] += 1
+            counters["startup_time_ms"] += metadata.get("startup_time_ms") or 0
+        else:
+            watch_time = metadata.get("watch_time_ms") or 0
+            counters["heartbeats"] += 1
+            counters["watch_time_ms"] += watch_time
+            counters["stall_count"] += metadata.get("stall_count") or 0
+            counters["stall_duration_ms"] += metadata.get("stall_duration_ms") or 0
+            counters["bitrate_time"] += (metadata.get("bitrate_kbps") or 0) * watch_time
+            counters["rendition_switches"] += metadata.get("rendition_switches") or 0
+
+    if not totals:
+        return
+    stmt = upsert_insert(db, PlaybackQoeRollup)
+    stmt = stmt.values([
+        {"video_id": video_id, "rendition": rendition, "bucket_start": start, **counters}
+        for (video_id, rendition, start), counters in sorted(totals.items())
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["video_id", "rendition", "bucket_start"],
+        set_={counter: getattr(PlaybackQoeRollup, counter) + getattr(stmt.excluded, counter) for counter in COUNTERS},
+    ))
+
+# Returns the QoE metrics grouped by rendition, by video, or by both, in the given time range
+# The results of the video groupings hold the video id, the titles are added by the caller
+def query_playback_quality(db: Session, group_by="rendition", video_id=None, start=None, end=None):
+    group_columns = {
+        "rendition": [PlaybackQoeRollup.rendition],
+        "video": [PlaybackQoeRollup.video_id],
+        "video_rendition": [PlaybackQoeRollup.video_id, PlaybackQoeRollup.rendition],
+    }[group_by]
+    query = db.query(
+        *group_columns,
+        *[func.sum(getattr(PlaybackQoeRollup, counter)).label(counter) for counter in COUNTERS],
+    )
+    if video_id is not None:
+        query = query.filter(PlaybackQoeRollup.video_id == video_id)
+    if start is not None:
+        query = query.filter(PlaybackQoeRollup.bucket_start >= bucket_start(start, "day"))
+    if end is not None:
+        query = query.filter(PlaybackQoeRollup.bucket_start < end)
+
+    results = []
+    for row in query.group_by(*group_columns).order_by(*group_columns).all():
+        watch_time = row.watch_time_ms or 0
+        results.append({
+            **{column.key: getattr(row, column.key) for column in group_columns},
+            "sessions": row.sessions,
+            "avg_startup_time_ms": row.startup_time_ms / row.sessions if row.sessions else None,
+            "watch_time_ms": watch_time,
+            "stall_count": row.stall_count,
+            "stalls_per_hour": row.stall_count / (watch_time / 3_600_000) if watch_time else None,
+            # Share of the session time spent waiting for data
+            "rebuffering_ratio": row.stall_duration_ms / (watch_time + row.stall_duration_ms) if watch_time + row.stall_duration_ms else None,
+            "avg_bitrate_kbps": row.bitrate_time / watch_time if watch_time else None,
+            "rendition_switches": row.rendition_switches,
+        })
+    return results
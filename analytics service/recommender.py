@@ -0,0 +1,182 @@
+from models import UserVideoHistory
+from sqlalchemy.orm import Session
+from scipy import sparse
+import numpy as np
+import threading
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Weight factor of the category bias (user's category view count * factor is added to the score)
+CATEGORY_BIAS_FACTOR = 0.5
+
+# Number of pending co-view increments kept outside of the sparse matrix before they are merged into it
+COMPACT_THRESHOLD = int(os.getenv("COVIEW_COMPACT_THRESHOLD", "50000"))
+
+# Item-item co-view model used for recommendations
+#
+# coview[i, j] = number of distinct users who watched both video i and video j.
+# The score of a candidate video is the sum of its co-view counts with every video the user watched,
+# which equals the original algorithm (each similar user adds the size of the overlap to every video they watched).
+# New plays are collected as pending increments and merged into the sparse matrix in bulk.
+class CoViewModel:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.video_index = {}           # video id -> matrix index
+        self.video_ids = []             # matrix index -> video id
+        self.category_index = {}        # category -> category code
+        self._video_categories = []     # matrix index -> category code (-1 if unknown)
+        self._category_codes = None     # cached NumPy array of self._video_categories
+        self.user_videos = {}           # username -> set of watched matrix indexes
+        self.coview = sparse.csr_matrix((0, 0), dtype=np.int64)
+        self._pending = {}              # row -> {column: increment} not yet merged into self.coview
+        self._pending_size = 0
+
+    # Returns the matrix index of a video, registering it (and its category) if needed
+    def _get_video_index(self, video_id, category):
+        index = self.video_index.get(video_id)
+        if index is None:
+            index = len(self.video_ids)
+            self.video_index[video_id] = index
+            self.video_ids.append(video_id)
+            self._video_categories.append(-1)
+        # The category of a video is the first known one
+        if category and self._video_categories[index] == -1:
+            self._video_categories[index] = self.category_index.setdefault(category, len(self.category_index))
+            self._category_codes = None
+        return index
+
+    # Builds the model from (username, video_id, category) rows
+    def build(self, rows):
+        with self._lock:
+            self._reset()
+            user_ids = {}
+            user_column, video_column = [], []
+            for username, video_id, category in rows:
+                user_column.append(user_ids.setdefault(username, len(user_ids)))
+                video_column.append(self._get_video_index(video_id, category))
+
+            # Binary user x video matrix (repeated plays of the same video count once)
+            watched = sparse.csr_matrix(
+                (np.ones(len(user_column), dtype=np.int64), (user_column, video_column)),
+                shape=(len(user_ids), len(self.video_ids)),
+            )
+            watched.sum_duplicates()
+            watched.data[:] = 1
+
+            # Co-view counts of every video pair, without the video itself
+            coview = (watched.T @ watched).tocsr()
+            coview.setdiag(0)
+            coview.eliminate_zeros()
+            self.coview = coview
+
+            # Keep the watched videos per user for the incremental updates
+            for username, user_id in user_ids.items():
+                start, end = watched.indptr[user_id], watched.indptr[user_id + 1]
+                self.user_videos[username] = set(watched.indices[start:end].tolist())
+
+    # Builds the model from the UserVideoHistory table (streamed, not loaded at once)
+    # Plays whose video could not be resolved to an id are left out
+    def load(self, db: Session):
+        rows = db.query(
+            UserVideoHistory.username, UserVideoHistory.video_id, UserVideoHistory.category
+        ).filter(UserVideoHistory.video_id.isnot(None)).order_by(UserVideoHistory.id).yield_per(10000)
+        self.build(rows)
+        logger.info("Co-view model loaded", extra={"users": len(self.user_videos), "videos": len(self.video_ids)})
+
+    # Registers new plays (dicts with username, video_id and category)
+    def record_plays(self, plays):
+        with self._lock:
+            for play in plays:
+                index = self._get_video_index(play["video_id"], play.get("category"))
+                watched = self.user_videos.setdefault(play["username"], set())
+                if index in watched:
+                    continue
+                # The new video is co-viewed with every video the user watched before
+                for other in watched:
+                    self._add_pending(index, other)
+                    self._add_pending(other, index)
+                watched.add(index)
+
+            if self._pending_size > COMPACT_THRESHOLD:
+                self._compact()
+
+    def _add_pending(self, row, column):
+        row_increments = self._pending.setdefault(row, {})
+        if column not in row_increments:
+            self._pending_size += 1
+        row_increments[column] = row_increments.get(column, 0) + 1
+
+    # Merges the pending increments into the sparse matrix
+    def _compact(self):
+        size = len(self.video_ids)
+        rows, columns, values = [], [], []
+        for row, row_increments in self._pending.items():
+            for column, increment in row_increments.items():
+                rows.append(row)
+                columns.append(column)
+                values.append(increment)
+
+        coview = self.coview
+        coview.resize((size, size))
+        self.coview = (coview + sparse.csr_matrix((values, (rows, columns)), shape=(size, size), dtype=np.int64)).tocsr()
+        self._pending = {}
+        self._pending_size = 0
+
+    # Returns True if the user has watched at least one video
+    def has_user(self, username):
+        return bool(self.user_videos.get(username))
+
+    # Returns the matrix indexes of the videos the user has watched
+    def watched_videos(self, username):
+        with self._lock:
+            return frozenset(self.user_videos.get(username, ()))
+
+    # Returns the ids of the top recommended videos for the user
+    # category_weights: category -> number of videos the user watched from that category
+    def recommend(self, username, category_weights=None, limit=3):
+        with self._lock:
+            watched = self.user_videos.get(username)
+            if not watched:
+                return []
+            watched_rows = np.fromiter(watched, dtype=np.int64, count=len(watched))
+            scores = np.zeros(len(self.video_ids), dtype=np.float64)
+
+            # Sum the co-view rows of every watched video (vectorized over the sparse matrix)
+            merged_rows = watched_rows[watched_rows < self.coview.shape[0]]
+            if len(merged_rows):
+                scores[:self.coview.shape[1]] += np.asarray(self.coview[merged_rows].sum(axis=0)).ravel()
+
+            # Add the increments that are not merged into the matrix yet
+            for row in watched_rows.tolist():
+                for column, increment in self._pending.get(row, {}).items():
+                    scores[column] += increment
+
+            # Only videos co-viewed by similar users and not watched by the user are candidates
+            scores[watched_rows] = 0
+            candidates = np.flatnonzero(scores > 0)
+            if not len(candidates):
+                return []
+
+            # Apply category bias to the candidate scores
+            if category_weights:
+                if self._category_codes is None:
+                    self._category_codes = np.array(self._video_categories, dtype=np.int64)
+                # The last slot stays 0 and is used for videos without a category (code -1)
+                weights = np.zeros(len(self.category_index) + 1, dtype=np.float64)
+                for category, view_count in category_weights.items():
+                    code = self.category_index.get(category)
+                    if code is not None:
+                        weights[code] = view_count * CATEGORY_BIAS_FACTOR
+                scores[candidates] += weights[self._category_codes[candidates]]
+
+            # Sort by score (highest first) and get the top videos
+            top = candidates[np.argsort(-scores[candidates], kind="stable")[:limit]]
+            return [self.video_ids[index] for index in top.tolist()]
+
+# Shared model used by the API endpoints and the ingestion pipeline
+coview_model = CoViewModel()
@@ -0,0 +1,83 @@
+from models import ActivityRollup, RollupActiveUser
+from sqlalchemy.orm import Session
+from database import upsert_insert
+from collections import Counter
+from datetime import datetime
+
+# Supported bucket sizes
+GRANULARITIES = ("minute", "hour", "day")
+
+# Distinct active users are only kept for the larger buckets (one row per user and bucket)
+ACTIVE_USER_GRANULARITIES = ("hour", "day")
+
+# Supported metrics:
+# - events: number of events per event type
+# - plays_by_category: number of "play-video" events per video category
+# - active_users: number of distinct users with at least one event
+METRICS = ("events", "plays_by_category", "active_users")
+
+# Returns the start of the bucket the timestamp belongs to
+def bucket_start(timestamp: datetime, granularity: str):
+    if granularity == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# Increments the rollup counters with one upsert per batch
+# counts: (metric, granularity, bucket_start, dimension) -> increment
+def increment_rollups(db: Session, counts: Counter):
+    if not counts:
+        return
+    stmt = upsert_insert(db, ActivityRollup)
+    stmt = stmt.values([
+        {"metric": metric, "granularity": granularity, "bucket_start": start, "dimension": dimension, "count": count}
+        for (metric, granularity, start, dimension), count in sorted(counts.items())
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["metric", "granularity", "bucket_start", "dimension"],
+        set_={"count": ActivityRollup.count + stmt.excluded.count},
+    ))
+
+# Updates the rollups with a batch of events
+# Every event is counted in the bucket of its own timestamp, so late events correct the past buckets
+def apply_rollups(db: Session, events):
+    counts = Counter()
+    active_users = set()
+    for event in events:
+        metadata = event.get("activity_metadata") or {}
+        for granularity in GRANULARITIES:
+            start = bucket_start(event["timestamp"], granularity)
+            counts[("events", granularity, start, event["event_type"])] += 1
+            if event["event_type"] == "play-video" and metadata.get("category"):
+                counts[("plays_by_category", granularity, start, metadata["category"])] += 1
+            if granularity in ACTIVE_USER_GRANULARITIES:
+                active_users.add((granularity, start, event["username"]))
+
+    # Register the active users, only the ones not seen in the bucket yet increase the counter
+    if active_users:
+        stmt = upsert_insert(db, RollupActiveUser).values([
+            {"granularity": granularity, "bucket_start": start, "username": username}
+            for granularity, start, username in sorted(active_users)
+        ])
+        stmt = stmt.on_conflict_do_nothing(
+            index_elements=["granularity", "bucket_start", "username"]
+        ).returning(RollupActiveUser.granularity, RollupActiveUser.bucket_start)
+        for granularity, start in db.execute(stmt):
+            counts[("active_users", granularity, start, "")] += 1
+
+    increment_rollups(db, counts)
+
+# Returns the rollup records of a metric in the given time range, ordered by bucket
+def query_rollups(db: Session, metric, granularity, start=None, end=None, dimension=None):
+    query = db.query(ActivityRollup).filter(
+        ActivityRollup.metric == metric,
+        ActivityRollup.granularity == granularity,
+    )
+    if start is not None:
+        query = query.filter(ActivityRollup.bucket_start >= bucket_start(start, granularity))
+    if end is not None:
+        query = query.filter(ActivityRollup.bucket_start < end)
+    if dimension is not None:
+        query = query.filter(ActivityRollup.dimension == dimension)
+    return query.order_by(ActivityRollup.bucket_start, ActivityRollup.dimension).all()
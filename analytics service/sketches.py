@@ -0,0 +1,106 @@
+from database import upsert_insert
+from sqlalchemy.orm import Session
+from rollups import bucket_start
+from models import ViewerSketch
+import numpy as np
+import hashlib
+import math
+import os
+
+# Number of index bits of the HyperLogLog sketches: 2^12 = 4096 one-byte registers (4 KB per video and day)
+PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+
+# HyperLogLog sketch for approximate distinct counting
+# Standard error of the estimate: 1.04 / sqrt(number of registers), about 1.6% with the default precision
+class HyperLogLog:
+    def __init__(self, precision=PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+        if len(self.registers) != self.size:
+            raise ValueError(f"Expected {self.size} registers, got {len(self.registers)}")
+
+    @property
+    def standard_error(self):
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, value: str):
+        # 64-bit hash: the first bits select the register, the rest give the rank (position of the first 1 bit)
+        hashed = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+        index = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        rest = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    # Merges another sketch into this one (the result counts the union of both)
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Only sketches with the same precision can be merged")
+        merged = np.maximum(np.frombuffer(self.registers, dtype=np.uint8), np.frombuffer(other.registers, dtype=np.uint8))
+        self.registers = bytearray(merged.tobytes())
+
+    def estimate(self):
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        raw = alpha * self.size ** 2 / float(np.sum(np.ldexp(1.0, -registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(registers == 0))
+        # Small range correction (linear counting) while many registers are still empty
+        if raw <= 2.5 * self.size and zeros:
+            return self.size * math.log(self.size / zeros)
+        return raw
+
+# Adds the viewers of a batch of plays (with resolved video ids) to the daily sketches of the videos
+def apply_viewer_sketches(db: Session, plays):
+    viewers = {}
+    for play in plays:
+        key = (play["video_id"], bucket_start(play["timestamp"], "day"))
+        viewers.setdefault(key, set()).add(play["username"])
+
+    # Make sure every sketch exists, then lock them (in a fixed order) so concurrent writers merge instead of overwrite
+    keys = sorted(viewers)
+    stmt = upsert_insert(db, ViewerSketch).values([
+        {"video_id": video_id, "bucket_start": start, "registers": bytes(1 << PRECISION)}
+        for video_id, start in keys
+    ])
+    db.execute(stmt.on_conflict_do_nothing(index_elements=["video_id", "bucket_start"]))
+    sketches = db.query(ViewerSketch).filter(
+        ViewerSketch.video_id.in_({video_id for video_id, _ in keys}),
+        ViewerSketch.bucket_start.in_({start for _, start in keys}),
+    ).order_by(ViewerSketch.video_id, ViewerSketch.bucket_start).with_for_update().all()
+
+    for sketch in sketches:
+        usernames = viewers.get((sketch.video_id, sketch.bucket_start))
+        if not usernames:
+            continue
+        hll = HyperLogLog(registers=sketch.registers)
+        for username in usernames:
+            hll.add(username)
+        sketch.registers = bytes(hll.registers)
+
+# Returns the approximate number of distinct viewers of a video per day and in the whole range
+def unique_viewers(db: Session, video_id, start=None, end=None):
+    query = db.query(ViewerSketch).filter(ViewerSketch.video_id == video_id)
+    if start is not None:
+        query = query.filter(ViewerSketch.bucket_start >= bucket_start(start, "day"))
+    if end is not None:
+        query = query.filter(ViewerSketch.bucket_start < end)
+
+    total = HyperLogLog()
+    days = []
+    for sketch in query.order_by(ViewerSketch.bucket_start).all():
+        hll = HyperLogLog(registers=sketch.registers)
+        days.append({"day": sketch.bucket_start, "unique_viewers": round(hll.estimate())})
+        total.merge(hll)
+
+    estimate = total.estimate()
+    error = total.standard_error
+    return {
+        "video_id": video_id,
+        "unique_viewers": round(estimate),
+        "standard_error": error,
+        # About 95% of the estimates fall within two standard errors of the real value
+        "confidence_95": [max(0, math.floor(estimate * (1 - 2 * error))), math.ceil(estimate * (1 + 2 * error))],
+        "days": days,
+    }
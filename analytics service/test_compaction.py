@@ -0,0 +1,74 @@
+# Tests of the monthly compaction of the raw events into the rollups (partitions.compact_month)
+# Needs an empty PostgreSQL database: TEST_DATABASE_URL=postgresql://... python -m pytest test_compaction.py
+
+from datetime import datetime, timedelta
+import pytest
+import os
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+
+from database import SessionLocal, engine, init_db
+from models import ActivityRollup, RollupActiveUser, UserActivity
+from partitions import compact_month
+from ingestion import process_batch
+
+MONTH = datetime(2024, 3, 1)
+
+def event(username, event_type, timestamp, **metadata):
+    return {"username": username, "event_type": event_type, "activity_metadata": metadata, "timestamp": timestamp}
+
+def rollup_rows(db):
+    return {
+        (row.metric, row.granularity, row.bucket_start, row.dimension): row.count
+        for row in db.query(ActivityRollup).filter(ActivityRollup.bucket_start >= MONTH, ActivityRollup.bucket_start < datetime(2024, 4, 1))
+    }
+
+@pytest.fixture
+def db():
+    init_db()
+    session = SessionLocal()
+    yield session
+    session.close()
+    with engine.begin() as connection:
+        for table in (ActivityRollup.__table__, RollupActiveUser.__table__, UserActivity.__table__):
+            connection.execute(table.delete())
+
+def test_compaction_keeps_the_heartbeat_rollups(db):
+    day = MONTH + timedelta(days=4, hours=10)
+    process_batch(db, [
+        event("alice", "play-video", day, video="Intro", category="Film"),
+        event("alice", "playback-start", day + timedelta(seconds=2), startup_time_ms=300),
+        event("alice", "playback-heartbeat", day + timedelta(seconds=30), watch_time_ms=28000),
+        event("alice", "playback-heartbeat", day + timedelta(seconds=60), watch_time_ms=30000),
+        # bob only sends heartbeats on the next day (his session started before midnight)
+        event("bob", "playback-heartbeat", day + timedelta(days=1), watch_time_ms=30000),
+    ])
+    before = rollup_rows(db)
+    assert before[("events", "day", MONTH + timedelta(days=4), "playback-heartbeat")] == 2
+    assert before[("active_users", "day", MONTH + timedelta(days=5), "")] == 1
+
+    with engine.begin() as connection:
+        compact_month(connection, MONTH)
+
+    db.expire_all()
+    assert rollup_rows(db) == before
+    assert db.query(RollupActiveUser).count() == 0
+
+def test_compaction_rebuilds_the_stored_events(db):
+    day = MONTH + timedelta(days=9)
+    process_batch(db, [
+        event("alice", "login", day),
+        event("carol", "play-video", day + timedelta(hours=1), video="Intro", category="Sport"),
+    ])
+    before = rollup_rows(db)
+
+    # Drop the incremental rollups: compaction recomputes them from user_activities
+    with engine.begin() as connection:
+        connection.execute(ActivityRollup.__table__.delete())
+        compact_month(connection, MONTH)
+
+    db.expire_all()
+    assert rollup_rows(db) == before
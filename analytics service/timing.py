@@ -0,0 +1,152 @@
+from urllib import request as urllib_request
+from time import perf_counter, monotonic
+from datetime import datetime
+import threading
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# The same module is used by every service (copied into each service directory)
+
+# Settings of the request timing (can be set via environment variables)
+ANALYTICS_URL = os.getenv("ANALYTICS_URL", "http://analytics-service:80")    # Where the histograms are shipped
+SHIP_INTERVAL = float(os.getenv("TIMING_SHIP_INTERVAL", "15"))               # Length of one histogram window (in seconds)
+
+# Upper bounds of the latency histogram buckets (in milliseconds), the last bucket is unbounded
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# Returns the key of the bucket the latency belongs to
+def bucket_key(latency_ms):
+    for bound in LATENCY_BUCKETS_MS:
+        if latency_ms <= bound:
+            return str(bound)
+    return "inf"
+
+# Per-route latency histograms of the current window
+class LatencyRecorder:
+    def __init__(self, service):
+        self.service = service
+        self._lock = threading.Lock()
+        self._window_start = datetime.utcnow()
+        self._histograms = {}   # (endpoint, status_code) -> {"count", "total_ms", "buckets"}
+        self.observers = []     # Functions that also receive every measurement (e.g. the Prometheus metrics)
+
+    def record(self, endpoint, status_code, latency_ms):
+        for observer in self.observers:
+            observer(endpoint, status_code, latency_ms)
+        with self._lock:
+            histogram = self._histograms.get((endpoint, status_code))
+            if histogram is None:
+                histogram = {"count": 0, "total_ms": 0.0, "buckets": {}}
+                self._histograms[(endpoint, status_code)] = histogram
+            histogram["count"] += 1
+            histogram["total_ms"] += latency_ms
+            key = bucket_key(latency_ms)
+            histogram["buckets"][key] = histogram["buckets"].get(key, 0) + 1
+
+    # Closes the current window and returns its histograms (one record per endpoint and status code)
+    def drain(self):
+        with self._lock:
+            histograms, window_start = self._histograms, self._window_start
+            self._histograms, self._window_start = {}, datetime.utcnow()
+        return [
+            {
+                "service": self.service,
+                "endpoint": endpoint,
+                "status_code": status_code,
+                "window_start": window_start.isoformat(),
+                "request_count": histogram["count"],
+                "response_time": histogram["total_ms"] / histogram["count"],  # Average in milliseconds
+                "latency_buckets": histogram["buckets"],
+            }
+            for (endpoint, status_code), histogram in histograms.items()
+        ]
+
+# ASGI middleware that measures every HTTP request and records it per route template
+class TimingMiddleware:
+    def __init__(self, app, recorder: LatencyRecorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The matched route is stored in the scope by the router (route template, e.g. /videos/{filename})
+            route = scope.get("route")
+            endpoint = f"{scope['method']} {getattr(route, 'path', 'unmatched')}"
+            self.recorder.record(endpoint, status["code"], (perf_counter() - start) * 1000)
+
+# Sends the histograms to the analytics service in one request
+def ship_to_analytics(records):
+    body = json.dumps(records).encode("utf-8")
+    req = urllib_request.Request(
+        f"{ANALYTICS_URL}/analytics/system-metrics/batch",
+        data=body,
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib_request.urlopen(req, timeout=5) as response:
+        response.read()
+
+# Background thread that ships the closed windows periodically
+class MetricsShipper:
+    def __init__(self, recorder: LatencyRecorder, sink=ship_to_analytics, interval=SHIP_INTERVAL):
+        self.recorder = recorder
+        self.sink = sink
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ship(self):
+        records = self.recorder.drain()
+        if not records:
+            return
+        try:
+            self.sink(records)
+        except Exception as e:
+            # Metrics are best effort: a failed window is dropped instead of piling up in memory
+            logger.warning("Failed to ship request metrics: %s", e)
+
+    def _run(self):
+        next_run = monotonic() + self.interval
+        while not self._stop.wait(max(0, next_run - monotonic())):
+            self.ship()
+            next_run += self.interval
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-shipper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.ship() # Ship the last, partial window
+
+# Adds the timing middleware to the app and ships the histograms while the app is running
+def setup_timing(app, service, sink=ship_to_analytics):
+    recorder = LatencyRecorder(service)
+    shipper = MetricsShipper(recorder, sink)
+    app.add_middleware(TimingMiddleware, recorder=recorder)
+    app.add_event_handler("startup", shipper.start)
+    app.add_event_handler("shutdown", shipper.stop)
+    return recorder
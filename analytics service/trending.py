@@ -0,0 +1,179 @@
+from database import SessionLocal, upsert_insert
+from sqlalchemy.orm import Session
+from models import TrendingScore
+from datetime import datetime
+import threading
+import heapq
+import math
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the trending engine (can be set via environment variables)
+HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", "6"))     # A play loses half of its weight in this time
+TOP_K = int(os.getenv("TRENDING_TOP_K", "100"))                         # Videos kept in each top list
+SNAPSHOT_INTERVAL = float(os.getenv("TRENDING_SNAPSHOT_INTERVAL", "60")) # Seconds between database snapshots
+
+# Decay rate per second
+DECAY_RATE = math.log(2) / (HALF_LIFE_HOURS * 3600)
+
+# The scores are stored relative to a reference time (score * e^(rate * (t - reference))), so a new play
+# only changes one video and the order of the videos never has to be recomputed as time passes.
+# When the stored values grow too large, the reference time is moved forward and every score is rescaled.
+MAX_EXPONENT = 300
+
+# Scores below this (decayed to now) are dropped when the scores are rescaled
+MIN_SCORE = 1e-3
+
+# Bounded top-K of videos whose scores only increase
+# A min-heap with lazy deletion: outdated heap entries are skipped when they reach the top
+class TopK:
+    def __init__(self, k):
+        self.k = k
+        self.members = {}   # video id -> score
+        self._heap = []     # (score, video id), may contain outdated entries
+
+    def _min(self):
+        while self._heap and self.members.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def update(self, video_id, score):
+        if video_id in self.members or len(self.members) < self.k:
+            self.members[video_id] = score
+            heapq.heappush(self._heap, (score, video_id))
+        else:
+            # The smallest member never decreases, so a video that is out can only get in by beating it
+            smallest = self._min()
+            if score <= smallest[0]:
+                return
+            heapq.heapreplace(self._heap, (score, video_id))
+            del self.members[smallest[1]]
+            self.members[video_id] = score
+        # Drop the outdated entries from time to time so the heap stays bounded
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(score, video_id) for video_id, score in self.members.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, limit):
+        return sorted(self.members.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+# In-memory trending engine with exponentially time-decayed play counts
+class TrendingEngine:
+    def __init__(self, k=TOP_K, decay_rate=DECAY_RATE):
+        self.k = k
+        self.decay_rate = decay_rate
+        self._lock = threading.Lock()
+        self._reset(datetime.utcnow())
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _reset(self, reference):
+        self._reference = reference
+        self._scores = {}       # video id -> score relative to the reference time
+        self._categories = {}   # video id -> category
+        self._overall = TopK(self.k)
+        self._by_category = {}  # category -> TopK
+
+    def _exponent(self, timestamp):
+        return self.decay_rate * (timestamp - self._reference).total_seconds()
+
+    # Moves the reference time to now, rescales the scores and drops the ones that decayed to ~0
+    def _rebase(self, now):
+        factor = math.exp(-self._exponent(now))
+        scores, categories = self._scores, self._categories
+        self._reset(now)
+        for video_id, score in scores.items():
+            if score * factor >= MIN_SCORE:
+                self._set(video_id, categories.get(video_id), score * factor)
+
+    def _set(self, video_id, category, score):
+        self._scores[video_id] = score
+        if category:
+            self._categories[video_id] = category
+        self._overall.update(video_id, score)
+        category = self._categories.get(video_id)
+        if category:
+            self._by_category.setdefault(category, TopK(self.k)).update(video_id, score)
+
+    # Adds weight to a video (1 for a play at the given time)
+    def _add(self, video_id, category, timestamp, weight=1.0):
+        if self._exponent(timestamp) > MAX_EXPONENT:
+            self._rebase(timestamp)
+        increment = weight * math.exp(self._exponent(timestamp))
+        self._set(video_id, category, self._scores.get(video_id, 0.0) + increment)
+
+    # Registers new plays (dicts with video_id, category and timestamp)
+    def record_plays(self, plays):
+        with self._lock:
+            for play in plays:
+                self._add(play["video_id"], play.get("category"), play["timestamp"])
+
+    # Returns the top trending videos (overall or in one category) with their scores decayed to now
+    def top(self, category=None, limit=10):
+        with self._lock:
+            top_k = self._overall if category is None else self._by_category.get(category)
+            if top_k is None:
+                return []
+            factor = math.exp(-self._exponent(datetime.utcnow()))
+            return [
+                {"video_id": video_id, "category": self._categories.get(video_id), "score": score * factor}
+                for video_id, score in top_k.top(limit)
+            ]
+
+    # Restores the scores from the last database snapshot
+    def load(self, db: Session):
+        with self._lock:
+            self._reset(datetime.utcnow())
+            for row in db.query(TrendingScore).yield_per(1000):
+                # The snapshot holds the score at updated_at, convert it to the current reference time
+                self._add(row.video_id, row.category, row.updated_at, weight=row.score)
+
+    # Writes the current scores (decayed to now) to the database with one upsert
+    def snapshot(self):
+        now = datetime.utcnow()
+        with self._lock:
+            factor = math.exp(-self._exponent(now))
+            rows = [
+                {"video_id": video_id, "category": self._categories.get(video_id), "score": score * factor, "updated_at": now}
+                for video_id, score in self._scores.items()
+            ]
+        if not rows:
+            return
+        db = SessionLocal()
+        try:
+            stmt = upsert_insert(db, TrendingScore).values(rows)
+            db.execute(stmt.on_conflict_do_update(
+                index_elements=["video_id"],
+                set_={"category": stmt.excluded.category, "score": stmt.excluded.score, "updated_at": stmt.excluded.updated_at},
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.exception("Failed to save trending snapshot")
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stop.wait(SNAPSHOT_INTERVAL):
+            self.snapshot()
+
+    # Starts the periodic snapshots
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="trending-snapshot", daemon=True)
+        self._thread.start()
+
+    # Stops the periodic snapshots and saves the final state
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.snapshot()
+
+# Shared engine used by the API endpoints and the ingestion pipeline
+trending_engine = TrendingEngine()
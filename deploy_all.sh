@@ -31,6 +31,15 @@ kubectl apply -f "database/service.yaml"
 echo "⏳ Várakozás 10 másodpercet az adatbázis indulásához..."
 sleep 10
 
+# A user service JWT aláíró kulcsa (titok nélkül a szolgáltatás nem indul el)
+if ! kubectl get secret jwt-signing-keys >/dev/null 2>&1; then
+  echo "🔑 JWT aláíró kulcs létrehozása..."
+  KEY_DIR=$(mktemp -d)
+  openssl genpkey -algorithm ed25519 -out "$KEY_DIR/key-$(date +%Y%m%d).pem"
+  kubectl create secret generic jwt-signing-keys --from-file="$KEY_DIR"
+  rm -rf "$KEY_DIR"
+fi
+
 # Többi komponens sorrendben
 SERVICES=(
   "storage"
@@ -0,0 +1,131 @@
+# Starts the backend services on the local machine for the load test
+#
+# Every service runs in its own uvicorn process (the services use the same module names, e.g. main, models
+# and database, so they can not share an interpreter), configured through the same environment variables
+# as in the Kubernetes deployments. The addresses of the other services point to the local processes and
+# the NGINX VOD server is replaced by the stand-in of vod_stub.py.
+#
+# Database: a SQLite file shared by the services (default), or an existing PostgreSQL database given by URL.
+# The tables are created by the services at startup, use an empty database for comparable results.
+
+from vod_stub import VodStubServer
+from pathlib import Path
+from time import monotonic
+import urllib.request
+import urllib.error
+import subprocess
+import tempfile
+import sqlite3
+import socket
+import signal
+import time
+import sys
+import os
+
+# Repository root (the service directories are next to the load test directory)
+ROOT = Path(__file__).resolve().parent.parent
+
+# Service name -> (directory, readiness path), stopped in this order (the others ship their metrics to analytics)
+SERVICES = {
+    "user": ("user service", "/health/ready"),
+    "vod": ("vod management service", "/health/ready"),
+    "analytics": ("analytics service", "/health/ready"),
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Creates the SQLite database file in WAL mode, so readers do not wait for the writing service
+def create_sqlite_database(path):
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+    finally:
+        connection.close()
+    return f"sqlite:///{path}"
+
+class Stack:
+    def __init__(self, database_url=None, videos=50, env=None, workdir=None):
+        self.workdir = Path(workdir or tempfile.mkdtemp(prefix="vod-load-test-"))
+        self.database_url = database_url or create_sqlite_database(self.workdir / "vod.db")
+        self.videos = videos
+        self.extra_env = env or {}
+        self.ports = {name: free_port() for name in SERVICES}
+        self.vod_stub = None
+        self.processes = {}
+
+    # Base URL of a service, e.g. stack.url("user")
+    def url(self, name):
+        return f"http://127.0.0.1:{self.ports[name]}"
+
+    def service_env(self):
+        env = dict(os.environ)
+        env.update({
+            "DATABASE_URL": self.database_url,
+            "VOD_SERVER_URL": self.vod_stub.url,
+            "USER_SERVICE_URL": self.url("user"),
+            "JWKS_URL": f"{self.url('user')}/.well-known/jwks.json",
+            "ANALYTICS_URL": self.url("analytics"),
+            "JWT_KEYS_DIR": str(self.workdir / "jwt-keys"),   # Empty: the user service signs with an ephemeral key
+            "JWT_ALLOW_EPHEMERAL_KEY": "true",
+            "PARQUET_EXPORT_DIR": str(self.workdir / "exports"),
+            "LOG_LEVEL": "WARNING",
+            "SHUTDOWN_DRAIN_DELAY": "0",
+            "SHUTDOWN_GRACE_PERIOD": "5",
+        })
+        env.update(self.extra_env)
+        return env
+
+    def start(self, timeout=60):
+        self.vod_stub = VodStubServer(videos=self.videos).start()
+        env = self.service_env()
+        for name, (directory, _) in SERVICES.items():
+            log = open(self.workdir / f"{name}.log", "w")
+            self.processes[name] = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.ports[name])],
+                cwd=ROOT / directory, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        for name, (_, ready_path) in SERVICES.items():
+            self.wait_ready(name, ready_path, timeout)
+        return self
+
+    # Waits until the readiness probe of the service answers 200
+    def wait_ready(self, name, path, timeout):
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            if self.processes[name].poll() is not None:
+                raise RuntimeError(f"The {name} service exited, see {self.workdir / f'{name}.log'}")
+            try:
+                with urllib.request.urlopen(self.url(name) + path, timeout=2) as response:
+                    if response.status == 200:
+                        return
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                pass
+            time.sleep(0.2)
+        raise TimeoutError(f"The {name} service was not ready in {timeout} s, see {self.workdir / f'{name}.log'}")
+
+    # Stops the services the way Kubernetes does (SIGTERM, buffered writes are flushed)
+    def stop(self, timeout=15):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = {}
+        if self.vod_stub is not None:
+            self.vod_stub.stop()
+            self.vod_stub = None
+
+    def __enter__(self):
+        try:
+            return self.start()
+        except BaseException:
+            self.stop()
+            raise
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,110 @@
+# Stand-in for the NGINX VOD server (nginx vod server/nginx_vod.conf) used by the load test
+# Serves the /vod/ directory listing in the format of the NGINX autoindex module, the master playlists
+# and the <slug>_info.txt metadata files the VOD management service reads during the catalog sync.
+# Usage: python vod_stub.py [port] [videos]
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime
+from urllib.parse import unquote
+import threading
+import random
+import sys
+
+CATEGORIES = ["Film", "Sport", "Music", "News", "Education"]
+
+# Master playlist of a video (the renditions themselves are not served, the load test does not play videos)
+MASTER_PLAYLIST = (
+    "#EXTM3U\n#EXT-X-VERSION:3\n"
+    "#EXT-X-STREAM-INF:BANDWIDTH=5350000,RESOLUTION=1920x1080\n{slug}_0/index.m3u8\n"
+    "#EXT-X-STREAM-INF:BANDWIDTH=2996000,RESOLUTION=1280x720\n{slug}_1/index.m3u8\n"
+    "#EXT-X-STREAM-INF:BANDWIDTH=1498000,RESOLUTION=848x480\n{slug}_2/index.m3u8\n"
+    "#EXT-X-STREAM-INF:BANDWIDTH=856000,RESOLUTION=640x360\n{slug}_3/index.m3u8\n"
+)
+
+# Generates the files of the video library: {name: content}
+def generate_library(videos, seed=42):
+    rng = random.Random(seed)
+    files = {}
+    for number in range(1, videos + 1):
+        slug = f"video_{number:05d}"
+        files[f"{slug}.m3u8"] = MASTER_PLAYLIST.format(slug=slug)
+        # Line 1: title, line 2: category, line 3: duration, lines 4+: description
+        files[f"{slug}_info.txt"] = (
+            f"Video {number}\n{CATEGORIES[number % len(CATEGORIES)]}\n{rng.randint(60, 7200)}\n"
+            f"Generated video number {number} of the load test library.\n"
+        )
+    return files
+
+# Renders a directory listing like "autoindex on;" does (hidden files are not listed)
+# modified: modification time shown for every file (the VOD management service re-reads a file when it changes)
+def autoindex_html(path, files, modified):
+    modified = modified.strftime("%d-%b-%Y %H:%M")
+    rows = "".join(
+        f'<a href="{name}">{name}</a>{" " * max(1, 51 - len(name))}{modified}{len(content.encode()):>20}\n'
+        for name, content in sorted(files.items()) if not name.startswith(".")
+    )
+    return (
+        f"<html>\r\n<head><title>Index of {path}</title></head>\r\n<body>\r\n<h1>Index of {path}</h1><hr><pre>"
+        f'<a href="../">../</a>\n{rows}</pre><hr></body>\r\n</html>\r\n'
+    )
+
+class VodRequestHandler(BaseHTTPRequestHandler):
+    # Files served under /vod/ and the time they were generated (set by VodStubServer)
+    files = {}
+    modified = None
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = unquote(self.path.split("?", 1)[0])
+        if path in ("/vod", "/vod/"):
+            self._send(200, "text/html", autoindex_html("/vod/", self.files, self.modified))
+        elif path.startswith("/vod/") and path[len("/vod/"):] in self.files:
+            name = path[len("/vod/"):]
+            content_type = "application/vnd.apple.mpegurl" if name.endswith(".m3u8") else "text/plain"
+            self._send(200, content_type, self.files[name])
+        else:
+            self._send(404, "text/html", "<html><body><h1>404 Not Found</h1></body></html>")
+
+    def _send(self, status, content_type, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The access log would be written for every request of the load test
+    def log_message(self, format, *args):
+        pass
+
+# The stand-in server, running on a background thread
+class VodStubServer:
+    def __init__(self, port=0, videos=50):
+        handler = type("Handler", (VodRequestHandler,), {"files": generate_library(videos), "modified": datetime.utcnow()})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/vod/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="vod-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 7000
+    videos = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    stub = VodStubServer(port, videos).start()
+    print(f"Serving {videos} videos on {stub.url}")
+    try:
+        stub._thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -1,11 +1,26 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from metrics import setup_metrics, add_gauge
+from graceful import graceful_shutdown
+from prometheus_client import Histogram
+from logs import setup_logging
+from timing import setup_timing, LATENCY_BUCKETS_MS
+from time import perf_counter
 from pathlib import Path
 import subprocess
+import asyncio
+import shutil
+import logging
 import os 
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI()
 
+# Structured JSON logging through a background queue, every request gets an id
+setup_logging("transcoding-service", app)
+
 # Configure CORS (Cross-Origin Resource Sharing)
 app.add_middleware(
     CORSMiddleware,
@@ -15,14 +30,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Define upload and output directories
-UPLOAD_DIR = Path("/app/uploads")
-OUTPUT_DIR = Path("/vod")
+# Measure every request and ship the latency histograms to the analytics service in batches
+recorder = setup_timing(app, "transcoding-service")
+
+# Expose the request metrics and the transcoding gauges on /metrics (Prometheus format)
+setup_metrics(app, recorder)
+
+# Number of FFmpeg processes that may run at the same time (the others wait in the queue)
+TRANSCODE_MAX_CONCURRENT = int(os.getenv("TRANSCODE_MAX_CONCURRENT", "1"))
+
+# FFmpeg runs on a worker thread, so the event loop keeps answering (e.g. /metrics) during a transcode
+transcode_slots = asyncio.Semaphore(TRANSCODE_MAX_CONCURRENT)
+transcode_state = {"queued": 0, "active": 0}
+
+add_gauge("transcoding_queue_depth", "Uploads waiting for a free transcoding slot", lambda: transcode_state["queued"])
+add_gauge("transcoding_active_ffmpeg_processes", "Running FFmpeg processes", lambda: transcode_state["active"])
+TRANSCODE_DURATION = Histogram(
+    "transcoding_duration_seconds", "Duration of the FFmpeg runs", ["result"],
+    buckets=tuple(bound / 1000 for bound in LATENCY_BUCKETS_MS) + (120, 300, 600, 1800, 3600),
+)
+
+# FFmpeg processes that are running now
+running_processes = set()
+
+# Runs FFmpeg once a transcoding slot is free
+async def run_ffmpeg(ffmpeg_command, cwd):
+    transcode_state["queued"] += 1
+    try:
+        await transcode_slots.acquire()
+    finally:
+        transcode_state["queued"] -= 1
+    transcode_state["active"] += 1
+    start = perf_counter()
+    result = "error"
+    try:
+        process = subprocess.Popen(ffmpeg_command, cwd=cwd)
+        running_processes.add(process)
+        try:
+            returncode = await run_in_threadpool(process.wait)
+        except asyncio.CancelledError:
+            # The request was cancelled, FFmpeg must not keep writing the output
+            process.kill()
+            raise
+        finally:
+            running_processes.discard(process)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ffmpeg_command)
+        result = "success"
+    finally:
+        TRANSCODE_DURATION.labels(result).observe(perf_counter() - start)
+        transcode_state["active"] -= 1
+        transcode_slots.release()
+
+# Define upload and output directories (can be set via environment variables)
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "/app/uploads"))
+OUTPUT_DIR = Path(os.getenv("VOD_OUTPUT_DIR", "/vod"))
+
+# Markers of the running transcodes (on the shared volume, so a restarted pod finds the interrupted ones)
+# NGINX does not list hidden directories, so the markers are not served
+JOBS_DIR = OUTPUT_DIR / ".transcoding"
+
+# Number of video renditions written per video (<slug>_0 ... <slug>_3)
+RENDITION_COUNT = 4
+
+# At most this many audio renditions are written in group mode (<slug>_audio_0, <slug>_audio_1)
+MAX_AUDIO_RENDITIONS = 2
+
+# Audio output of the renditions (can be set via environment variables)
+#   group: one or two AAC renditions in an EXT-X-MEDIA audio group that every video variant refers to
+#   muxed: an AAC copy in every video variant (four audio encodes, four copies in the storage)
+HLS_AUDIO_MODE = os.getenv("HLS_AUDIO_MODE", "group")
+AUDIO_GROUP_BITRATES = [bitrate.strip() for bitrate in os.getenv("HLS_AUDIO_BITRATES", "128k").split(",") if bitrate.strip()][:MAX_AUDIO_RENDITIONS]   # e.g. "128k" or "128k,64k"
+AUDIO_GROUP_ID = "audio"
+MUXED_AUDIO_BITRATES = ["192k", "128k", "96k", "64k"]   # One per video variant (1080p first) in muxed mode
 
 # Ensure that the directories exist
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# Removes every output file of a video (used when its transcode did not finish)
+def remove_outputs(slug):
+    for rendition in range(RENDITION_COUNT):
+        shutil.rmtree(OUTPUT_DIR / f"{slug}_{rendition}", ignore_errors=True)
+    for rendition in range(MAX_AUDIO_RENDITIONS):
+        shutil.rmtree(OUTPUT_DIR / f"{slug}_audio_{rendition}", ignore_errors=True)
+    for name in (f"{slug}.m3u8", f"{slug}_info.txt"):
+        (OUTPUT_DIR / name).unlink(missing_ok=True)
+
+# Removes the partial output of the transcodes a previous run could not finish, and the uploads it left behind
+# Only one transcoding pod writes to the volume, so every marker found at startup belongs to a dead process
+def cleanup_interrupted_jobs():
+    if JOBS_DIR.is_dir():
+        for marker in JOBS_DIR.iterdir():
+            remove_outputs(marker.name)
+            marker.unlink(missing_ok=True)
+            logger.warning("Removed the partial output of an interrupted transcode", extra={"slug": marker.name})
+    for upload in UPLOAD_DIR.iterdir():
+        if upload.is_file():
+            upload.unlink(missing_ok=True)
+
+# Stops the running FFmpeg processes (the grace period of the shutdown is over)
+def stop_running_ffmpeg():
+    for process in list(running_processes):
+        logger.warning("Stopping FFmpeg, the shutdown grace period is over", extra={"pid": process.pid})
+        process.terminate()
+
+# Prepare the volume before the first upload and take over SIGTERM
+@app.on_event("startup")
+def startup():
+    cleanup_interrupted_jobs()
+    graceful_shutdown.install()
+    graceful_shutdown.on_deadline(stop_running_ffmpeg)
+
+# Whatever is still running when the server stops is stopped (its output is removed on the next startup)
+@app.on_event("shutdown")
+def shutdown():
+    stop_running_ffmpeg()
+
 # Helper function to check if audio stream exists
 def has_audio_stream(input_file):
     try:
@@ -36,49 +160,10 @@ def has_audio_stream(input_file):
     except:
         return False
 
-# Root API endpoint for checking whether the service is running
-@app.get("/")
-def read_root():
-    return {"message": "Transcoding Service is up and running!"}
-
-# Endpoint to handle video upload and multi-rendition HLS transcoding
-@app.post("/upload")
-async def upload_video(file: UploadFile = File(...), metadata: UploadFile | None = File(None)):
-    # Validate input
-    if not file.filename.endswith(".mp4"):
-        raise HTTPException(status_code=400, detail="Only .mp4 files are enabled.")
-
-    # Prepare names and paths
-    base_name = Path(file.filename).stem
-    slug = base_name.replace(" ", "_").lower()
-
-    # Save input
-    input_file_path = UPLOAD_DIR / file.filename
-    with open(input_file_path, "wb") as buffer:
-        buffer.write(await file.read())
-
-    # Resolve absolute path for FFmpeg (cwd will change for output writing)
-    input_file_path = input_file_path.resolve()
-
-    # Output directory: flat structure in /vod
-    out_dir = OUTPUT_DIR
-    os.makedirs(out_dir, exist_ok=True)
-
-    # Ensure rendition subdirectories exist: /vod/<slug>_0, /vod/<slug>_1, ...
-    for rendition_dir in range(4):
-        (out_dir / f"{slug}_{rendition_dir}").mkdir(exist_ok=True)
-
-    # Save metadata to /vod/<slug>_info.txt
-    metadata_path = out_dir / f"{slug}_info.txt"
-    if metadata:
-        with open(metadata_path, "wb") as meta_buffer:
-            meta_buffer.write(await metadata.read())
-
-    # Check if audio stream exists
-    has_audio = has_audio_stream(input_file_path)
-
-    # FFmpeg command to generate 4 renditions + master.m3u8
-    # Output structure: /vod/<slug>_master.m3u8, /vod/<slug>_0/index.m3u8, etc.
+# Builds the FFmpeg command that writes the renditions of a video and its master playlist
+# Output structure: /vod/<slug>.m3u8, /vod/<slug>_0/index.m3u8 ... /vod/<slug>_3/index.m3u8 (video),
+# /vod/<slug>_audio_0/index.m3u8 ... (audio group, HLS_AUDIO_MODE=group)
+def build_ffmpeg_command(input_file_path, slug, has_audio):
     ffmpeg_command = [
         "ffmpeg", "-y",
         "-i", str(input_file_path),
@@ -116,22 +201,28 @@ async def upload_video(file: UploadFile = File(...), metadata: UploadFile | None
         "-g:v:3", "48", "-keyint_min:v:3", "48", "-sc_threshold:v:3", "0",
     ]
 
-    # Add audio mapping if audio exists
-    if has_audio:
-        ffmpeg_command.extend([
-            "-map", "0:a?",
-            "-c:a:0", "aac", "-b:a:0", "192k", "-ac:a:0", "2",
-            "-c:a:1", "aac", "-b:a:1", "128k", "-ac:a:1", "2",
-            "-c:a:2", "aac", "-b:a:2", "96k", "-ac:a:2", "2",
-            "-c:a:3", "aac", "-b:a:3", "64k", "-ac:a:3", "2",
-        ])
-
-    # Add HLS output options
-    if has_audio:
-        var_stream_map = "v:0,a:0 v:1,a:1 v:2,a:2 v:3,a:3"
+    video_variants = [f"v:{index}" for index in range(RENDITION_COUNT)]
+    if not has_audio:
+        var_stream_map = " ".join(video_variants)
+    elif HLS_AUDIO_MODE == "group":
+        # The audio is encoded once per bitrate and published as an EXT-X-MEDIA group,
+        # every video variant refers to the group instead of carrying its own copy
+        for index, bitrate in enumerate(AUDIO_GROUP_BITRATES):
+            ffmpeg_command.extend(["-map", "0:a:0", f"-c:a:{index}", "aac", f"-b:a:{index}", bitrate, f"-ac:a:{index}", "2"])
+        var_stream_map = " ".join(
+            [f"{variant},agroup:{AUDIO_GROUP_ID}" for variant in video_variants]
+            + [
+                f"a:{index},agroup:{AUDIO_GROUP_ID},name:audio_{index}" + (",default:yes" if index == 0 else "")
+                for index in range(len(AUDIO_GROUP_BITRATES))
+            ]
+        )
     else:
-        var_stream_map = "v:0 v:1 v:2 v:3"
+        # An AAC copy muxed into every video variant (bitrate decreasing with the video quality)
+        for index, bitrate in enumerate(MUXED_AUDIO_BITRATES):
+            ffmpeg_command.extend(["-map", "0:a:0", f"-c:a:{index}", "aac", f"-b:a:{index}", bitrate, f"-ac:a:{index}", "2"])
+        var_stream_map = " ".join(f"{variant},a:{index}" for index, variant in enumerate(video_variants))
 
+    # HLS output options
     ffmpeg_command.extend([
         "-f", "hls",
         "-hls_time", "4",
@@ -142,11 +233,100 @@ async def upload_video(file: UploadFile = File(...), metadata: UploadFile | None
         "-var_stream_map", var_stream_map,
         f"{slug}_%v/index.m3u8",
     ])
+    return ffmpeg_command
+
+# Directories of the audio renditions written for a video (empty if the audio is muxed into the video variants)
+def audio_rendition_dirs(slug, has_audio):
+    if not has_audio or HLS_AUDIO_MODE != "group":
+        return []
+    return [f"{slug}_audio_{index}" for index in range(len(AUDIO_GROUP_BITRATES))]
+
+# Root API endpoint for checking whether the service is running
+@app.get("/")
+def read_root():
+    return {"message": "Transcoding Service is up and running!"}
+
+# Liveness probe: the process is up and able to answer requests
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+# Readiness probe: no new uploads are accepted while the pod shuts down
+@app.get("/health/ready")
+def readiness(response: Response):
+    ready = not graceful_shutdown.is_draining()
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "queued": transcode_state["queued"], "active": transcode_state["active"]}
+
+# Endpoint to handle video upload and multi-rendition HLS transcoding
+@app.post("/upload")
+async def upload_video(file: UploadFile = File(...), metadata: UploadFile | None = File(None)):
+    # Validate input
+    if not file.filename.endswith(".mp4"):
+        raise HTTPException(status_code=400, detail="Only .mp4 files are enabled.")
+
+    # A transcode started now could not finish before the pod stops
+    if graceful_shutdown.is_draining():
+        raise HTTPException(status_code=503, detail="The service is shutting down, please try again", headers={"Retry-After": "5"})
+
+    # Prepare names and paths
+    base_name = Path(file.filename).stem
+    slug = base_name.replace(" ", "_").lower()
+
+    # Save input
+    input_file_path = UPLOAD_DIR / file.filename
+    with open(input_file_path, "wb") as buffer:
+        buffer.write(await file.read())
+
+    # Resolve absolute path for FFmpeg (cwd will change for output writing)
+    input_file_path = input_file_path.resolve()
+
+    # Output directory: flat structure in /vod
+    out_dir = OUTPUT_DIR
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Mark the transcode as running until its output is complete
+    JOBS_DIR.mkdir(exist_ok=True)
+    (JOBS_DIR / slug).touch()
+
+    # Ensure rendition subdirectories exist: /vod/<slug>_0, /vod/<slug>_1, ...
+    for rendition_dir in range(RENDITION_COUNT):
+        (out_dir / f"{slug}_{rendition_dir}").mkdir(exist_ok=True)
+
+    # Save metadata to /vod/<slug>_info.txt
+    metadata_path = out_dir / f"{slug}_info.txt"
+    if metadata:
+        with open(metadata_path, "wb") as meta_buffer:
+            meta_buffer.write(await metadata.read())
+
+    # Check if audio stream exists
+    has_audio = has_audio_stream(input_file_path)
+
+    # Audio rendition subdirectories: /vod/<slug>_audio_0, ...
+    audio_dirs = audio_rendition_dirs(slug, has_audio)
+    for audio_dir in audio_dirs:
+        (out_dir / audio_dir).mkdir(exist_ok=True)
+
+    # FFmpeg command of the renditions + master playlist
+    ffmpeg_command = build_ffmpeg_command(input_file_path, slug, has_audio)
 
     try:
-        subprocess.run(ffmpeg_command, check=True, cwd=str(out_dir))
+        await run_ffmpeg(ffmpeg_command, str(out_dir))
     except subprocess.CalledProcessError as e:
+        # Partial output is not left on the volume
+        remove_outputs(slug)
+        (JOBS_DIR / slug).unlink(missing_ok=True)
+        if graceful_shutdown.is_draining():
+            logger.warning("Transcoding interrupted by the shutdown", extra={"slug": slug})
+            raise HTTPException(status_code=503, detail="Transcoding was interrupted by a restart, please upload again", headers={"Retry-After": "30"})
+        logger.error("Transcoding failed", extra={"slug": slug, "returncode": e.returncode})
         raise HTTPException(status_code=500, detail=f"Transcoding error: {e}")
+    finally:
+        # A cancelled request keeps its marker, its output is removed on the next startup
+        input_file_path.unlink(missing_ok=True)
+    (JOBS_DIR / slug).unlink(missing_ok=True)
+    logger.info("Transcoding finished", extra={"slug": slug, "has_audio": has_audio})
 
     return {
         "message": "Multi-rendition HLS created",
@@ -157,4 +337,8 @@ async def upload_video(file: UploadFile = File(...), metadata: UploadFile | None
             {"name": "480p",  "url": f"/vod/{slug}_2/index.m3u8"},
             {"name": "360p",  "url": f"/vod/{slug}_3/index.m3u8"},
         ],
+        "audio": [
+            {"name": f"aac_{bitrate}", "url": f"/vod/{audio_dir}/index.m3u8"}
+            for audio_dir, bitrate in zip(audio_dirs, AUDIO_GROUP_BITRATES)
+        ],
     }
@@ -0,0 +1,103 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, REGISTRY
+from timing import LATENCY_BUCKETS_MS
+from logs import dropped_records
+from fastapi import Response
+from time import perf_counter
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# The same module is used by every service (copied into each service directory)
+
+# Settings of the metrics (can be set via environment variables)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))            # Queries slower than this are logged (0 = no logging)
+
+# Histogram buckets in seconds (the same bounds as the latency histograms shipped to the analytics service)
+LATENCY_BUCKETS = tuple(bound / 1000 for bound in LATENCY_BUCKETS_MS)
+
+# Metrics of the HTTP requests, per route template (e.g. /videos/{filename})
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "HTTP request duration", ["method", "route"], buckets=LATENCY_BUCKETS)
+
+# Metrics of the SQL queries, per statement type (SELECT, INSERT, ...)
+QUERY_DURATION = Histogram("db_query_duration_seconds", "SQL query duration", ["operation"], buckets=LATENCY_BUCKETS)
+SLOW_QUERIES = Counter("db_slow_queries_total", "SQL queries slower than SLOW_QUERY_MS", ["operation"])
+
+# Statement types used as labels, everything else is counted as "OTHER"
+QUERY_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "CREATE", "ALTER", "DROP"}
+
+# Records a request measured by the timing middleware (endpoint is "<method> <route template>")
+def observe_request(endpoint, status_code, latency_ms):
+    method, _, route = endpoint.partition(" ")
+    REQUESTS.labels(method, route, str(status_code)).inc()
+    REQUEST_DURATION.labels(method, route).observe(latency_ms / 1000)
+
+def query_operation(statement):
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return operation if operation in QUERY_OPERATIONS else "OTHER"
+
+# Measures every query of the engine with the cursor execute events and logs the slow ones
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None:
+            return
+        duration = perf_counter() - start
+        operation = query_operation(statement)
+        QUERY_DURATION.labels(operation).observe(duration)
+        if SLOW_QUERY_MS > 0 and duration * 1000 >= SLOW_QUERY_MS:
+            SLOW_QUERIES.labels(operation).inc()
+            # Only the statement is logged, the parameters may contain personal data
+            logger.warning("Slow query", extra={"duration_ms": round(duration * 1000, 1), "operation": operation, "statement": " ".join(statement.split())[:500]})
+
+# Exposes the state of the engine's connection pool (see db_engine.pool_status) on every scrape
+class PoolCollector:
+    GAUGES = {"size": "Connections kept in the pool", "checked_out": "Connections in use", "checked_in": "Idle connections", "overflow": "Connections above the pool size"}
+    COUNTERS = {"checkouts": "Connection checkouts", "timeouts": "Checkouts that timed out waiting for a connection", "connects": "New connections", "invalidations": "Connections found broken"}
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def collect(self):
+        from db_engine import pool_status
+        status = pool_status(self.engine)
+        for key, documentation in self.GAUGES.items():
+            if key in status:
+                yield GaugeMetricFamily(f"db_pool_{key}", documentation, value=status[key])
+        for key, documentation in self.COUNTERS.items():
+            if key in status:
+                yield CounterMetricFamily(f"db_pool_{key}", documentation, value=status[key])
+        if "wait_total_ms" in status:
+            yield CounterMetricFamily("db_pool_wait_seconds", "Time spent getting connections from the pool", value=status["wait_total_ms"] / 1000)
+        if "wait_max_ms" in status:
+            yield GaugeMetricFamily("db_pool_wait_max_seconds", "Longest connection checkout", value=status["wait_max_ms"] / 1000)
+
+# Registers a gauge whose value is read from a function on every scrape
+def add_gauge(name, documentation, function):
+    gauge = Gauge(name, documentation)
+    gauge.set_function(function)
+    return gauge
+
+# Adds the /metrics endpoint (Prometheus text format) to the app
+# recorder: the LatencyRecorder of setup_timing, engine: the SQLAlchemy engine of the service (optional)
+def setup_metrics(app, recorder, engine=None):
+    recorder.observers.append(observe_request)
+    add_gauge("log_records_dropped", "Log records dropped because the logging queue was full", dropped_records)
+    if engine is not None:
+        instrument_engine(engine)
+        REGISTRY.register(PoolCollector(engine))
+
+    def metrics():
+        return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
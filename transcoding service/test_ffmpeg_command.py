@@ -0,0 +1,124 @@
+# Tests of the FFmpeg command of the renditions (main.build_ffmpeg_command)
+# Run from this directory: python -m pytest test_ffmpeg_command.py
+# The last test runs FFmpeg itself and is skipped if it is not installed (it needs libx264 and aac).
+
+from pathlib import Path
+import subprocess
+import tempfile
+import shutil
+import re
+import os
+
+os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="transcoding-uploads-"))
+os.environ.setdefault("VOD_OUTPUT_DIR", tempfile.mkdtemp(prefix="transcoding-vod-"))
+
+import pytest
+import main
+
+SLUG = "my_video"
+
+@pytest.fixture
+def audio_mode(monkeypatch):
+    def configure(mode, bitrates=("128k",)):
+        monkeypatch.setattr(main, "HLS_AUDIO_MODE", mode)
+        monkeypatch.setattr(main, "AUDIO_GROUP_BITRATES", list(bitrates))
+    return configure
+
+def option_values(command, name):
+    return [command[position + 1] for position, argument in enumerate(command) if argument == name]
+
+def var_stream_map(command):
+    return option_values(command, "-var_stream_map")[0].split(" ")
+
+# Directories FFmpeg writes the variants to: %v is the name of the variant if it has one, its position otherwise
+def variant_dirs(command, slug=SLUG):
+    template = command[-1]
+    assert template == f"{slug}_%v/index.m3u8"
+    assert option_values(command, "-hls_segment_filename") == [f"{slug}_%v/seg_%03d.ts"]
+    dirs = []
+    for position, variant in enumerate(var_stream_map(command)):
+        fields = dict(field.split(":", 1) for field in variant.split(","))
+        dirs.append(template.replace("%v", fields.get("name", str(position))).rsplit("/", 1)[0])
+    return dirs
+
+def video_dirs(slug=SLUG):
+    return [f"{slug}_{rendition}" for rendition in range(main.RENDITION_COUNT)]
+
+def test_group_mode_writes_the_audio_to_the_audio_dirs(audio_mode):
+    audio_mode("group", ("128k", "64k"))
+    command = main.build_ffmpeg_command(Path("/in/video.mp4"), SLUG, has_audio=True)
+
+    # One AAC encode per audio rendition, not one per video variant
+    assert option_values(command, "-map").count("0:a:0") == 2
+    assert option_values(command, "-b:a:0") == ["128k"]
+    assert option_values(command, "-b:a:1") == ["64k"]
+
+    variants = var_stream_map(command)
+    assert variants[:4] == [f"v:{index},agroup:{main.AUDIO_GROUP_ID}" for index in range(4)]
+    assert variants[4:] == [
+        f"a:0,agroup:{main.AUDIO_GROUP_ID},name:audio_0,default:yes",
+        f"a:1,agroup:{main.AUDIO_GROUP_ID},name:audio_1",
+    ]
+    assert variant_dirs(command) == video_dirs() + main.audio_rendition_dirs(SLUG, True)
+    assert main.audio_rendition_dirs(SLUG, True) == [f"{SLUG}_audio_0", f"{SLUG}_audio_1"]
+
+def test_muxed_mode_pairs_one_audio_copy_with_every_variant(audio_mode):
+    audio_mode("muxed")
+    command = main.build_ffmpeg_command(Path("/in/video.mp4"), SLUG, has_audio=True)
+
+    assert option_values(command, "-map").count("0:a:0") == main.RENDITION_COUNT
+    assert [option_values(command, f"-b:a:{index}")[0] for index in range(4)] == main.MUXED_AUDIO_BITRATES
+    assert var_stream_map(command) == ["v:0,a:0", "v:1,a:1", "v:2,a:2", "v:3,a:3"]
+    assert variant_dirs(command) == video_dirs()
+    assert main.audio_rendition_dirs(SLUG, True) == []
+
+@pytest.mark.parametrize("mode", ["group", "muxed"])
+def test_without_audio_only_the_video_variants_are_written(audio_mode, mode):
+    audio_mode(mode)
+    command = main.build_ffmpeg_command(Path("/in/video.mp4"), SLUG, has_audio=False)
+
+    assert not any(value.startswith("0:a") for value in option_values(command, "-map"))
+    assert not any(argument.startswith("-c:a") for argument in command)
+    assert var_stream_map(command) == ["v:0", "v:1", "v:2", "v:3"]
+    assert variant_dirs(command) == video_dirs()
+    assert main.audio_rendition_dirs(SLUG, False) == []
+
+def test_remove_outputs_removes_the_audio_dirs(audio_mode):
+    audio_mode("group", ("128k", "64k"))
+    for directory in video_dirs() + main.audio_rendition_dirs(SLUG, True):
+        (main.OUTPUT_DIR / directory).mkdir(parents=True, exist_ok=True)
+    (main.OUTPUT_DIR / f"{SLUG}.m3u8").write_text("#EXTM3U\n")
+
+    main.remove_outputs(SLUG)
+
+    assert not [path.name for path in main.OUTPUT_DIR.iterdir() if path.name.startswith(SLUG)]
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="FFmpeg is not installed")
+def test_master_playlist_points_to_the_written_renditions(audio_mode, tmp_path):
+    audio_mode("group", ("128k", "64k"))
+    source = tmp_path / "input.mp4"
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=size=640x360:rate=24",
+        "-f", "lavfi", "-i", "sine=frequency=440", "-t", "2",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", str(source),
+    ], check=True)
+
+    # The same directories as upload_video creates
+    for directory in video_dirs() + main.audio_rendition_dirs(SLUG, True):
+        (tmp_path / directory).mkdir()
+    command = main.build_ffmpeg_command(source, SLUG, has_audio=True)
+    subprocess.run(command[:1] + ["-v", "error"] + command[1:], cwd=tmp_path, check=True)
+
+    master = (tmp_path / f"{SLUG}.m3u8").read_text()
+    media_uris = re.findall(r'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="([^"]+)".*URI="([^"]+)"', master)
+    assert [uri for _, uri in media_uris] == [f"{directory}/index.m3u8" for directory in main.audio_rendition_dirs(SLUG, True)]
+    stream_infos = re.findall(r"#EXT-X-STREAM-INF:.*\n(.+)", master)
+    assert stream_infos == [f"{directory}/index.m3u8" for directory in video_dirs()]
+    group_id = media_uris[0][0]
+    assert master.count(f'AUDIO="{group_id}"') == main.RENDITION_COUNT
+
+    # Every playlist the master refers to was written
+    for _, uri in media_uris:
+        assert (tmp_path / uri).is_file()
+    for uri in stream_infos:
+        assert (tmp_path / uri).is_file()
@@ -1,24 +1,149 @@
-from fastapi import Security, HTTPException, Depends
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+from cryptography.hazmat.primitives import serialization
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+from fastapi import Security, HTTPException
 from datetime import datetime, timedelta
 from fastapi.security import HTTPBearer
+from time import monotonic
+import threading
+import hashlib
+import secrets
 import jwt
+import logging
+import os
 
-# Secret key used to sign JWT tokens
-SECRET_KEY = "supersecretkey"
+logger = logging.getLogger(__name__)
+
+# Settings of the tokens (can be set via environment variables)
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "/etc/jwt-keys")                          # Directory of the PEM signing keys (file name = key id)
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID", "")                                  # Key id used for signing (empty = last key id by name)
+JWT_KEY_RELOAD_INTERVAL = float(os.getenv("JWT_KEY_RELOAD_INTERVAL", "60"))      # Seconds between checks of the key directory
+ACCESS_TOKEN_MINUTES = int(os.getenv("ACCESS_TOKEN_MINUTES", "60"))              # Lifetime of an access token
+REFRESH_TOKEN_DAYS = int(os.getenv("REFRESH_TOKEN_DAYS", "30"))                  # Lifetime of a refresh token
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", "300"))                             # Seconds the verifiers may cache the public keys
+JWT_ALLOW_EPHEMERAL_KEY = os.getenv("JWT_ALLOW_EPHEMERAL_KEY", "false").lower() == "true"   # Development only: sign with a generated key if none is mounted
+
+# Raised when no signing key is configured (see SigningKeyRing)
+class MissingSigningKeyError(RuntimeError):
+    pass
+
+# Signing algorithm of each supported key type
+KEY_ALGORITHMS = {Ed25519PrivateKey: ("EdDSA", OKPAlgorithm), RSAPrivateKey: ("RS256", RSAAlgorithm)}
 
 # Define the security scheme – this will automatically look for Authorization: Bearer <token> in requests
 security = HTTPBearer()
 
+def key_algorithm(private_key):
+    for key_type, algorithm in KEY_ALGORITHMS.items():
+        if isinstance(private_key, key_type):
+            return algorithm
+    raise ValueError(f"Unsupported signing key type: {type(private_key).__name__}")
+
+# The private signing keys of the service, loaded from JWT_KEYS_DIR
+#
+# Every *.pem file is a key, its name (without .pem) is the key id written into the "kid" header of the
+# tokens. Every key is published in the JWKS, but only the active one signs. Rotation:
+#   1. add the new key file (it is published, verifiers learn it within JWKS_MAX_AGE),
+#   2. make it active (JWT_ACTIVE_KID, or give it the last name),
+#   3. remove the old key file once the tokens it signed have expired (ACCESS_TOKEN_MINUTES).
+# Without key files the service refuses to start: a key generated by every process would make the tokens of
+# one replica invalid on the others and after every restart. Such an ephemeral Ed25519 key is only used in
+# development, with JWT_ALLOW_EPHEMERAL_KEY=true. If the key files disappear later, the loaded keys are kept.
+class SigningKeyRing:
+    def __init__(self, directory=JWT_KEYS_DIR, active_kid=JWT_ACTIVE_KID, reload_interval=JWT_KEY_RELOAD_INTERVAL,
+                 allow_ephemeral=JWT_ALLOW_EPHEMERAL_KEY):
+        self.directory = directory
+        self.active_kid = active_kid
+        self.reload_interval = reload_interval
+        self.allow_ephemeral = allow_ephemeral
+        self._keys = {}             # kid -> (private key, algorithm name, algorithm class)
+        self._active = None
+        self._loaded_at = None
+        self._ephemeral = None
+        self._lock = threading.Lock()
+
+    def _read_keys(self):
+        keys = {}
+        if os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                if not name.endswith(".pem"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name), "rb") as key_file:
+                        private_key = serialization.load_pem_private_key(key_file.read(), password=None)
+                    keys[name[:-len(".pem")]] = (private_key, *key_algorithm(private_key))
+                except (OSError, ValueError, TypeError) as e:
+                    logger.error("Skipping signing key %s: %s", name, e)
+        return keys
+
+    # Reloads the keys if the last load is older than the reload interval
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and monotonic() - self._loaded_at < self.reload_interval:
+            return
+        with self._lock:
+            if self._loaded_at is not None and monotonic() - self._loaded_at < self.reload_interval:
+                return
+            keys = self._read_keys()
+            if not keys and self._keys and self._ephemeral is None:
+                logger.error("No signing keys in %s any more, keeping the keys loaded before", self.directory)
+                keys = self._keys
+            elif not keys:
+                if not self.allow_ephemeral:
+                    raise MissingSigningKeyError(
+                        f"No signing keys in {self.directory}, mount the key files or set JWT_ALLOW_EPHEMERAL_KEY=true for development"
+                    )
+                if self._ephemeral is None:
+                    logger.warning("No signing keys in %s, using an ephemeral Ed25519 key (tokens do not survive a restart)", self.directory)
+                    private_key = Ed25519PrivateKey.generate()
+                    self._ephemeral = {f"ephemeral-{secrets.token_hex(4)}": (private_key, *key_algorithm(private_key))}
+                keys = self._ephemeral
+            active = self.active_kid if self.active_kid in keys else sorted(keys)[-1]
+            if active != self._active:
+                logger.info("Signing tokens with key %s", active)
+            self._keys, self._active = keys, active
+            self._loaded_at = monotonic()
+
+    # Returns (kid, private key, algorithm name) of the key that signs the new tokens
+    def active_key(self):
+        self._ensure_loaded()
+        private_key, algorithm, _ = self._keys[self._active]
+        return self._active, private_key, algorithm
+
+    # Returns (public key, algorithm name) of a key id, or None if the key is unknown
+    def public_key(self, kid):
+        self._ensure_loaded()
+        entry = self._keys.get(kid)
+        if entry is None:
+            return None
+        return entry[0].public_key(), entry[1]
+
+    # Public keys in JWKS format (RFC 7517)
+    def jwks(self):
+        self._ensure_loaded()
+        keys = []
+        for kid, (private_key, algorithm, algorithm_class) in self._keys.items():
+            jwk = algorithm_class.to_jwk(private_key.public_key(), as_dict=True)
+            keys.append({**jwk, "kid": kid, "alg": algorithm, "use": "sig"})
+        return {"keys": keys}
+
+# Shared key ring used by the API endpoints
+signing_keys = SigningKeyRing()
+
 # Function to create a JWT token
 def create_token(data: dict):
-    # Prepare the payload with additional expiration time (1 hour from now)
+    kid, private_key, algorithm = signing_keys.active_key()
+    now = datetime.utcnow()
+
+    # Prepare the payload with additional issue and expiration time
     payload = {
         **data,
-        "exp": datetime.utcnow() + timedelta(hours=1)  # Token expiration time
+        "iat": now,
+        "exp": now + timedelta(minutes=ACCESS_TOKEN_MINUTES)  # Token expiration time
     }
 
-    # Encode the token using HS256 algorithm and the secret key
-    token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
+    # Sign the token with the active private key, the kid header tells the verifiers which public key to use
+    token = jwt.encode(payload, private_key, algorithm=algorithm, headers={"kid": kid})
     return token
 
 # Function to verify the validity of a JWT token
@@ -27,16 +152,26 @@ def verify_token(credentials: HTTPBearer = Security(security)):
     token = credentials.credentials
 
     try:
-        # Decode and verify the token using the secret key
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        # Find the public key of the token's signing key
+        key = signing_keys.public_key(jwt.get_unverified_header(token).get("kid"))
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown signing key")
+
+        # Decode and verify the token with the public key (only the algorithm of the key is accepted)
+        payload = jwt.decode(token, key[0], algorithms=[key[1]])
         return payload # Return the decoded payload if token is valid
     except jwt.ExpiredSignatureError:
         # Raised when the token has expired
-        print("Token expired")  # Log that the token expired
+        logger.info("Token expired")  # Log that the token expired
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         # Raised when the token is invalid (e.g. tampered or wrong signature)
-        print("Invalid token")  # Log that the token is invalid
+        logger.info("Invalid token")  # Log that the token is invalid
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Refresh tokens are random strings, only their SHA-256 hash is stored
+def new_refresh_token():
+    return secrets.token_urlsafe(32)
 
+def hash_refresh_token(token: str):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
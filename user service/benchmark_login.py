@@ -0,0 +1,77 @@
+# Benchmark of the login password verification under a burst
+# Usage: python benchmark_login.py [logins] [request_threads]
+# No database is needed: every simulated login verifies an Argon2 hash, like POST /login does.
+#
+# Compares hashing directly on the request threads (every request hashes at once) with the
+# bounded hashing pool of passwords.py, and measures how responsive a cheap request stays meanwhile.
+
+from concurrent.futures import ThreadPoolExecutor
+from passwords import PasswordService, PasswordHasherBusy
+from time import perf_counter, sleep
+import threading
+import sys
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+
+# Measures the latency of a cheap request (a few microseconds of work) every 10 ms until stopped
+def probe(stop, latencies):
+    while not stop.is_set():
+        start = perf_counter()
+        sum(range(1000))
+        latencies.append(perf_counter() - start)
+        sleep(0.01)
+
+def run_burst(name, login, logins, request_threads):
+    latencies, probe_latencies, rejected = [], [], [0]
+    lock = threading.Lock()
+
+    def request():
+        start = perf_counter()
+        try:
+            login()
+        except PasswordHasherBusy:
+            with lock:
+                rejected[0] += 1
+            return
+        with lock:
+            latencies.append(perf_counter() - start)
+
+    stop = threading.Event()
+    probe_thread = threading.Thread(target=probe, args=(stop, probe_latencies))
+    probe_thread.start()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=request_threads) as pool:
+        for _ in range(logins):
+            pool.submit(request)
+    elapsed = perf_counter() - start
+    stop.set()
+    probe_thread.join()
+
+    print(f"{name}:")
+    print(f"  {len(latencies)} logins in {elapsed:.2f} s ({len(latencies) / elapsed:.1f} logins/s), {rejected[0]} rejected (503)")
+    print(f"  login latency: p50 {percentile(latencies, 50):.0f} ms, p99 {percentile(latencies, 99):.0f} ms")
+    print(f"  cheap request latency: p50 {percentile(probe_latencies, 50):.2f} ms, p99 {percentile(probe_latencies, 99):.2f} ms")
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    request_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 40 # Default thread pool size of FastAPI sync routes
+
+    service = PasswordService()
+    service.calibrate()
+    stored = service.hasher.hash("correct horse battery staple")
+
+    # Single login without contention
+    start = perf_counter()
+    service.verify("correct horse battery staple", stored)
+    print(f"Single verification: {(perf_counter() - start) * 1000:.0f} ms")
+
+    run_burst("Hashing on the request threads", lambda: service._verify("correct horse battery staple", stored), logins, request_threads)
+    run_burst("Bounded hashing pool", lambda: service.verify("correct horse battery staple", stored), logins, request_threads)
+    service.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from time import monotonic
+import threading
+import logging
+import signal
+import os
+
+logger = logging.getLogger(__name__)
+
+# The same module is used by every service (copied into each service directory)
+
+# Settings of the graceful shutdown (can be set via environment variables)
+SHUTDOWN_DRAIN_DELAY = float(os.getenv("SHUTDOWN_DRAIN_DELAY", "5"))        # Seconds the pod reports not-ready but keeps serving after SIGTERM
+SHUTDOWN_GRACE_PERIOD = float(os.getenv("SHUTDOWN_GRACE_PERIOD", "25"))     # Seconds the in-flight work may take after the drain delay
+
+# Graceful shutdown on SIGTERM
+#
+# Kubernetes sends SIGTERM and removes the pod from the service endpoints at the same time, so requests
+# may still arrive for a few seconds. On SIGTERM the readiness probe fails at once, the requests are
+# still served for SHUTDOWN_DRAIN_DELAY, and only then is the signal passed on to uvicorn, which stops
+# accepting connections, waits for the running requests and runs the shutdown handlers (they drain the
+# buffered writes). Work that is still running SHUTDOWN_GRACE_PERIOD later is stopped by the deadline
+# callbacks. terminationGracePeriodSeconds of the pod must be longer than the two together.
+class GracefulShutdown:
+    def __init__(self, drain_delay=SHUTDOWN_DRAIN_DELAY, grace_period=SHUTDOWN_GRACE_PERIOD):
+        self.drain_delay = drain_delay
+        self.grace_period = grace_period
+        self.draining = threading.Event()
+        self._deadline = None
+        self._deadline_callbacks = []
+        self._previous_handler = None
+
+    # Takes over SIGTERM (call from the startup handler, after uvicorn installed its own handler)
+    def install(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        handler = signal.getsignal(signal.SIGTERM)
+        if handler == self._handle_sigterm:
+            return
+        self._previous_handler = handler
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+
+    # Registers a function that is called when the grace period is over (e.g. to stop running jobs)
+    def on_deadline(self, callback):
+        self._deadline_callbacks.append(callback)
+
+    def is_draining(self):
+        return self.draining.is_set()
+
+    # Seconds left of the grace period (None before SIGTERM)
+    def time_left(self):
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - monotonic())
+
+    def _handle_sigterm(self, signum, frame):
+        if self.draining.is_set():
+            # A second SIGTERM skips the rest of the drain delay
+            self._forward(signum, frame)
+            return
+        self.start_draining()
+        timer = threading.Timer(self.drain_delay, self._forward, (signum, frame))
+        timer.daemon = True
+        timer.start()
+
+    # Marks the service not-ready and starts the grace period
+    def start_draining(self):
+        if self.draining.is_set():
+            return
+        self.draining.set()
+        self._deadline = monotonic() + self.drain_delay + self.grace_period
+        logger.info("Shutdown requested, draining", extra={"drain_delay": self.drain_delay, "grace_period": self.grace_period})
+        timer = threading.Timer(self.drain_delay + self.grace_period, self._run_deadline_callbacks)
+        timer.daemon = True
+        timer.start()
+
+    def _forward(self, signum, frame):
+        handler, self._previous_handler = self._previous_handler, None
+        if callable(handler):
+            handler(signum, frame)
+        elif handler is not None and handler != signal.SIG_IGN:
+            # No server handler (e.g. run without uvicorn): exit the default way
+            signal.signal(signum, signal.SIG_DFL)
+            signal.raise_signal(signum)
+
+    def _run_deadline_callbacks(self):
+        for callback in self._deadline_callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Shutdown deadline callback failed")
+
+# Shared shutdown state of the service
+graceful_shutdown = GracefulShutdown()
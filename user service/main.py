@@ -1,12 +1,22 @@
 from fastapi.middleware.cors import CORSMiddleware
-from database import init_db
-from fastapi import FastAPI
+from database import init_db, engine
+from db_engine import pool_status
+from fastapi import FastAPI, Response
 from routes import router
+from logs import setup_logging
+from timing import setup_timing
+from metrics import setup_metrics
+from passwords import password_service
+from graceful import graceful_shutdown
+from auth import signing_keys
 #import ssl
 
 # Create the FastAPI app instance
 app = FastAPI()
 
+# Structured JSON logging through a background queue, every request gets an id
+setup_logging("user-service", app)
+
 # if __name__ == "__main__":
 #     ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
 #     ssl_context.load_cert_chain(certfile="/path/to/fullchain.pem", keyfile="/path/to/privkey.pem")
@@ -26,6 +36,12 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers (e.g., Authorization, Content-Type)
 )
 
+# Measure every request and ship the latency histograms to the analytics service in batches
+recorder = setup_timing(app, "user-service")
+
+# Expose the request, SQL query and connection pool metrics on /metrics (Prometheus format)
+setup_metrics(app, recorder, engine)
+
 # Include all routes defined in the router
 app.include_router(router)
 
@@ -33,9 +49,36 @@ app.include_router(router)
 @app.on_event("startup")
 def startup():
     init_db() # Creates tables if they don't exist
+    signing_keys.active_key() # Fails the startup if no signing key is mounted
+    password_service.calibrate() # Choose the password hashing cost before the first login
+    graceful_shutdown.install() # SIGTERM: report not-ready first, then stop (see graceful.py)
+
+# Let the running password hashes finish before the application stops
+@app.on_event("shutdown")
+def shutdown():
+    password_service.shutdown()
+    engine.dispose() # Close the pooled database connections
 
 # Default root endpoint to verify the service is running
 @app.get("/")
 def read_root():
     return {"message": "User Service is up and running!"}
 
+# Liveness probe: the process is up and able to answer requests
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+# Readiness probe: fails as soon as the pod starts shutting down, so no new requests are routed here
+@app.get("/health/ready")
+def readiness(response: Response):
+    ready = not graceful_shutdown.is_draining()
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready}
+
+# Connection pool of the service: live checkouts and the time requests wait for a connection
+@app.get("/health/db-pool")
+def db_pool():
+    return pool_status(engine)
+
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
 from datetime import datetime
 from database import Base 
 
@@ -21,3 +21,21 @@ class User(Base):
     # Hashed password of the user - cannot be null
     hashed_password = Column(String, nullable=False)
 
+# Refresh tokens of the users, a new access token can be requested with them without logging in again
+# Only the SHA-256 hash of the token is stored, and every token can be used once (it is replaced on use)
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    # Owner of the token
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
+
+    # SHA-256 hash of the token
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+    # Set when the token was used or revoked (logout)
+    revoked_at = Column(DateTime, nullable=True)
@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+from argon2.exceptions import VerificationError, InvalidHashError
+from argon2 import PasswordHasher, extract_parameters
+from time import perf_counter
+import threading
+import bcrypt
+import hmac
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Settings of the password hashing (can be set via environment variables)
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))   # Threads that hash passwords
+HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))                     # Hashes running or waiting at once
+HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "2"))                # Seconds a request waits for a free slot
+HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", "100"))                      # Calibration target of one hash
+HASH_MEMORY_KIB = int(os.getenv("PASSWORD_HASH_MEMORY_KIB", "19456"))                    # Argon2 memory cost (19 MiB)
+HASH_TIME_COST = int(os.getenv("PASSWORD_HASH_TIME_COST", "0"))                          # Argon2 iterations (0 = calibrate)
+
+# Lowest number of Argon2 iterations used, even if the target latency would allow less
+MIN_TIME_COST = 2
+MAX_TIME_COST = 20
+
+# Raised when every hashing slot is taken (the caller should retry later)
+class PasswordHasherBusy(Exception):
+    pass
+
+def is_bcrypt_hash(stored):
+    return stored.startswith(("$2a$", "$2b$", "$2y$"))
+
+def is_argon2_hash(stored):
+    return stored.startswith("$argon2")
+
+# Argon2id password hashing on a dedicated, bounded thread pool
+#
+# Hashing is CPU heavy on purpose, so it does not run on the request threads: at most HASH_WORKERS hashes
+# run at the same time and at most HASH_MAX_PENDING requests wait for one. Beyond that the request is
+# rejected right away instead of queueing without limit (PasswordHasherBusy -> 503).
+# Older bcrypt hashes and plaintext passwords are still accepted, and need_rehash() tells the caller
+# to replace them after a successful login.
+class PasswordService:
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, queue_timeout=HASH_QUEUE_TIMEOUT):
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._hasher = None
+        self._dummy_hash = None
+        self._calibrate_lock = threading.Lock()
+
+    # Chooses the Argon2 iterations so one hash takes about HASH_TARGET_MS on this machine
+    # PASSWORD_HASH_TIME_COST skips the calibration (use it to keep every replica on the same cost)
+    def calibrate(self, target_ms=HASH_TARGET_MS, memory_kib=HASH_MEMORY_KIB):
+        with self._calibrate_lock:
+            if self._hasher is not None:
+                return self._hasher.time_cost
+            time_cost = HASH_TIME_COST
+            if time_cost <= 0:
+                time_cost = MIN_TIME_COST
+                while time_cost < MAX_TIME_COST:
+                    start = perf_counter()
+                    PasswordHasher(time_cost=time_cost, memory_cost=memory_kib, parallelism=1).hash("calibration")
+                    elapsed_ms = (perf_counter() - start) * 1000
+                    if elapsed_ms >= target_ms:
+                        break
+                    # The time grows linearly with the iterations, jump close to the target
+                    time_cost = min(MAX_TIME_COST, max(time_cost + 1, int(time_cost * target_ms / max(elapsed_ms, 0.1))))
+            self._hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_kib, parallelism=1)
+            # Verified when the user does not exist, so the response time does not reveal it
+            self._dummy_hash = self._hasher.hash("dummy password")
+            logger.info("Password hashing: argon2id", extra={"time_cost": time_cost, "memory_cost_kib": memory_kib})
+            return time_cost
+
+    @property
+    def hasher(self):
+        if self._hasher is None:
+            self.calibrate()
+        return self._hasher
+
+    # Runs a function on the hashing pool and waits for its result
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise PasswordHasherBusy("Too many password operations in progress")
+        try:
+            return self._executor.submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def _verify(self, password, stored):
+        if stored is None:
+            # Unknown user: do the same work as for a real one
+            try:
+                self.hasher.verify(self._dummy_hash, password + "x")
+            except VerificationError:
+                pass
+            return False
+        if is_argon2_hash(stored):
+            try:
+                return self.hasher.verify(stored, password)
+            except (VerificationError, InvalidHashError):
+                return False
+        if is_bcrypt_hash(stored):
+            try:
+                return bcrypt.checkpw(password.encode("utf-8"), stored.encode("utf-8"))
+            except ValueError:
+                return False
+        # Plaintext password from before hashing was enabled
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+
+    # Returns the hash of the password (computed on the hashing pool)
+    def hash(self, password):
+        return self._run(self.hasher.hash, password)
+
+    # Checks the password against the stored value (pass None for an unknown user)
+    def verify(self, password, stored):
+        return self._run(self._verify, password, stored)
+
+    # True if the stored value should be replaced with a new hash (plaintext, bcrypt, or weaker Argon2 parameters)
+    # Only weaker parameters count, so replicas calibrated to slightly different costs don't rehash each other's hashes
+    def needs_rehash(self, stored):
+        if not is_argon2_hash(stored):
+            return True
+        try:
+            parameters = extract_parameters(stored)
+        except InvalidHashError:
+            return True
+        return parameters.time_cost < self.hasher.time_cost or parameters.memory_cost < self.hasher.memory_cost
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+# Shared password service used by the API endpoints
+password_service = PasswordService()
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
+from typing import List, Optional
 
 # This model defines the shape of the response data when returning user information
 class UserResponse(BaseModel):
@@ -8,6 +9,27 @@ class UserResponse(BaseModel):
     email: str # User's email address
     registration_date: datetime # The date and time the user registered
 
-    class Config:
-        orm_mode = True  # Enables compatibility with ORM objects like SQLAlchemy models
-                         # This allows returning SQLAlchemy objects directly from FastAPI routes
+    model_config = ConfigDict(from_attributes=True)  # Enables compatibility with ORM objects like SQLAlchemy models
+                                                     # This allows returning SQLAlchemy objects directly from FastAPI routes
+
+# Public profile of a user (no email address or password hash), used by the listing and the batch lookup
+class UserProfile(BaseModel):
+    id: int # Unique identifier of the user
+    username: str # User's username
+    registration_date: Optional[datetime] = None # The date and time the user registered
+
+    model_config = ConfigDict(from_attributes=True)
+
+# One page of the user listing, pass next_cursor to get the next page (None on the last page)
+class UserPage(BaseModel):
+    users: List[UserProfile]
+    next_cursor: Optional[str] = None
+
+# Input of the batch lookup: the ids of the users to return
+class UserBatchRequest(BaseModel):
+    ids: List[int]
+
+# Result of the batch lookup: the found users in the order of the requested ids, and the ids that were not found
+class UserBatchResponse(BaseModel):
+    users: List[UserProfile]
+    missing: List[int]
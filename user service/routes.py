@@ -1,15 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException
-from auth import create_token, verify_token
-from passlib.context import CryptContext
-from pydantic_models import UserResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from auth import create_token, verify_token, signing_keys, new_refresh_token, hash_refresh_token
+from auth import ACCESS_TOKEN_MINUTES, REFRESH_TOKEN_DAYS, JWKS_MAX_AGE
+from passwords import password_service, PasswordHasherBusy
+from pydantic_models import UserResponse, UserProfile, UserPage, UserBatchRequest, UserBatchResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Optional
 from database import get_db
-from models import User
+from models import User, RefreshToken
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter() # Creating a router for organizing the API routes
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto") # Password hashing configuration
+
+# Maximum number of users returned by one listing page or requested in one batch lookup
+MAX_PAGE_SIZE = 1000
+
+# Hashes or verifies a password on the bounded hashing pool (503 if it is saturated)
+def run_password_operation(operation, *args):
+    try:
+        return operation(*args)
+    except PasswordHasherBusy as e:
+        logger.warning("Password hashing is saturated: %s", e)
+        raise HTTPException(status_code=503, detail="Server is busy, please try again", headers={"Retry-After": "1"})
 
 # Input models
 class RegisterInput(BaseModel):
@@ -21,6 +36,26 @@ class LoginInput(BaseModel):
     username: str
     password: str
 
+class RefreshInput(BaseModel):
+    refresh_token: str
+
+# Creates an access token and a new refresh token for the user (the refresh token is committed by the caller)
+def issue_tokens(db: Session, user: User):
+    refresh_token = new_refresh_token()
+    now = datetime.utcnow()
+    db.add(RefreshToken(
+        user_id=user.id,
+        token_hash=hash_refresh_token(refresh_token),
+        created_at=now,
+        expires_at=now + timedelta(days=REFRESH_TOKEN_DAYS),
+    ))
+    return {
+        "access_token": create_token({"user_id": user.id, "username": user.username}),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_MINUTES * 60,
+        "refresh_token": refresh_token,
+    }
+
 # Register API endpoint for user registration
 @router.post("/register")
 def register(input: RegisterInput, db: Session = Depends(get_db)):
@@ -30,9 +65,7 @@ def register(input: RegisterInput, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Hash the user's password before saving it
-    # hashed_password = pwd_context.hash(input.password)
-
-    hashed_password = input.password
+    hashed_password = run_password_operation(password_service.hash, input.password)
     
     # Create a new user instance
     user = User(
@@ -47,7 +80,7 @@ def register(input: RegisterInput, db: Session = Depends(get_db)):
     db.commit()
 
     # Log the succesfull registartion
-    print(f"Successfull registartion for user: {input.username}")
+    logger.info("Successful registration", extra={"username": input.username})
 
     # Return a success message
     return {"message": "User created successfully"}
@@ -56,39 +89,118 @@ def register(input: RegisterInput, db: Session = Depends(get_db)):
 @router.post("/login")
 def login(input: LoginInput, db: Session = Depends(get_db)):
     # Log the login attempt with username
-    print(f"Login attempt for user: {input.username}")
+    logger.info("Login attempt", extra={"username": input.username})
     
     # Find user by username
     user = db.query(User).filter(User.username == input.username).first()
+
+    # Verify the password (an unknown user costs the same time, so the response does not reveal it)
+    verified = run_password_operation(password_service.verify, input.password, user.hashed_password if user else None)
     if not user:
-        print("User not found")
+        logger.info("Login failed: user not found", extra={"username": input.username})
         raise HTTPException(status_code=400, detail="Invalid credentials")
-    
-    # Verify the password
-    #if not pwd_context.verify(input.password, user.hashed_password):
-    #    print("Password mismatch")
-    #    raise HTTPException(status_code=400, detail="Invalid credentials")
-
-    if input.password != user.hashed_password:
-        print("Password mismatch")
+    if not verified:
+        logger.info("Login failed: password mismatch", extra={"username": input.username})
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
     # Log the succesfull password verification
-    print("Password verified")
+    logger.info("Password verified", extra={"username": input.username})
+
+    # Replace plaintext, bcrypt and weaker hashes now that the password is known
+    if password_service.needs_rehash(user.hashed_password):
+        try:
+            user.hashed_password = password_service.hash(input.password)
+            db.commit()
+            logger.info("Password rehashed", extra={"username": input.username})
+        except PasswordHasherBusy:
+            pass # Rehashed on a later login
+
+    # Create a JWT token and a refresh token
+    tokens = issue_tokens(db, user)
+    db.commit()
 
-    # Create a JWT token
-    token = create_token({"user_id": user.id, "username": user.username})
+    # Return the tokens to the client
+    return tokens
 
-    # Return the access token to the client
-    return {"access_token": token}
+# Refresh API endpoint: exchanges a refresh token for a new access token and a new refresh token
+# Costs a few indexed queries instead of a password hash. Every refresh token can be used only once:
+# using it again means it was stolen, so every refresh token of the user is revoked.
+@router.post("/token/refresh")
+def refresh_token(input: RefreshInput, db: Session = Depends(get_db)):
+    now = datetime.utcnow()
+    stored = db.query(RefreshToken).filter(RefreshToken.token_hash == hash_refresh_token(input.refresh_token)).first()
+    if not stored or stored.expires_at <= now:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
 
-# Users API endpoint to get all registered users
-@router.get("/users")
-def get_users(db: Session = Depends(get_db)):
-    # Query all users in the database
-    users = db.query(User).all()
-    # Return list of users  
-    return users
+    # Mark the token used, the condition lets only one of two concurrent requests succeed
+    used = db.query(RefreshToken).filter(RefreshToken.id == stored.id, RefreshToken.revoked_at.is_(None)).update(
+        {"revoked_at": now}, synchronize_session=False
+    )
+    if not used:
+        db.query(RefreshToken).filter(RefreshToken.user_id == stored.user_id, RefreshToken.revoked_at.is_(None)).update(
+            {"revoked_at": now}, synchronize_session=False
+        )
+        db.commit()
+        logger.warning("Reused refresh token, every session of the user is revoked", extra={"user_id": stored.user_id})
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    user = db.query(User).filter(User.id == stored.user_id).first()
+    if not user:
+        db.commit()
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    tokens = issue_tokens(db, user)
+    db.commit()
+    return tokens
+
+# Revoke API endpoint (logout): the refresh token can't be used anymore
+@router.post("/token/revoke")
+def revoke_token(input: RefreshInput, db: Session = Depends(get_db)):
+    db.query(RefreshToken).filter(
+        RefreshToken.token_hash == hash_refresh_token(input.refresh_token), RefreshToken.revoked_at.is_(None)
+    ).update({"revoked_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return {"message": "Token revoked"}
+
+# JWKS API endpoint: the public keys the other services verify the access tokens with
+# The keys change rarely, so the verifiers (and proxies) may cache the response
+@router.get("/.well-known/jwks.json")
+def jwks(response: Response):
+    response.headers["Cache-Control"] = f"public, max-age={JWKS_MAX_AGE}"
+    return signing_keys.jwks()
+
+# Users API endpoint to list the registered users page by page (public profiles only)
+# Keyset pagination on the id: the cursor is the id of the last user of the previous page
+@router.get("/users", response_model=UserPage)
+def get_users(cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    query = db.query(User.id, User.username, User.registration_date)
+    if cursor:
+        try:
+            query = query.filter(User.id > int(cursor))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # One extra row tells whether there is a next page
+    users = query.order_by(User.id).limit(limit + 1).all()
+    next_cursor = str(users[limit - 1].id) if len(users) > limit else None
+    return {"users": users[:limit], "next_cursor": next_cursor}
+
+# Batch lookup API endpoint: returns the public profiles of many users with one query
+# (e.g. to show the current usernames of a page of comments)
+@router.post("/users/batch", response_model=UserBatchResponse)
+def get_users_batch(input: UserBatchRequest, db: Session = Depends(get_db)):
+    if len(input.ids) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} ids can be requested at once")
+
+    ids = list(dict.fromkeys(input.ids)) # Unique ids in the requested order
+    found = {
+        user.id: user
+        for user in db.query(User.id, User.username, User.registration_date).filter(User.id.in_(ids)).all()
+    } if ids else {}
+    return {
+        "users": [found[user_id] for user_id in ids if user_id in found],
+        "missing": [user_id for user_id in ids if user_id not in found],
+    }
 
 # Cureent user API endpoint to get all information about the logged in user
 @router.get("/get_current_user", response_model=UserResponse)  # Return using the user datamodel
@@ -133,8 +245,12 @@ def edit_profile(input: RegisterInput, payload: dict = Depends(verify_token), db
         user.email = input.email
 
     # Check if password has been provided and is different, then hash and update it
-    if input.password and not pwd_context.verify(input.password, user.hashed_password):
-        user.hashed_password = pwd_context.hash(input.password)
+    if input.password and not run_password_operation(password_service.verify, input.password, user.hashed_password):
+        user.hashed_password = run_password_operation(password_service.hash, input.password)
+        # Sessions started with the old password can't be renewed anymore
+        db.query(RefreshToken).filter(RefreshToken.user_id == user.id, RefreshToken.revoked_at.is_(None)).update(
+            {"revoked_at": datetime.utcnow()}, synchronize_session=False
+        )
 
     # Commit the changes to the database
     db.commit()
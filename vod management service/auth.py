@@ -1,25 +1,96 @@
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Request, HTTPException, Depends
-from datetime import datetime, timedelta
+from time import monotonic
+import threading
+import requests
 import jwt
+import logging
+import os
 
-# Secret key used to sign and verify JWT tokens
-SECRET_KEY = "supersecretkey"
+logger = logging.getLogger(__name__)
+
+# Settings of the token verification (can be set via environment variables)
+JWKS_URL = os.getenv("JWKS_URL", "http://user-service:80/.well-known/jwks.json")   # Public keys of the user service
+JWKS_CACHE_SECONDS = float(os.getenv("JWKS_CACHE_SECONDS", "300"))                # Seconds the fetched keys are used without refetching
+JWKS_MIN_REFETCH_SECONDS = float(os.getenv("JWKS_MIN_REFETCH_SECONDS", "30"))     # Minimum seconds between fetches for unknown key ids
+JWKS_TIMEOUT = float(os.getenv("JWKS_TIMEOUT", "2"))                              # Seconds to wait for the user service
+
+# Only asymmetric algorithms are accepted, the services share no secret
+ALLOWED_ALGORITHMS = {"EdDSA", "RS256"}
 
 # HTTPBearer defines the expected authentication scheme (Bearer token in Authorization header)
 security = HTTPBearer()
 
+# Public keys of the user service, fetched from its JWKS endpoint
+#
+# The keys are fetched once and cached, so a token is verified locally without calling the user service.
+# A token signed with an unknown key id (after a key rotation) triggers a refetch, but at most once per
+# JWKS_MIN_REFETCH_SECONDS, so tokens with made-up key ids can't flood the user service.
+class JwksKeyCache:
+    def __init__(self, url=JWKS_URL, cache_seconds=JWKS_CACHE_SECONDS, min_refetch_seconds=JWKS_MIN_REFETCH_SECONDS):
+        self.url = url
+        self.cache_seconds = cache_seconds
+        self.min_refetch_seconds = min_refetch_seconds
+        self._keys = {}             # kid -> jwt.PyJWK
+        self._fetched_at = None     # Time of the last successful fetch
+        self._attempted_at = None   # Time of the last fetch attempt
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _since(timestamp):
+        return monotonic() - timestamp if timestamp is not None else float("inf")
+
+    def _fetch(self):
+        self._attempted_at = monotonic()
+        response = requests.get(self.url, timeout=JWKS_TIMEOUT)
+        response.raise_for_status()
+        keys = {}
+        for data in response.json().get("keys", []):
+            if data.get("alg") not in ALLOWED_ALGORITHMS or not data.get("kid"):
+                continue
+            try:
+                keys[data["kid"]] = jwt.PyJWK(data)
+            except jwt.PyJWTError as e:
+                logger.error("Skipping JWKS key %s: %s", data.get("kid"), e)
+        self._keys = keys
+        self._fetched_at = monotonic()
+
+    # Returns the key of a key id, or None if the user service does not publish it
+    def get(self, kid):
+        key = self._keys.get(kid)
+        if key is not None and self._since(self._fetched_at) < self.cache_seconds:
+            return key
+        with self._lock:
+            key = self._keys.get(kid)
+            stale = self._since(self._fetched_at) >= self.cache_seconds
+            # Another request may have fetched the keys while this one waited
+            if (stale or key is None) and self._since(self._attempted_at) >= self.min_refetch_seconds:
+                try:
+                    self._fetch()
+                except (requests.RequestException, ValueError) as e:
+                    # The cached keys stay in use while the user service is unreachable
+                    logger.warning("Failed to fetch the JWKS from %s: %s", self.url, e)
+            return self._keys.get(kid)
+
+# Shared key cache used by the API endpoints
+jwks_keys = JwksKeyCache()
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    
+
     # Validates a JWT token provided in the Authorization header using Bearer scheme.
 
     try:
-        # Decode and verify the JWT using the shared secret and the HS256 algorithm
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=["HS256"])
+        # Find the public key the token was signed with
+        key = jwks_keys.get(jwt.get_unverified_header(credentials.credentials).get("kid"))
+        if key is None:
+            raise jwt.InvalidTokenError("Unknown signing key")
+
+        # Decode and verify the JWT locally with the public key (only the algorithm of the key is accepted)
+        payload = jwt.decode(credentials.credentials, key.key, algorithms=[key.algorithm_name])
         return payload  # Return the token's decoded payload (e.g., user info, roles, expiry)
     except jwt.ExpiredSignatureError:
         # Token is expired
         raise HTTPException(status_code=401, detail="Token has expired.")
     except jwt.InvalidTokenError:
         # Token is malformed or signature doesn't match
-        raise HTTPException(status_code=401, detail="Invalid token.")    
+        raise HTTPException(status_code=401, detail="Invalid token.")
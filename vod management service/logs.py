@@ -0,0 +1,154 @@
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+from contextvars import ContextVar
+import logging
+import random
+import atexit
+import queue
+import uuid
+import json
+import sys
+import os
+
+# The same module is used by every service (copied into each service directory)
+
+# Settings of the logging (can be set via environment variables)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()                              # Lowest level that is written
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))                      # Records waiting to be written before new ones are dropped
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "true").lower() == "true"              # Apply the sample rates of high-volume messages
+
+# Id of the request being served (set by RequestIdMiddleware, added to every record logged during the request)
+request_id_var = ContextVar("request_id", default=None)
+
+# Header that carries the request id between the services
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Attributes of every LogRecord, the other attributes (passed with extra={...}) become JSON fields
+RESERVED_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName", "request_id", "sample_rate"}
+
+# Writes one JSON object per record
+class JsonFormatter(logging.Formatter):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "service": self.service,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if getattr(record, "sample_rate", None) is not None:
+            entry["sample_rate"] = record.sample_rate
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+# Keeps a record logged with extra={"sample_rate": r} with probability r (e.g. 0.01 = about every 100th)
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        sample_rate = getattr(record, "sample_rate", None)
+        return not LOG_SAMPLING or sample_rate is None or random.random() < sample_rate
+
+# Adds the id of the current request to the record (runs on the thread that logs)
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+# Puts the records on a bounded queue, a listener thread writes them to stdout
+# The caller never waits for the output: when the queue is full the record is dropped and counted.
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Resolves the message and the traceback on the calling thread, the other attributes are kept for the JSON fields
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_listener = None
+_handler = None
+
+# Routes the logging of the process (including uvicorn) through the queue as JSON lines
+def setup_logging(service, app=None):
+    global _listener, _handler
+    if _listener is None:
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter(service))
+        _handler = NonBlockingQueueHandler(log_queue)
+        _handler.addFilter(SamplingFilter())
+        _handler.addFilter(RequestIdFilter())
+
+        root = logging.getLogger()
+        root.handlers = [_handler]
+        root.setLevel(LOG_LEVEL)
+        # uvicorn configures its own handlers before the app is imported
+        for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+            logging.getLogger(name).handlers = []
+            logging.getLogger(name).propagate = True
+
+        _listener = QueueListener(log_queue, output)
+        _listener.start()
+        # Write the queued records before the process exits
+        atexit.register(_listener.stop)
+    if app is not None:
+        app.add_middleware(RequestIdMiddleware)
+
+# Number of records dropped because the queue was full
+def dropped_records():
+    return _handler.dropped if _handler is not None else 0
+
+# Headers that pass the current request id on to another service
+def request_id_headers():
+    request_id = request_id_var.get()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+# ASGI middleware that gives every request an id (taken from the X-Request-ID header if it is valid)
+# and returns it in the response
+class RequestIdMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        if not request_id or len(request_id) > 128 or not request_id.isprintable():
+            request_id = uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
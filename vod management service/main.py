@@ -1,11 +1,19 @@
 from fastapi.middleware.cors import CORSMiddleware
-from database import init_db
-from fastapi import FastAPI
-from routes import router
+from routes import router, start_background_sync, stop_background_sync, sync_state
+from fastapi import FastAPI, Response
+from database import is_db_initialized, engine
+from db_engine import pool_status
+from logs import setup_logging
+from timing import setup_timing
+from metrics import setup_metrics
+from graceful import graceful_shutdown
 
 # Create a new FastAPI application instance
 app = FastAPI()
 
+# Structured JSON logging through a background queue, every request gets an id
+setup_logging("vod-management-service", app)
+
 # Configure CORS (Cross-Origin Resource Sharing) middleware
 # This allows frontend applications (e.g., on a different port) to interact with this API
 app.add_middleware(
@@ -21,16 +29,48 @@ app.add_middleware(
     allow_headers=["*"],     # Allow all headers
 )
 
+# Measure every request and ship the latency histograms to the analytics service in batches
+recorder = setup_timing(app, "vod-management-service")
+
+# Expose the request, SQL query and connection pool metrics on /metrics (Prometheus format)
+setup_metrics(app, recorder, engine)
+
 # Include all API routes from the external router module
 app.include_router(router)
 
 # This function runs automatically when the application starts
-# Used here to initialize the database (e.g., create tables)
+# Schema creation and the catalog sync run in the background, so startup returns immediately
 @app.on_event("startup")
 def startup():
-    init_db()
+    start_background_sync()
+    graceful_shutdown.install() # SIGTERM: report not-ready first, then stop (see graceful.py)
+
+# Stop the catalog sync retries and close the pooled database connections
+@app.on_event("shutdown")
+def shutdown():
+    stop_background_sync(timeout=graceful_shutdown.time_left())
+    engine.dispose()
 
 # Basic root API endpoint, useful as a health check
 @app.get("/")
 def read_root():
-    return {"message": "VOD Management Service is up and running!"}
\ No newline at end of file
+    return {"message": "VOD Management Service is up and running!"}
+
+# Liveness probe: the process is up and able to answer requests
+@app.get("/health/live")
+def liveness():
+    return {"status": "alive"}
+
+# Readiness probe: the database schema exists and the pod is not shutting down, so requests can be served
+# The state of the catalog sync is reported alongside (it keeps retrying in the background)
+@app.get("/health/ready")
+def readiness(response: Response):
+    ready = is_db_initialized() and not graceful_shutdown.is_draining()
+    if not ready:
+        response.status_code = 503
+    return {"ready": ready, "sync": sync_state}
+
+# Connection pool of the service: live checkouts and the time requests wait for a connection
+@app.get("/health/db-pool")
+def db_pool():
+    return pool_status(engine)
@@ -28,6 +28,10 @@ class Video(Base):
     # Defaults to the current UTC time
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # Modification time and size of the metadata file in the VOD server listing when it was last read
+    # The metadata is read again only when they change (null: not read successfully yet)
+    metadata_version = Column(String, nullable=True)
+
 # SQLAlchemy model representing the "comments" table in the database
 class Comment(Base):
     __tablename__ = "comments" # Name of the table in the database
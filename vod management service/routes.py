@@ -2,104 +2,228 @@ from pydantic_models import VideoCreate, VideoResponse, CommentCreate, CommentRe
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from auth import verify_token
+from logs import request_id_headers
 from bs4 import BeautifulSoup
 from datetime import datetime 
-from database import get_db
+from database import get_db, init_db, SessionLocal
 from models import Video, Comment
+from events import event_bus, VIDEO_PUBLISHED, VIDEO_UPDATED, COMMENT_CREATED
 from typing import List
 from pathlib import Path
+import threading
 import requests
-import time
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
 # Base URL of the NGINX VOD server (can be set via environment variable or fallback to default)
 VOD_SERVER_URL = os.getenv("VOD_SERVER_URL", "http://nginx-vod-service:7000/vod/")
 
+# Base URL of the user service, used to look up the current usernames of comment authors
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:80")
+USER_LOOKUP_TIMEOUT = float(os.getenv("USER_LOOKUP_TIMEOUT", "2"))    # Seconds to wait for the user service
+VOD_SERVER_TIMEOUT = float(os.getenv("VOD_SERVER_TIMEOUT", "5"))      # Seconds to wait for the directory listing or a metadata file
+
 # Global URL used for video streaming from the local dev environment
 # VOD_SERVER_URL_GLOBAL = "http://localhost:8080/vod/"
 
-# Runs automatically when the app starts to sync available videos from the VOD server
-@router.on_event("startup")
-def startup_sync_videos():
-
-    # This function is triggered when the FastAPI application starts.
-    # It attempts to connect to the NGINX VOD server, extract available video files,
-    # read their metadata, and synchronize them with the local database.
+# Settings of the background startup task (exponential backoff between attempts)
+# The schema creation is retried until the database is reachable, only the catalog sync gives up
+SYNC_MAX_RETRIES = int(os.getenv("SYNC_MAX_RETRIES", "8"))               # Maximum number of catalog sync attempts
+SYNC_INITIAL_DELAY = float(os.getenv("SYNC_INITIAL_DELAY", "1"))         # First wait time (in seconds)
+SYNC_MAX_DELAY = float(os.getenv("SYNC_MAX_DELAY", "60"))                # Upper limit of the wait time (in seconds)
+
+# Shared state of the background startup task, reported by the readiness endpoint
+# status: "pending" -> "initializing" (database not reachable yet) -> "running" -> "ready" or "failed"
+sync_state = {
+    "status": "pending",
+    "db_attempts": 0,
+    "attempts": 0,
+    "synced_videos": 0,
+    "last_error": None,
+    "last_synced_at": None,
+}
+_sync_lock = threading.Lock()
+_sync_thread = None
+_sync_stop = threading.Event()
+
+# Returns the metadata file path that belongs to a master playlist
+def metadata_file_for(file):
+    # New format: slug.m3u8 -> slug_info.txt (simple replacement)
+    # Old nested format: <slug>/master.m3u8 -> <slug>/<slug>_info.txt
+    path_obj = Path(file)
+    if path_obj.name == "master.m3u8":
+        slug = path_obj.parent.name if path_obj.parent.name else path_obj.stem
+        return str(path_obj.parent / f"{slug}_info.txt")
+    return file.replace(".m3u8", "_info.txt")
+
+# Metadata of a video whose metadata file can't be read
+METADATA_FALLBACK = ("No Title", "No Category", "No Duration", "No Description")
+
+# Payload of the video.published and video.updated events
+def video_event_payload(video):
+    return {"video_id": video.id, "title": video.title, "category": video.category, "path": video.path, "duration": video.duration}
+
+# Adds every video file that is not yet in the database and applies the changed metadata files,
+# returns the number of new videos
+# file_versions: modification time and size of the files in the listing (see extract_file_versions), the
+# metadata of a known video is only read again when the version of its metadata file changed
+def sync_video_files(db: Session, video_files, file_versions=None):
+    file_versions = file_versions or {}
+    # Load all known videos with one query instead of one query per file
+    known_videos = {video.path: video for video in db.query(Video).all()}
+    added, updated = [], []
+    changed = False
+
+    for file in video_files:
+        path = f"/{file}"
+        metadata_file = metadata_file_for(file)
+        version = file_versions.get(metadata_file)
+        video = known_videos.get(path)
+        if video is not None and (version is None or version == video.metadata_version):
+            continue
+
+        # Read metadata (title, category, duration, description)
+        metadata_path = os.path.join(VOD_SERVER_URL, metadata_file)
+        title, category, duration, description = read_metadata(metadata_path)
+        if (title, category, duration, description) == METADATA_FALLBACK:
+            version = None # Not read, try again on the next sync
+
+        if video is not None:
+            # The metadata file was rewritten (e.g. the video was uploaded again with a new title)
+            # A file that can't be read now does not overwrite the stored metadata
+            if version is None:
+                continue
+            if (video.title, video.category, video.duration, video.description) != (title, category, duration, description):
+                video.title, video.category, video.duration, video.description = title, category, duration, description
+                updated.append(video)
+                logger.info("Video metadata updated", extra={"title": title})
+            video.metadata_version = version
+            changed = True
+            continue
+
+        # Create a new Video entry
+        video = Video(
+            title=title,
+            description=description,
+            path=path,
+            category=category,
+            duration=duration,
+            metadata_version=version,
+            created_at=datetime.utcnow()
+        )
+        db.add(video)
+        known_videos[path] = video
+        added.append(video)
+
+        # Log the newly added video
+        logger.info("Video added", extra={"title": title})
+
+    # Save all changes in one transaction, the events are sent with it
+    if added or changed:
+        db.flush() # Assigns the ids of the new videos
+        for video in added:
+            event_bus.publish(db, VIDEO_PUBLISHED, video_event_payload(video))
+        for video in updated:
+            event_bus.publish(db, VIDEO_UPDATED, video_event_payload(video))
+        db.commit()
+    return len(added)
+
+# Creates the schema and synchronizes the catalog, retrying with exponential backoff
+def run_startup_sync():
+
+    # It attempts to create the database tables, connect to the NGINX VOD server,
+    # extract available video files, read their metadata, and synchronize them with the local database.
+    # Runs in a background thread so the application starts serving requests immediately.
+
+    # Create the tables first: without them no request can be served, so this is retried
+    # (with the delay capped at SYNC_MAX_DELAY) until the database is reachable or the service stops
+    sync_state["status"] = "initializing"
+    delay = SYNC_INITIAL_DELAY
+    while True:
+        sync_state["db_attempts"] += 1
+        try:
+            init_db()
+            break
+        except Exception as e:
+            sync_state["last_error"] = str(e)
+            logger.warning("Database not reachable, retrying the schema creation: %s", e)
+        if _wait_before_retry(delay):
+            return
+        delay = min(delay * 2, SYNC_MAX_DELAY)
 
     # Log the start of the synchronization process
-    print("Start video syncronization...")
-
-    db = next(get_db()) # Open a new database session
-    max_retries = 5 # Maximum number of retries
-    retry_delay = 5 # Wait time (in seconds) between retries
-
-    try:
-        for attempt in range(max_retries):
+    logger.info("Starting video synchronization")
+    sync_state["status"] = "running"
+    delay = SYNC_INITIAL_DELAY
+
+    for attempt in range(SYNC_MAX_RETRIES):
+        sync_state["attempts"] = attempt + 1
+        try:
+            # Log the current attempt to reach the VOD server
+            logger.info("Reaching the NGINX server", extra={"attempt": attempt + 1, "max_attempts": SYNC_MAX_RETRIES})
+
+            # Send GET request to the VOD server to get HTML listing of files
+            response = requests.get(VOD_SERVER_URL, timeout=VOD_SERVER_TIMEOUT)
+            response.raise_for_status()
+
+            # Extract list of video filenames from the HTML and store the new and changed ones
+            db = SessionLocal()
             try:
-                # Log the current attempt to reach the VOD server
-                print(f"{attempt + 1}/{max_retries} attempt to reach the NGINX server...")
-
-                # Send GET request to the VOD server to get HTML listing of files
-                response = requests.get(VOD_SERVER_URL)
-                response.raise_for_status()
-
-                # Extract list of video filenames from the HTML
-                video_files = extract_video_filenames(response.text)
-
-                for file in video_files:
-                    # Check if the video is already in the database
-                    if not db.query(Video).filter(Video.path == f"/{file}").first():
-                        # Build the corresponding metadata file path
-                        # New format: slug.m3u8 -> slug_info.txt (simple replacement)
-                        # Old nested format: <slug>/master.m3u8 -> <slug>/<slug>_info.txt
-                        path_obj = Path(file)
-                        if path_obj.name == "master.m3u8":
-                            # Old nested format: <slug>/master.m3u8 -> <slug>/<slug>_info.txt
-                            slug = path_obj.parent.name if path_obj.parent.name else path_obj.stem
-                            metadata_file = str(path_obj.parent / f"{slug}_info.txt")
-                        else:
-                            # Standard format: slug.m3u8 -> slug_info.txt
-                            metadata_file = file.replace(".m3u8", "_info.txt")
-                        metadata_path = os.path.join(VOD_SERVER_URL, metadata_file)
-
-                        # Read metadata (title, category, duration, description)
-                        title, category, duration, description = read_metadata(metadata_path)
-
-                        # Create a new Video entry
-                        new_video = Video(
-                            title=title,
-                            description=description,
-                            path=f"/{file}",
-                            category=category,
-                            duration=duration,
-                            created_at=datetime.utcnow()
-                        )
-
-                        # Save the new video to the database
-                        db.add(new_video)
-                        db.commit()
-
-                        # Log the newly added video
-                        print(f"Video added: {new_video.title}")
-                break  # If successful, break out of the retry loop
-
-            except requests.RequestException as e:
-                # Log the failed attempt to contact the VOD server
-                print(f"Unsuccessfull attempt: {e}")
-                time.sleep(retry_delay) # Wait before retrying
-
-        else:
-            # All attempts failed, log that max retries were reached
-            print("Reached the number of max attempts.")
-    except Exception as e:
-        # Log any other unexpected error that occurred during sync
-        print(f"Error during syncronization: {e}")
-    finally:
-        db.close() # Ensure the database connection is closed
-        # Log the close
-        print("Database connection closed.")
+                sync_state["synced_videos"] = sync_video_files(db, extract_video_filenames(response.text), extract_file_versions(response.text))
+            finally:
+                db.close() # Ensure the database connection is closed
+
+            sync_state["status"] = "ready"
+            sync_state["last_error"] = None
+            sync_state["last_synced_at"] = datetime.utcnow().isoformat()
+            logger.info("Video synchronization finished", extra={"synced_videos": sync_state["synced_videos"]})
+            return
+
+        except Exception as e:
+            # Log the failed attempt (VOD server or database not reachable)
+            sync_state["last_error"] = str(e)
+            logger.warning("Unsuccessful synchronization attempt: %s", e)
+
+        # Wait before retrying, doubling the delay each time (a shutdown ends the wait)
+        if attempt + 1 < SYNC_MAX_RETRIES:
+            if _wait_before_retry(delay):
+                return
+            delay = min(delay * 2, SYNC_MAX_DELAY)
+
+    # All attempts failed, log that max retries were reached
+    # The schema exists, so the service stays ready and GET /videos keeps adding the new videos
+    sync_state["status"] = "failed"
+    logger.error("Video synchronization failed, reached the maximum number of attempts")
+
+# Waits before the next attempt, returns True if the shutdown ended the wait
+def _wait_before_retry(delay):
+    if _sync_stop.wait(delay):
+        sync_state["status"] = "stopped"
+        logger.info("Video synchronization stopped by the shutdown")
+        return True
+    return False
+
+# Starts the background startup task (does nothing if it is already running)
+def start_background_sync():
+    global _sync_thread
+    with _sync_lock:
+        if _sync_thread is not None and _sync_thread.is_alive():
+            return
+        _sync_stop.clear()
+        _sync_thread = threading.Thread(target=run_startup_sync, name="video-sync", daemon=True)
+        _sync_thread.start()
+
+# Stops the retries of the background startup task and waits for the running attempt
+def stop_background_sync(timeout=None):
+    _sync_stop.set()
+    with _sync_lock:
+        thread = _sync_thread
+    if thread is not None:
+        thread.join(timeout)
 
 
 # Function: Extracts .m3u8 filenames from the HTML content of the VOD directory
@@ -126,12 +250,24 @@ def extract_video_filenames(html_content):
                 # Old nested format: <slug>/master.m3u8
                 video_files.append(href)
 
-    # Log the extracted filenames for debugging purposes        
-    print(f"Extracted filenames: {video_files}")
+    # Log the number of extracted filenames (the names themselves only at debug level)
+    logger.debug("Extracted video filenames", extra={"count": len(video_files), "filenames": video_files})
 
     # Return the video files
     return video_files
 
+# Function: Extracts the modification time and size of every file in the HTML of the VOD directory listing
+# NGINX autoindex writes them after the link: <a href="x_info.txt">x_info.txt</a>   19-Oct-2026 18:56   123
+def extract_file_versions(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    versions = {}
+    for link in soup.find_all('a'):
+        href = link.get('href')
+        details = link.next_sibling
+        if href and isinstance(details, str) and details.strip():
+            versions[href] = " ".join(details.split()[:3])
+    return versions
+
 # Endpoint to retrieve a video stream URL based on the filename
 @router.get("/videos/{filename}", dependencies=[Depends(verify_token)])
 def get_video_by_filename(filename: str, db: Session = Depends(get_db)):
@@ -144,14 +280,14 @@ def get_video_by_filename(filename: str, db: Session = Depends(get_db)):
 
     # If the video doesn't exist, raise a 404 error
     if not video:
-        print(f"Video not found: {filename}")
+        logger.info("Video not found", extra={"video_filename": filename})
         raise HTTPException(status_code=404, detail="Video not found")
 
     # Construct the full URL using the VOD base path
     video_url = f"{VOD_SERVER_URL}{filename}"
 
-    # Log the generation of the video URL
-    print(f"Video URL generated: {video_url}")
+    # Log the generation of the video URL (sampled, it is logged on every playback)
+    logger.info("Video URL generated", extra={"video_url": video_url, "sample_rate": 0.01})
 
     # Return the full video URL as JSON
     return {"video_url": video_url}
@@ -167,11 +303,8 @@ def list_videos(db: Session = Depends(get_db)):
     #The final response returns all video entries stored in the database.
 
     try:
-        # Log the start of the request
-        print("Requesting video list from NGINX server")
-
         # Send a request to the NGINX server to get the directory listing (HTML)
-        response = requests.get(VOD_SERVER_URL)
+        response = requests.get(VOD_SERVER_URL, timeout=VOD_SERVER_TIMEOUT)
 
         # Raise an exception if the server response is not successful (e.g., 404 or 500)
         response.raise_for_status()
@@ -179,38 +312,13 @@ def list_videos(db: Session = Depends(get_db)):
         # Extract filenames (*.m3u8) from the HTML response
         video_files = extract_video_filenames(response.text)
 
-        # Iterate through each video file to check if it exists in the database
-        for file in video_files:
-            # Check if the video already exists based on its path
-            existing_video = db.query(Video).filter(Video.path == f"/{file}").first()
-
-            if not existing_video:
-                # Construct metadata file path and read its content
-                metadata_file = file.replace(".m3u8", "_info.txt")
-                metadata_path = os.path.join(VOD_SERVER_URL, metadata_file)
-
-                # Parse metadata from the associated .txt file
-                title, category, duration, description = read_metadata(metadata_path)
-
-                # Create a new Video model instance with the parsed metadata
-                new_video = Video(
-                    title=title,
-                    description=description,
-                    path=f"/{file}",
-                    category=category,
-                    duration=duration,
-                    created_at=datetime.utcnow()
-                )
-
-                # Save the new video record into the database
-                db.add(new_video)
-                db.commit()
-        
+        # Add the video files that are not in the database yet and apply the changed metadata files
+        sync_video_files(db, video_files, extract_file_versions(response.text))
+
         # After processing, fetch the complete list of videos from the database
         videos = db.query(Video).all()
-        # Log the available videos
-        print(f"{len(videos)} videos are in the database.")
-        print(videos)
+        # Log the number of available videos (sampled, the list is requested on every page load)
+        logger.info("Video list served", extra={"videos": len(videos), "sample_rate": 0.01})
 
         # Return the list of videos to the client
         return videos
@@ -231,7 +339,7 @@ def read_metadata(metadata_url: str):
 
     try:
         # Make an HTTP GET request to download the metadata file
-        response = requests.get(metadata_url)
+        response = requests.get(metadata_url, timeout=VOD_SERVER_TIMEOUT)
 
         # Raise an HTTPException if the request failed (e.g., 404 or 500)
         response.raise_for_status()
@@ -255,13 +363,39 @@ def read_metadata(metadata_url: str):
         return title, category, duration, description
     except Exception as e:
         # In case of any error (e.g., network failure, file format issue), log error
-        print(f"Failed to read metadata: {e}")
+        logger.warning("Failed to read metadata: %s", e)
 
         # Return safe fallback values so the application doesn't break
-        return "No Title", "No Category", "No Duration", "No Description"
+        return METADATA_FALLBACK
 
 # COMMENT API ENDPOINTS
 
+# Returns the comments with the current usernames of their authors, looked up with one batch request
+# The username stored with the comment is kept if the user service can't be reached or the user is gone
+def with_current_usernames(comments):
+    user_ids = sorted({comment.user_id for comment in comments})
+    usernames = {}
+    if user_ids:
+        try:
+            response = requests.post(f"{USER_SERVICE_URL}/users/batch", json={"ids": user_ids}, headers=request_id_headers(), timeout=USER_LOOKUP_TIMEOUT)
+            response.raise_for_status()
+            usernames = {user["id"]: user["username"] for user in response.json()["users"]}
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.warning("Failed to look up the comment authors: %s", e)
+
+    return [
+        CommentResponse(
+            id=comment.id,
+            video_id=comment.video_id,
+            user_id=comment.user_id,
+            username=usernames.get(comment.user_id, comment.username),
+            content=comment.content,
+            created_at=comment.created_at,
+            updated_at=comment.updated_at,
+        )
+        for comment in comments
+    ]
+
 # Get all comments for a specific video
 @router.get("/videos/{video_id}/comments", response_model=List[CommentResponse])
 def get_video_comments(video_id: int, db: Session = Depends(get_db)):
@@ -277,7 +411,8 @@ def get_video_comments(video_id: int, db: Session = Depends(get_db)):
     # Get all comments for the video, ordered by creation date (newest first)
     comments = db.query(Comment).filter(Comment.video_id == video_id).order_by(Comment.created_at.desc()).all()
     
-    return comments
+    # Show the current usernames (the stored ones are not updated when a user is renamed)
+    return with_current_usernames(comments)
 
 # Get comment count for a specific video
 @router.get("/videos/{video_id}/comments/count")
@@ -322,8 +457,16 @@ def create_comment(video_id: int, comment: CommentCreate,
         content=comment.content
     )
     
-    # Add to database
+    # Add to database, subscribers learn about the comment from the event written in the same transaction
     db.add(new_comment)
+    db.flush()
+    event_bus.publish(db, COMMENT_CREATED, {
+        "comment_id": new_comment.id,
+        "video_id": video_id,
+        "user_id": new_comment.user_id,
+        "username": new_comment.username,
+        "created_at": new_comment.created_at.isoformat(),
+    })
     db.commit()
     db.refresh(new_comment)
     